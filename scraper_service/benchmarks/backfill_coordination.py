@@ -0,0 +1,182 @@
+"""
+Starts several processes backfilling one shovel with lease coordination against a local
+Clickhouse, one of which dies halfway through the first range it claims and another of which is
+suspended there until its lease has expired, and checks that every range was completed exactly
+once, every block's rows were inserted by its range's owner only, and the checkpoint ends
+contiguous at the last range. Exits 1 if any check fails. Needs no archive node.
+
+    cd scraper_service
+    python -m benchmarks.backfill_coordination --workers 4 --ranges 20
+
+Uses the same CLICKHOUSE_* environment variables as the shovels. Each run uses its own
+shovel name, whose leases, checkpoints and rows are deleted afterwards.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from shared.clickhouse.batch_insert import buffer_insert, drain_buffer, set_shovel_name
+from shared.clickhouse.checkpoints import CHECKPOINTS_TABLE, read_checkpoint
+from shared.clickhouse.leases import LEASES_TABLE
+from shared.clickhouse.schema import catalogue
+from shared.clickhouse.utils import get_clickhouse_client
+from shared.shovel_base_class import ShovelBaseClass
+
+TABLE = "shovel_backfill_coordination_benchmark"
+FIRST_BLOCK = 1_000_000
+
+
+class CoordinatedShovel(ShovelBaseClass):
+    """
+    Inserts one row per block naming the process that processed it. With `crash_after`, the
+    process exits without flushing once it has processed that many blocks, as if killed. With
+    `pause_after`, it stops every thread, heartbeat included, for `pause_seconds` once it has
+    processed that many blocks, as if its host were suspended.
+    """
+
+    backfill_coordination = "lease"
+
+    def __init__(self, name, crash_after, pause_after, pause_seconds, block_seconds):
+        super().__init__(name)
+        self.crash_after = crash_after
+        self.pause_after = pause_after
+        self.pause_seconds = pause_seconds
+        self.block_seconds = block_seconds
+        self.processed = 0
+
+    def process_block(self, n):
+        if self.crash_after is not None and self.processed == self.crash_after:
+            os._exit(1)
+        if self.pause_after is not None and self.processed == self.pause_after:
+            self.pause_after = None
+            subprocess.Popen(["sh", "-c", f"sleep {self.pause_seconds}; kill -CONT {os.getpid()}"])
+            os.kill(os.getpid(), signal.SIGSTOP)
+        time.sleep(self.block_seconds)
+        buffer_insert(TABLE, [self.name, n, os.getpid()])
+        self.processed += 1
+
+
+def run_worker(shovel_name, last_block, chunk_size, lease_ttl, crash_after, pause_after, block_seconds, results):
+    shovel = CoordinatedShovel(shovel_name, crash_after, pause_after, 2 * lease_ttl, block_seconds)
+    shovel.backfill_chunk_size = chunk_size
+    shovel.backfill_lease_ttl = lease_ttl
+    set_shovel_name(shovel_name)
+    shovel._coordinated_backfill(FIRST_BLOCK, last_block)
+    drain_buffer()
+    shovel._save_checkpoint(shovel.checkpoint_block_number)
+    results.put((os.getpid(), shovel.checkpoint_block_number))
+
+
+def check(failures, ok, message):
+    print(f"  {'ok' if ok else 'FAILED'}: {message}")
+    if not ok:
+        failures.append(message)
+
+
+def verify(shovel_name, ranges, last_block, exit_codes, checkpoints):
+    client = get_clickhouse_client()
+    failures = []
+
+    done_claims = dict(client.execute(f"""
+        SELECT range_start, groupArray(owner)
+        FROM {LEASES_TABLE} FINAL
+        WHERE shovel_name = '{shovel_name}' AND done
+        GROUP BY range_start
+    """))
+    completed_once = [range_start for (range_start, _) in ranges if len(done_claims.get(range_start, [])) == 1]
+    check(failures, len(completed_once) == len(ranges) and len(done_claims) == len(ranges),
+          f"{len(completed_once)} of {len(ranges)} ranges completed exactly once, "
+          f"{len(done_claims)} ranges marked done")
+
+    # The process that completed a range must have inserted all of its rows
+    block_pids = dict(client.execute(f"""
+        SELECT block_number, groupUniqArray(pid)
+        FROM {TABLE}
+        WHERE shovel_name = '{shovel_name}'
+        GROUP BY block_number
+    """))
+    missing = []
+    foreign = []
+    for (range_start, range_end) in ranges:
+        owners = done_claims.get(range_start, [])
+        pid = int(owners[0].split(":")[1]) if owners else None
+        missing.extend(n for n in range(range_start, range_end + 1) if pid not in block_pids.get(n, []))
+        foreign.extend(n for n in range(range_start, range_end + 1) if set(block_pids.get(n, [])) - {pid})
+    check(failures, not missing,
+          f"{len(missing)} blocks missing rows from their range's owner" + (f", e.g. {missing[:5]}" if missing else ""))
+    # The suspended worker's rows for the range it lost must have been discarded
+    check(failures, not foreign,
+          f"{len(foreign)} blocks with rows from other workers" + (f", e.g. {foreign[:5]}" if foreign else ""))
+
+    crashed = [code for code in exit_codes if code != 0]
+    check(failures, len(crashed) == 1, f"{len(crashed)} of {len(exit_codes)} workers crashed, expected 1")
+    check(failures, sorted(checkpoints) == [last_block] * (len(exit_codes) - 1),
+          f"surviving workers ended at checkpoints {sorted(checkpoints)}, expected {last_block}")
+    persisted = read_checkpoint(shovel_name)
+    check(failures, persisted == last_block, f"persisted checkpoint {persisted}, expected {last_block}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--ranges", type=int, default=20)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--lease-ttl", type=int, default=10)
+    parser.add_argument("--block-seconds", type=float, default=0.005)
+    args = parser.parse_args()
+
+    shovel_name = f"backfill_coordination_{uuid.uuid4().hex[:8]}"
+    last_block = FIRST_BLOCK + args.ranges * args.chunk_size - 1
+    ranges = [
+        (range_start, range_start + args.chunk_size - 1)
+        for range_start in range(FIRST_BLOCK, last_block + 1, args.chunk_size)
+    ]
+
+    client = get_clickhouse_client()
+    client.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            shovel_name String,
+            block_number UInt64,
+            pid UInt32
+        ) ENGINE = MergeTree()
+        ORDER BY (shovel_name, block_number)
+    """)
+    catalogue.refresh(TABLE)
+
+    print(f"Backfilling {len(ranges)} ranges of {args.chunk_size} blocks with {args.workers} workers as {shovel_name}")
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_worker, args=(
+            shovel_name, last_block, args.chunk_size, args.lease_ttl,
+            # The first worker dies mid-range, so its lease has to expire and be taken over
+            args.chunk_size // 2 if i == 0 else None,
+            # The second loses its lease mid-range and has to give the range up
+            args.chunk_size // 2 if i == 1 else None,
+            args.block_seconds, results,
+        ))
+        for i in range(args.workers)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    checkpoints = [results.get(timeout=10)[1] for worker in workers if worker.exitcode == 0]
+    print(f"Workers finished in {time.perf_counter() - started:.1f}s")
+
+    try:
+        failures = verify(shovel_name, ranges, last_block, [worker.exitcode for worker in workers], checkpoints)
+    finally:
+        for table in (LEASES_TABLE, CHECKPOINTS_TABLE, TABLE):
+            client.execute(f"ALTER TABLE {table} DELETE WHERE shovel_name = '{shovel_name}'")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
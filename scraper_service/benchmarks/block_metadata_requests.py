@@ -0,0 +1,142 @@
+"""
+Counts the Clickhouse queries and Substrate requests `get_block_metadata` makes per block
+during sequential catch-up, against in-memory stand-ins for Clickhouse and the node, and fails
+if they exceed the expected budget. Needs no archive node or Clickhouse.
+
+    cd scraper_service
+    python -m benchmarks.block_metadata_requests --blocks 5000
+"""
+import argparse
+import sys
+from datetime import datetime, timezone
+from shared import block_metadata
+
+
+class Counts:
+    def __init__(self):
+        self.clickhouse_queries = 0
+        self.hash_batches = 0
+        self.hashes_fetched = 0
+        self.single_hashes = 0
+        self.timestamp_queries = 0
+
+
+class FakeClickhouse:
+    def __init__(self, counts, stored_from):
+        self.counts = counts
+        self.stored_from = stored_from
+
+    def execute(self, query):
+        self.counts.clickhouse_queries += 1
+        words = query.split()
+        first = int(words[words.index(">=") + 1])
+        end = int(words[words.index("<") + 1])
+        return [
+            (datetime.fromtimestamp(n * 12, timezone.utc), n, f"0x{n:064x}")
+            for n in range(max(first, self.stored_from), end)
+        ]
+
+
+class FakeTimestamp:
+    def serialize(self):
+        return 1_700_000_000_000
+
+
+class FakeSubstrate:
+    def __init__(self, counts):
+        self.counts = counts
+
+    def get_block_hash(self, n):
+        self.counts.single_hashes += 1
+        return f"0x{n:064x}"
+
+    def query(self, module, storage, block_hash=None):
+        self.counts.timestamp_queries += 1
+        return FakeTimestamp()
+
+
+class FakeCatalogue:
+    def columns(self, table):
+        return [("block_number", "UInt64"), ("timestamp", "DateTime"), ("block_hash", "String")]
+
+
+def run(first_block, blocks, stored_from):
+    """
+    Looks up blocks first_block.. in order, with Clickhouse holding timestamps and hashes from
+    stored_from onwards. Returns the counts.
+    """
+    counts = Counts()
+
+    def get_block_hashes(block_numbers):
+        counts.hash_batches += 1
+        counts.hashes_fetched += len(block_numbers)
+        return [f"0x{n:064x}" for n in block_numbers]
+
+    block_metadata.get_clickhouse_client = lambda: FakeClickhouse(counts, stored_from)
+    block_metadata.get_substrate_client = lambda: FakeSubstrate(counts)
+    block_metadata.get_block_hashes = get_block_hashes
+    block_metadata.catalogue = FakeCatalogue()
+    block_metadata.header_index = None
+    block_metadata.timestamps.clear()
+    block_metadata.block_hashes.clear()
+    block_metadata.prefetched_hashes.clear()
+    block_metadata.timestamp_window = None
+    block_metadata.prefetch_window = None
+    block_metadata.last_hash_lookup = None
+    block_metadata.block_cache.entries.clear()
+
+    for n in range(first_block, first_block + blocks):
+        block_metadata.get_block_metadata(n)
+    return counts
+
+
+def check(name, counts, blocks, budget):
+    print(
+        f"{name}: {counts.clickhouse_queries} Clickhouse queries, {counts.hash_batches} hash batches "
+        f"({counts.hashes_fetched} hashes), {counts.single_hashes} single hash requests, "
+        f"{counts.timestamp_queries} timestamp queries for {blocks} blocks"
+    )
+    failed = [
+        f"{key} {getattr(counts, key)} > {limit}"
+        for (key, limit) in budget.items()
+        if getattr(counts, key) > limit
+    ]
+    for failure in failed:
+        print(f"  FAILED: {failure}")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--blocks", type=int, default=5000)
+    args = parser.parse_args()
+    blocks = args.blocks
+    windows = blocks // block_metadata.BLOCK_HASH_PREFETCH + 1
+    clickhouse_windows = blocks // 10_000 + 1
+
+    ok = check("stored in Clickhouse", run(1_000_000, blocks, 0), blocks, {
+        "clickhouse_queries": clickhouse_windows,
+        "hash_batches": 0,
+        "single_hashes": 0,
+        "timestamp_queries": 0,
+    })
+    # Below the first block of the timestamp shovel, as when events are backfilled from 0
+    ok &= check("not in Clickhouse", run(0, blocks, 10**9), blocks, {
+        "clickhouse_queries": clickhouse_windows,
+        "hash_batches": windows,
+        "hashes_fetched": windows * block_metadata.BLOCK_HASH_PREFETCH,
+        "single_hashes": 1,
+        "timestamp_queries": blocks,
+    })
+    # Clickhouse only has the second half, from where the timestamp shovel started
+    ok &= check("half in Clickhouse", run(0, blocks, blocks // 2), blocks, {
+        "clickhouse_queries": clickhouse_windows,
+        "hash_batches": windows,
+        "single_hashes": 1,
+        "timestamp_queries": blocks // 2,
+    })
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
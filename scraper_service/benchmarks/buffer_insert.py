@@ -0,0 +1,67 @@
+"""
+Measures the cost of queueing a block's rows one at a time with `buffer_insert` against a
+single `buffer_insert_many` call, on `shovel_stake_double_map`-shaped rows. Nothing is sent to
+Clickhouse.
+
+    cd scraper_service
+    python -m benchmarks.buffer_insert --rows 500000
+"""
+import argparse
+import random
+import time
+from shared.clickhouse import batch_insert
+from shared.clickhouse.batch_insert import buffer_insert, buffer_insert_many, reset_buffer
+
+TABLE = "shovel_stake_double_map"
+
+
+def make_rows(count):
+    return [
+        [4_000_000, 1_700_000_000, f"5{random.getrandbits(256):064x}"[:48],
+         f"5{random.getrandbits(256):064x}"[:48], random.getrandbits(50)]
+        for _ in range(count)
+    ]
+
+
+def per_row(rows):
+    for row in rows:
+        buffer_insert(TABLE, row)
+
+
+def batched(rows):
+    buffer_insert_many(TABLE, rows)
+
+
+def measure(name, insert, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        reset_buffer()
+        started = time.perf_counter()
+        insert(rows)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    reset_buffer()
+    print(f"{name:>8}: {best * 1000:.1f}ms, {best / len(rows) * 1e9:.0f}ns per row")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # Keep every row in the buffer, so no flush or drain is triggered while measuring
+    batch_insert.set_insert_profile(batch_insert.InsertProfile(
+        "benchmark", {}, flush_max_rows=float("inf"), flush_max_bytes=float("inf"), flush_max_age=float("inf"),
+    ))
+    batch_insert.BUFFER_MEMORY_BUDGET = float("inf")
+
+    rows = make_rows(args.rows)
+    slow = measure("per row", per_row, rows, args.repeat)
+    fast = measure("batched", batched, rows, args.repeat)
+    print(f"buffer_insert_many is {slow / fast:.0f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Routes `chain_getBlockHash` requests through `RoutedSubstrateInterface` to local mock JSON-RPC
+archive nodes of different speed and reliability, with and without hedging, and reports which
+node answered and how long requests took. Halfway through, the fastest node is shut down to
+show failover. Needs no archive node or Clickhouse.
+
+    cd scraper_service
+    python -m benchmarks.endpoint_routing --requests 2000
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shared import endpoints
+from shared.endpoints import EndpointPool
+from shared.substrate import RoutedSubstrateInterface
+
+
+class MockNode:
+    """
+    JSON-RPC node over HTTP that answers after `latency` seconds, or `stall` seconds for a
+    `stall_rate` share of requests, and fails a `fail_rate` share with HTTP 503.
+    """
+
+    def __init__(self, name, latency, stall_rate=0.0, stall=0.0, fail_rate=0.0):
+        self.name = name
+        self.answered = 0
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if random.random() < fail_rate:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                time.sleep(stall if random.random() < stall_rate else latency)
+                if request["method"] == "chain_getBlockHash":
+                    result = f"0x{request['params'][0]:064x}"
+                elif request["method"] == "system_chain":
+                    result = "Mock"
+                else:
+                    result = None
+                body = json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                node.answered += 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def percentile(values, p):
+    return sorted(values)[min(int(len(values) * p), len(values) - 1)]
+
+
+def measure(name, hedge, requests):
+    nodes = [
+        MockNode("fast", latency=0.005, stall_rate=0.03, stall=0.5),
+        MockNode("slow", latency=0.03),
+        MockNode("flaky", latency=0.002, fail_rate=0.3),
+    ]
+    endpoints.HEDGE_REQUESTS = hedge
+    substrate = RoutedSubstrateInterface(EndpointPool([node.url for node in nodes]))
+    phases = {"all up": [], "fast down": []}
+    errors = 0
+    for i in range(requests):
+        if i == requests // 2:
+            nodes[0].stop()
+        started = time.perf_counter()
+        try:
+            substrate.rpc_request("chain_getBlockHash", [i])
+        except Exception:
+            errors += 1
+        phases["all up" if i < requests // 2 else "fast down"].append(time.perf_counter() - started)
+    substrate.close()
+    for node in nodes[1:]:
+        node.stop()
+
+    print(f"{name}: {errors} errors, answered by " + ", ".join(f"{node.name} {node.answered}" for node in nodes))
+    for (phase, timings) in phases.items():
+        print(
+            f"  {phase:>9}: p50 {percentile(timings, 0.5) * 1000:.1f}ms, "
+            f"p99 {percentile(timings, 0.99) * 1000:.1f}ms, max {max(timings) * 1000:.1f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    measure("no hedging", False, args.requests)
+    measure("hedging", True, args.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Replays a backfill of `shovel_stake_map`-shaped rows across a month boundary and compares the
+parts and merge work of inserting flushes in arrival order with inserting them split by
+partition and pre-sorted by the ORDER BY key. Rows go to a scratch table dropped afterwards.
+
+    cd scraper_service
+    python -m benchmarks.part_counts --blocks 20000 --flush-blocks 500
+
+Uses the same CLICKHOUSE_* environment variables as the shovels. Merge totals come from
+system.part_log, when the server has it enabled.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timezone
+from shared.clickhouse.batch_insert import _insert_rows
+from shared.clickhouse.partitions import arrange_rows
+from shared.clickhouse.schema import catalogue
+from shared.clickhouse.utils import get_clickhouse_client
+
+TABLE = "shovel_stake_map_benchmark"
+
+
+def make_flushes(blocks, flush_blocks, accounts):
+    """
+    Returns the rows of each flush, as a shovel would buffer them: block by block, every
+    account's stake at that block. Blocks start a day before a month boundary.
+    """
+    start = int(datetime(2024, 6, 30, tzinfo=timezone.utc).timestamp())
+    keys = [
+        (f"5{random.getrandbits(256):064x}"[:48], f"5{random.getrandbits(256):064x}"[:48])
+        for _ in range(accounts)
+    ]
+    flushes = []
+    rows = []
+    for block_number in range(blocks):
+        timestamp = start + block_number * 12
+        for (coldkey, hotkey) in random.sample(keys, len(keys)):
+            rows.append([block_number, timestamp, coldkey, hotkey, random.getrandbits(50)])
+        if (block_number + 1) % flush_blocks == 0:
+            flushes.append(rows)
+            rows = []
+    if rows:
+        flushes.append(rows)
+    return flushes
+
+
+def insert_in_arrival_order(rows):
+    _insert_rows(TABLE, rows)
+
+
+def insert_arranged(rows):
+    for chunk in arrange_rows(TABLE, rows):
+        _insert_rows(TABLE, chunk)
+
+
+def measure(name, insert, flushes):
+    client = get_clickhouse_client()
+    client.execute(f"TRUNCATE TABLE {TABLE}")
+    client.execute(f"SYSTEM STOP MERGES {TABLE}")
+    started = time.perf_counter()
+    for rows in flushes:
+        insert(rows)
+    inserted = time.perf_counter() - started
+    [(parts,)] = client.execute(f"SELECT count() FROM system.parts WHERE table = '{TABLE}' AND active")
+
+    client.execute(f"SYSTEM START MERGES {TABLE}")
+    merge_started = datetime.now(timezone.utc).replace(tzinfo=None)
+    started = time.perf_counter()
+    client.execute(f"OPTIMIZE TABLE {TABLE} FINAL")
+    optimized = time.perf_counter() - started
+
+    merged = ""
+    try:
+        client.execute("SYSTEM FLUSH LOGS")
+        [(merges, read_bytes)] = client.execute(
+            f"""
+            SELECT count(), sum(read_bytes)
+            FROM system.part_log
+            WHERE table = '{TABLE}' AND event_type = 'MergeParts' AND event_time >= %(since)s
+            """,
+            {"since": merge_started},
+        )
+        merged = f", {merges} merges reading {read_bytes / 2**20:,.0f} MiB"
+    except Exception as e:
+        merged = f" (no system.part_log: {e})"
+
+    print(
+        f"{name:>8}: {parts} parts after inserting in {inserted:.2f}s, "
+        f"OPTIMIZE FINAL took {optimized:.2f}s{merged}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--blocks", type=int, default=20_000)
+    parser.add_argument("--flush-blocks", type=int, default=500)
+    parser.add_argument("--accounts", type=int, default=50)
+    args = parser.parse_args()
+
+    client = get_clickhouse_client()
+    client.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    client.execute(f"""
+        CREATE TABLE {TABLE} (
+            block_number UInt64,
+            timestamp DateTime,
+            coldkey String,
+            hotkey String,
+            stake UInt64
+        ) ENGINE = ReplacingMergeTree()
+        PARTITION BY toYYYYMM(timestamp)
+        ORDER BY (coldkey, hotkey, timestamp)
+    """)
+    catalogue.refresh(TABLE)
+
+    print(f"Generating {args.blocks:,} blocks of {args.accounts} rows")
+    flushes = make_flushes(args.blocks, args.flush_blocks, args.accounts)
+    try:
+        measure("arrival", insert_in_arrival_order, flushes)
+        measure("arranged", insert_arranged, flushes)
+    finally:
+        client.execute(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Compares the old SQL text insert path with native columnar inserts on a large flush of
+`shovel_subnets`-shaped rows. Rows go to a scratch table that is dropped afterwards.
+
+    cd scraper_service
+    python -m benchmarks.subnets_flush --rows 1000000
+
+Uses the same CLICKHOUSE_* environment variables as the shovels.
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from shared.clickhouse.batch_insert import batch_insert_into_clickhouse_table
+from shared.clickhouse.utils import get_clickhouse_client
+
+TABLE = "shovel_subnets_benchmark"
+
+COLUMNS = [
+    ("block_number", "UInt64"),
+    ("timestamp", "DateTime"),
+    ("subnet_id", "UInt16"),
+    ("neuron_id", "UInt16"),
+    ("hotkey", "String"),
+    ("coldkey", "String"),
+    ("active", "Bool"),
+    ("axon_block", "UInt64"),
+    ("axon_version", "UInt32"),
+    ("axon_ip", "String"),
+    ("axon_port", "UInt16"),
+    ("axon_ip_type", "UInt8"),
+    ("axon_protocol", "UInt8"),
+    ("axon_placeholder1", "UInt8"),
+    ("axon_placeholder2", "UInt8"),
+    ("rank", "UInt16"),
+    ("emission", "UInt64"),
+    ("incentive", "UInt16"),
+    ("consensus", "UInt16"),
+    ("trust", "UInt16"),
+    ("validator_trust", "UInt16"),
+    ("dividends", "UInt16"),
+    ("stake", "UInt64"),
+    ("weights", "Array(Tuple(UInt16, UInt16))"),
+    ("bonds", "Array(Tuple(UInt16, UInt16))"),
+    ("last_update", "UInt64"),
+    ("validator_permit", "Bool"),
+    ("pruning_scores", "UInt16"),
+]
+
+
+def make_rows(count):
+    rows = []
+    timestamp = int(time.time())
+    for i in range(count):
+        block_number = 4_000_000 + i // 4096
+        weights = [(uid, random.randrange(65536)) for uid in range(16)]
+        rows.append([
+            block_number, timestamp + i // 4096 * 12, i // 256 % 64, i % 256,
+            f"5{random.getrandbits(256):064x}"[:48], f"5{random.getrandbits(256):064x}"[:48], True,
+            block_number, 1, str(random.getrandbits(32)), 8091, 4, 0, 0, 0,
+            random.randrange(65536), random.getrandbits(40), random.randrange(65536),
+            random.randrange(65536), random.randrange(65536), random.randrange(65536),
+            random.randrange(65536), random.getrandbits(50),
+            weights, weights, block_number, False, random.randrange(65536),
+        ])
+    return rows
+
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return f"'{value}'"
+    if isinstance(value, list):
+        return f"[{','.join(sql_literal(x) for x in value)}]"
+    if isinstance(value, tuple):
+        return f"({','.join(sql_literal(x) for x in value)})"
+    return str(value)
+
+
+def legacy_insert(table, rows):
+    """
+    The SQL text path that shovels used before native inserts: pre-quoted values joined
+    into one INSERT statement.
+    """
+    quoted_rows = [[sql_literal(value) for value in row] for row in rows]
+    formatted_rows = ", ".join(
+        f"({','.join(str(value) for value in row)})" for row in quoted_rows
+    )
+    get_clickhouse_client().execute(
+        f"INSERT INTO {table} SETTINGS async_insert=1, wait_for_async_insert=1 VALUES {formatted_rows}"
+    )
+
+
+def measure(name, insert, rows):
+    get_clickhouse_client().execute(f"TRUNCATE TABLE {TABLE}")
+    tracemalloc.start()
+    started = time.perf_counter()
+    insert(TABLE, rows)
+    elapsed = time.perf_counter() - started
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:>8}: {elapsed:.2f}s, {len(rows) / elapsed:,.0f} rows/s, "
+        f"peak Python allocations {peak / 2**20:,.0f} MiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    client = get_clickhouse_client()
+    columns = ", ".join(f"{name} {column_type}" for (name, column_type) in COLUMNS)
+    client.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    client.execute(f"""
+        CREATE TABLE {TABLE} ({columns})
+        ENGINE = ReplacingMergeTree()
+        PARTITION BY toYYYYMM(timestamp)
+        ORDER BY (subnet_id, neuron_id, timestamp)
+    """)
+
+    print(f"Generating {args.rows:,} rows")
+    rows = make_rows(args.rows)
+    try:
+        measure("sql", legacy_insert, rows)
+        measure("native", batch_insert_into_clickhouse_table, rows)
+    finally:
+        client.execute(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+if __name__ == "__main__":
+    main()
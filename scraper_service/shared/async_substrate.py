@@ -0,0 +1,207 @@
+from async_substrate_interface import AsyncSubstrateInterface
+from async_substrate_interface.utils.storage import StorageKey
+from collections import OrderedDict
+from shared.endpoints import get_endpoint_pool
+from websockets.exceptions import WebSocketException
+import asyncio
+import os
+import threading
+import time
+
+# Requests a client keeps in flight at once over its websocket
+ASYNC_SUBSTRATE_CONCURRENCY = int(os.getenv("ASYNC_SUBSTRATE_CONCURRENCY", "32"))
+# Storage keys per `state_queryStorageAt` request, several of which are sent concurrently
+ASYNC_QUERY_BATCH_SIZE = int(os.getenv("SUBSTRATE_QUERY_BATCH_SIZE", "500"))
+REQUEST_TIMEOUT = float(os.getenv("SUBSTRATE_REQUEST_TIMEOUT", "60"))
+# Storage keys a client keeps built, across runtime versions
+STORAGE_KEY_CACHE_SIZE = int(os.getenv("SUBSTRATE_STORAGE_KEY_CACHE_SIZE", "100000"))
+
+# Errors that mean the node, not the request, is at fault
+ENDPOINT_ERRORS = (OSError, asyncio.TimeoutError, WebSocketException)
+
+thread_local = threading.local()
+
+
+def _value(result):
+    return getattr(result, "value", result)
+
+
+class AsyncSubstrateClient:
+    """
+    Asyncio Substrate client. Requests from any number of coroutines are multiplexed over one
+    websocket per archive node, with at most `concurrency` in flight. Results are returned
+    decoded.
+
+    Requests are routed like `RoutedSubstrateInterface`'s: to the fastest healthy node of the
+    endpoint pool, failing over to the next on connection errors or after
+    SUBSTRATE_REQUEST_TIMEOUT, and hedged on the next node when slow.
+    """
+
+    def __init__(self, pool, concurrency):
+        self.pool = pool
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # {url: AsyncSubstrateInterface}, each initialized when first used
+        self.substrates = {}
+        # LRU of built storage keys by (runtime_version, pallet, storage, params)
+        self.storage_keys = OrderedDict()
+
+    async def _client(self, endpoint):
+        if endpoint.url not in self.substrates:
+            self.substrates[endpoint.url] = AsyncSubstrateInterface(endpoint.url)
+        substrate = self.substrates[endpoint.url]
+        if not substrate.initialized:
+            # Concurrent callers wait on the interface's own lock until the first is done
+            await substrate.initialize()
+        return substrate
+
+    async def _attempt(self, endpoint, call):
+        async with self.semaphore:
+            return await asyncio.wait_for(call(await self._client(endpoint)), REQUEST_TIMEOUT)
+
+    async def _routed(self, timed_method, call, timed=True):
+        """
+        Runs call(substrate) against the best node for timed_method, hedging and failing over
+        to the others. With timed=False the node's latency isn't recorded, e.g. for calls
+        mostly answered from the interface's own caches.
+        """
+        candidates = self.pool.ranked(timed_method)
+        pending = {}
+        last_error = None
+        launch = True
+        try:
+            while True:
+                if launch and candidates:
+                    endpoint = candidates.pop(0)
+                    pending[asyncio.ensure_future(self._attempt(endpoint, call))] = (endpoint, time.monotonic())
+                    delay = self.pool.hedge_delay(endpoint, timed_method)
+                if not pending:
+                    raise last_error
+
+                (done, _) = await asyncio.wait(
+                    pending, timeout=delay if candidates else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                launch = not done
+                for task in done:
+                    (endpoint, started) = pending.pop(task)
+                    error = task.exception()
+                    if isinstance(error, ENDPOINT_ERRORS):
+                        self.pool.record_failure(endpoint, error)
+                        # Connect again next time, the connection may be gone
+                        substrate = self.substrates.pop(endpoint.url, None)
+                        if substrate is not None:
+                            asyncio.ensure_future(substrate.close())
+                        last_error = error
+                        launch = True
+                        continue
+
+                    if timed:
+                        self.pool.record_latency(endpoint, timed_method, time.monotonic() - started)
+                        for (other, other_started) in pending.values():
+                            self.pool.record_latency(other, timed_method, time.monotonic() - other_started)
+                    return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def query(self, pallet, storage, params=None, block_hash=None):
+        return _value(await self._routed(
+            "state_getStorage",
+            lambda substrate: substrate.query(pallet, storage, params or [], block_hash=block_hash),
+        ))
+
+    async def runtime_call(self, api, method, params=None, block_hash=None):
+        return _value(await self._routed(
+            f"state_call {api}_{method}",
+            lambda substrate: substrate.runtime_call(api, method, params or [], block_hash=block_hash),
+        ))
+
+    async def rpc_request(self, method, params):
+        return await self._routed(method, lambda substrate: substrate.rpc_request(method, params))
+
+    async def _runtime_at(self, block_hash):
+        """
+        Returns the runtime at block_hash, loaded by the interfaces themselves and cached by
+        them per runtime version.
+        """
+
+        async def load(substrate):
+            await substrate.init_runtime(block_hash=block_hash)
+            return substrate.runtime
+
+        return await self._routed("state_getRuntimeVersion", load, timed=False)
+
+    def _storage_key(self, runtime, pallet, storage, params):
+        """
+        Builds a storage key locally with the metadata of runtime.
+        """
+        key = (runtime.runtime_version, pallet, storage, tuple(params))
+        if key in self.storage_keys:
+            self.storage_keys.move_to_end(key)
+            return self.storage_keys[key]
+        storage_key = StorageKey.create_from_storage_function(
+            pallet, storage, list(params), runtime_config=runtime.runtime_config, metadata=runtime.metadata
+        )
+        self.storage_keys[key] = storage_key
+        while len(self.storage_keys) > STORAGE_KEY_CACHE_SIZE:
+            self.storage_keys.popitem(last=False)
+        return storage_key
+
+    async def _query_keys(self, keys, block_hash):
+        return await self._routed(
+            "state_queryStorageAt",
+            lambda substrate: substrate.query_multi(keys, block_hash=block_hash),
+        )
+
+    async def query_storage_batch(self, items, block_hash):
+        """
+        Like `shared.substrate.query_storage_batch`: reads (pallet, storage, params) items and
+        returns their decoded values in order, with the batches sent concurrently. Keys are built
+        and values decoded with the metadata of the runtime at block_hash.
+        """
+        runtime = await self._runtime_at(block_hash)
+        keys = [self._storage_key(runtime, pallet, storage, params) for (pallet, storage, params) in items]
+        batches = await asyncio.gather(*(
+            self._query_keys(keys[i:i + ASYNC_QUERY_BATCH_SIZE], block_hash)
+            for i in range(0, len(keys), ASYNC_QUERY_BATCH_SIZE)
+        ))
+        values = {}
+        for batch in batches:
+            for (storage_key, value) in batch:
+                values[storage_key.to_hex()] = _value(value)
+        return [values.get(key.to_hex()) for key in keys]
+
+
+def get_event_loop():
+    """
+    Returns this thread's event loop, kept for the life of the thread so the websocket of its
+    client stays open between blocks.
+    """
+    if not hasattr(thread_local, "loop"):
+        thread_local.loop = asyncio.new_event_loop()
+    return thread_local.loop
+
+
+def get_async_substrate_client():
+    """
+    Returns this thread's async client. Use it from coroutines run with `run_async`.
+    """
+    if not hasattr(thread_local, "client"):
+        thread_local.client = AsyncSubstrateClient(get_endpoint_pool(), ASYNC_SUBSTRATE_CONCURRENCY)
+    return thread_local.client
+
+
+def run_async(coroutine):
+    """
+    Runs coroutine to completion on this thread's event loop.
+    """
+    return get_event_loop().run_until_complete(coroutine)
+
+
+def reset_async_substrate():
+    """
+    Forgets this thread's loop and client without closing them, e.g. in a forked child sharing
+    its parent's websocket.
+    """
+    for name in ("client", "loop"):
+        if hasattr(thread_local, name):
+            delattr(thread_local, name)
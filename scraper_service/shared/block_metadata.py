@@ -1,37 +1,112 @@
+from shared.clickhouse.schema import catalogue
 from shared.clickhouse.utils import get_clickhouse_client
-from shared.substrate import get_substrate_client
+from shared.header_index import header_index
+from shared.substrate import get_block_hashes, get_substrate_client
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+BLOCK_TIMESTAMPS_TABLE = "shovel_block_timestamps"
+# Hashes missing from Clickhouse are fetched from the chain this many blocks at a time
+BLOCK_HASH_PREFETCH = int(os.getenv("BLOCK_HASH_PREFETCH", "1000"))
+
+# Rows below a block already looked for in Clickhouse are only looked for again after this many
+# seconds, e.g. when the timestamp shovel is behind or hasn't reached them at all
+TIMESTAMP_WINDOW_TTL = 60
 
 timestamps = dict()
+# Hashes the timestamp shovel stored, loaded with the timestamps
+block_hashes = dict()
+# (first block, end block, monotonic time) of the range last loaded from Clickhouse
+timestamp_window = None
+# Hashes fetched from the chain, kept apart so reloading the timestamps doesn't drop them
+prefetched_hashes = dict()
+# (first block, end block) of the range last prefetched from the chain
+prefetch_window = None
+# Blocks may be prefetched from several threads at once
+timestamps_lock = threading.Lock()
+# Last block whose hash was looked up, to tell sequential catch-up from sparse lookups
+last_hash_lookup = None
 
 
 def refresh_timestamp_dict(n):
     """
-    Caches n -> n+10k timestamps
+    Caches n -> n+10k timestamps, and block hashes where the timestamp shovel stored them
     """
+    global timestamp_window
     clickhouse = get_clickhouse_client()
     timestamps.clear()
+    block_hashes.clear()
+
+    # Tables created before hashes were stored don't have the column until the timestamp
+    # shovel adds it
+    columns = catalogue.columns(BLOCK_TIMESTAMPS_TABLE) or []
+    has_hashes = any(name == "block_hash" for (name, _) in columns)
 
     # Fetch 10k timestamps at a time
     query = f"""
-        SELECT timestamp, block_number
-        FROM shovel_block_timestamps
+        SELECT timestamp, block_number, {"block_hash" if has_hashes else "''"}
+        FROM {BLOCK_TIMESTAMPS_TABLE}
         WHERE block_number >= {n} AND block_number < {n + 10_000}
     """
     r = clickhouse.execute(query)
-    for (timestamp, block_number) in r:
+    for (timestamp, block_number, block_hash) in r:
         timestamps[block_number] = timestamp
+        if block_hash:
+            block_hashes[block_number] = block_hash
+    timestamp_window = (n, n + 10_000, time.monotonic())
+
+
+def _needs_refresh(n):
+    """
+    Whether Clickhouse should be asked again for block n, missing from the cache. Call with
+    timestamps_lock held.
+    """
+    if timestamp_window is None:
+        return True
+    (first, end, loaded_at) = timestamp_window
+    return not first <= n < end or time.monotonic() - loaded_at >= TIMESTAMP_WINDOW_TTL
+
+
+def prefetch_block_hashes(n):
+    """
+    Caches the hashes of the next BLOCK_HASH_PREFETCH blocks from n that Clickhouse didn't
+    have, in a single `chain_getBlockHash` request, replacing the previous prefetch. Call with
+    timestamps_lock held.
+    """
+    global prefetch_window
+    missing = [b for b in range(n, n + BLOCK_HASH_PREFETCH) if b not in block_hashes]
+    # Not retried before the next window even if it fails, lookups fall back to single requests
+    prefetch_window = (n, n + BLOCK_HASH_PREFETCH)
+    prefetched_hashes.clear()
+    try:
+        hashes = get_block_hashes(missing)
+    except Exception as e:
+        logging.warning(f"Failed to prefetch block hashes from {n}: {str(e)}")
+        return
+    for (block_number, block_hash) in zip(missing, hashes):
+        # Blocks the node doesn't have yet come back as null
+        if block_hash is not None:
+            prefetched_hashes[block_number] = block_hash
 
 
 def get_block_timestamp(n, block_hash):
     """
-    First tries to fetch from cache, then chain.
+    First tries the header index, then the cache, then chain.
     """
-    if n not in timestamps:
-        refresh_timestamp_dict(n)
+    header = header_index.get(n) if header_index is not None else None
+    if header is not None:
+        return header[1]
 
-    if n in timestamps:
-        substrate = get_substrate_client()
-        return int(timestamps[n].timestamp())
+    with timestamps_lock:
+        if n not in timestamps and _needs_refresh(n):
+            refresh_timestamp_dict(n)
+        timestamp = timestamps.get(n)
+
+    if timestamp is not None:
+        return int(timestamp.timestamp())
     else:
         print("WARN: Block n timestamp not found in Clickhouse, falling back to chain")
         substrate = get_substrate_client()
@@ -45,17 +120,92 @@ def get_block_timestamp(n, block_hash):
         )
 
 
+class BlockCache:
+    """
+    Small LRU of per-block data, so shovels hosted in the same process (see
+    `shared.shovel_host`) fetch each block's hash, timestamp and events only once.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_or_fetch(self, key, fetch):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        value = fetch()
+
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+
+block_cache = BlockCache(int(os.getenv("BLOCK_CACHE_SIZE", "64")))
+
+
+def lookup_block_hash(n):
+    """
+    Tries the header index, then the hashes cached with the timestamps, then the chain.
+    During sequential catch-up the hashes of the blocks ahead are prefetched, once per window
+    of BLOCK_HASH_PREFETCH blocks, so there's no request per block.
+    """
+    global last_hash_lookup
+    header = header_index.get(n) if header_index is not None else None
+    if header is not None:
+        return header[0]
+
+    with timestamps_lock:
+        sequential = last_hash_lookup is not None and 0 < n - last_hash_lookup <= BLOCK_HASH_PREFETCH
+        last_hash_lookup = n
+        if n not in block_hashes and n not in prefetched_hashes and _needs_refresh(n):
+            refresh_timestamp_dict(n)
+        in_prefetch_window = prefetch_window is not None and prefetch_window[0] <= n < prefetch_window[1]
+        if n not in block_hashes and n not in prefetched_hashes and sequential and not in_prefetch_window:
+            prefetch_block_hashes(n)
+        block_hash = block_hashes.get(n) or prefetched_hashes.get(n)
+
+    if block_hash is not None:
+        return block_hash
+    return get_substrate_client().get_block_hash(n)
+
+
+def get_block_hash(n):
+    return block_cache.get_or_fetch(("hash", n), lambda: lookup_block_hash(n))
+
+
+def get_block_events(n, block_hash):
+    """
+    Gets System.Events for block n.
+    """
+    return block_cache.get_or_fetch(
+        ("events", n),
+        lambda: get_substrate_client().query(
+            "System",
+            "Events",
+            block_hash=block_hash,
+        ),
+    )
+
+
 def get_block_metadata(n):
     """
-    Gets block metadata (timestamp, blockhash) for the latest block.
+    Gets block metadata (timestamp, blockhash) for block n.
 
-    TODO: In the future it will be adjusted to first check an in-memory cache, then Clickhouse, then Substrate.
+    Checks the in-memory block cache first, then Clickhouse for the timestamp, then Substrate.
     """
 
-    substrate = get_substrate_client()
-    block_hash = substrate.get_block_hash(n)
+    def fetch():
+        block_hash = get_block_hash(n)
+
+        # If still not there, just get it from the chain
+        block_timestamp = get_block_timestamp(n, block_hash)
 
-    # If still not there, just get it from the chain
-    block_timestamp = get_block_timestamp(n, block_hash)
+        return (block_timestamp, block_hash)
 
-    return (block_timestamp, block_hash)
+    return block_cache.get_or_fetch(("metadata", n), fetch)
@@ -0,0 +1,56 @@
+"""
+Block schedules let periodic shovels declare which blocks they care about, so that
+`ShovelBaseClass` only ever visits (and checkpoints) those blocks instead of walking every block
+and returning early.
+
+A schedule is any callable taking an inclusive (start, end) block range and returning the
+scheduled block numbers in that range in ascending order, so a generator function works too:
+
+    def my_schedule(start, end):
+        for n in range(start, end + 1):
+            if is_interesting(n):
+                yield n
+
+    class MyShovel(ShovelBaseClass):
+        block_schedule = staticmethod(my_schedule)
+"""
+import heapq
+
+
+def every_n_blocks(n, offset=0):
+    """
+    Schedules blocks where `block_number % n == offset`.
+    """
+    n = int(n)
+
+    def schedule(start, end):
+        first = start + (offset - start) % n
+        return range(first, end + 1, n)
+
+    return schedule
+
+
+def every_n_blocks_until(threshold, n_before, n_after):
+    """
+    Schedules every `n_before` blocks up to and including `threshold`, then every `n_after`
+    blocks.
+    """
+    before = every_n_blocks(n_before)
+    after = every_n_blocks(n_after)
+
+    def schedule(start, end):
+        yield from before(start, min(end, threshold))
+        yield from after(max(start, threshold + 1), end)
+
+    return schedule
+
+
+def merge_schedules(ranges):
+    """
+    Merges already-sorted block number iterables, dropping duplicates.
+    """
+    last = None
+    for block_number in heapq.merge(*ranges):
+        if block_number != last:
+            yield block_number
+            last = block_number
@@ -1,6 +1,15 @@
+import os
 import threading
-from time import sleep
+import time
+from contextlib import contextmanager
+from clickhouse_driver.errors import NetworkError, SocketTimeoutError
+from shared.clickhouse.dead_letters import DEAD_LETTERS_TABLE, write_dead_letters
+from shared.clickhouse.dedup import DEDUP_WINDOW_BLOCKS, dedup_token, enable_deduplication, split_by_window
+from shared.clickhouse.partitions import arrange_rows
+from shared.clickhouse.schema import catalogue, row_error
+from shared.clickhouse.sinks import NullSink, ParquetSink
 from shared.clickhouse.utils import get_clickhouse_client
+from shared.clickhouse.wal import WriteAheadLog, read_unflushed
 import logging
 
 # Global debug flag
@@ -15,85 +24,657 @@ def debug_log(message: str):
     if _DEBUG_MODE:
         logging.info(f"[ClickHouse DEBUG] {message}")
 
+# A flush starts as soon as any table has `flush_max_rows` rows, `flush_max_bytes` are
+# buffered or the oldest buffered row is `flush_max_age` seconds old, as set by the current
+# insert profile. Producers block while more than BUFFER_MEMORY_BUDGET bytes are buffered or
+# being flushed.
+FLUSH_MAX_ROWS = int(os.getenv("BUFFER_FLUSH_ROWS", "100000"))
+FLUSH_MAX_BYTES = int(os.getenv("BUFFER_FLUSH_BYTES", str(64 * 2**20)))
+FLUSH_MAX_AGE = float(os.getenv("BUFFER_FLUSH_MAX_AGE", "1"))
+BUFFER_MEMORY_BUDGET = int(os.getenv("BUFFER_MEMORY_BUDGET", str(512 * 2**20)))
+# Rejections no row can be blamed for are retried this many times per chunk before the chunk
+# is split up to find the rows Clickhouse won't take
+INSERT_MAX_ATTEMPTS = int(os.getenv("INSERT_MAX_ATTEMPTS", "10"))
+
+
+class InsertProfile:
+    """
+    How buffered rows are flushed and inserted: the settings sent with each INSERT and the
+    flush triggers. With `align_to_windows`, flushes triggered by size or age wait for the next
+    deduplication window boundary, so the same blocks are always inserted in the same chunks.
+    """
+
+    def __init__(self, name, settings, flush_max_rows, flush_max_bytes, flush_max_age, align_to_windows=False):
+        self.name = name
+        self.settings = settings
+        self.flush_max_rows = flush_max_rows
+        self.flush_max_bytes = flush_max_bytes
+        self.flush_max_age = flush_max_age
+        self.align_to_windows = align_to_windows
+
+
+# Catching up: few large synchronous inserts, each written straight to its own part. Rows
+# are only deduplicated by merges, not while inserting.
+BACKFILL_INSERT_PROFILE = InsertProfile(
+    "backfill",
+    settings={"async_insert": 0, "optimize_on_insert": 0},
+    flush_max_rows=int(os.getenv("BACKFILL_FLUSH_ROWS", "500000")),
+    flush_max_bytes=int(os.getenv("BACKFILL_FLUSH_BYTES", str(128 * 2**20))),
+    flush_max_age=float(os.getenv("BACKFILL_FLUSH_MAX_AGE", "30")),
+    align_to_windows=True,
+)
+# At the chain head: a small synchronous insert per finalized block, acknowledged as soon as
+# its part is written rather than after an async insert buffer flush
+TAIL_INSERT_PROFILE = InsertProfile(
+    "tail",
+    settings={"async_insert": 0},
+    flush_max_rows=FLUSH_MAX_ROWS,
+    flush_max_bytes=FLUSH_MAX_BYTES,
+    flush_max_age=FLUSH_MAX_AGE,
+)
+
 buffer = {}
+# [block_number, row count] runs for each buffered table, in the same order as its rows
+buffer_spans = {}
+# Tasks from failed flushes, retried unchanged so they keep their deduplication tokens
+retry_tasks = []
 buffer_lock = threading.Lock()
+# Notified when a flush is due and whenever a flush frees memory
+buffer_condition = threading.Condition(buffer_lock)
+# Held for a whole flush cycle, so `drain_buffer` returns only once rows taken by an
+# in-progress flush have been inserted too
+flush_cycle_lock = threading.Lock()
+
+# Estimated size of one row of each buffered table, taken from its first row
+row_sizes = {}
+buffered_bytes = 0
+# Rows taken by a flush are still in memory until their insert completes
+flushing_bytes = 0
+oldest_row_at = None
+last_flush_at = time.monotonic()
+flush_requested = False
+# A size or age limit was reached while aligning flushes to deduplication windows
+window_flush_due = False
+# Incremented every time the buffer is taken by a flush
+flush_cycles = 0
+insert_profile = TAIL_INSERT_PROFILE
+# Process running the flush thread. Elsewhere (e.g. backfill workers) producers over the
+# memory budget drain the buffer themselves instead of waiting.
+flush_thread_pid = None
+# Optional write-ahead log every buffered row is appended to before buffer_insert returns,
+# see `open_wal`
+wal = None
+# Block whose rows are being buffered, set by the shovel before processing it
+current_block = None
+shovel_name = "shovel"
+# Unexplained rejections so far of each chunk being retried, by (table, deduplication token)
+rejected_attempts = {}
+rejected_attempts_lock = threading.Lock()
+
+
+class InflightBytes:
+    """
+    Caps the estimated size of the inserts being sent to Clickhouse at once, across all flush
+    threads. A batch larger than the cap on its own is still let through when nothing else is
+    in flight.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.inflight = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def hold(self, size):
+        with self.condition:
+            while self.inflight > 0 and self.inflight + size > self.max_bytes:
+                self.condition.wait()
+            self.inflight += size
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.inflight -= size
+                self.condition.notify_all()
+
+
+inflight_bytes = InflightBytes(int(os.getenv("CLICKHOUSE_MAX_INFLIGHT_BYTES", str(256 * 2**20))))
+
+
+def _value_size(value):
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return 8 + sum(_value_size(v) for v in value)
+    if isinstance(value, dict):
+        return 8 + sum(_value_size(k) + _value_size(v) for (k, v) in value.items())
+    return 8
+
+
+def estimate_size(rows, sample=100):
+    """
+    Approximates the encoded size of rows in bytes, extrapolated from an even sample of them.
+    """
+    if not rows:
+        return 0
+    sampled = rows[::max(1, len(rows) // sample)]
+    sampled_size = sum(_value_size(value) for row in sampled for value in row)
+    return sampled_size * len(rows) // len(sampled)
+
+
+def set_shovel_name(name):
+    global shovel_name
+    shovel_name = name
+
+
+def set_insert_profile(profile):
+    global insert_profile
+    with buffer_condition:
+        if profile is insert_profile:
+            return
+        logging.info(f"Switching from {insert_profile.name} to {profile.name} inserts")
+        insert_profile = profile
+        # The flush thread may be waiting on the previous profile's age limit
+        buffer_condition.notify_all()
+
+
+def set_current_block(block_number):
+    """
+    Call before buffering any row of block_number. When the block starts a new deduplication
+    window and the current profile aligns flushes to windows, a pending flush is started
+    first, and this waits until it has taken the buffer.
+    """
+    global current_block, flush_requested
+    with buffer_condition:
+        crossed = current_block is not None and block_number // DEDUP_WINDOW_BLOCKS != current_block // DEDUP_WINDOW_BLOCKS
+        current_block = block_number
+        if not (crossed and insert_profile.align_to_windows and flush_thread_pid == os.getpid()):
+            return
+        aged = oldest_row_at is not None and time.monotonic() - oldest_row_at >= insert_profile.flush_max_age
+        if not (window_flush_due or aged):
+            return
+        cycle = flush_cycles
+        flush_requested = True
+        buffer_condition.notify_all()
+        while flush_cycles == cycle:
+            buffer_condition.wait()
+
+
+class ClickHouseSink:
+    def write(self, shovel_name, table, rows, spans):
+        """
+        Inserts one table's rows, split by block window and then by partition, each chunk
+        sorted by the table's ORDER BY key and sent once it fits under the global in-flight
+        byte cap. Every chunk carries a deduplication token, so inserting the same rows for the
+        same blocks again (a retried flush or a replayed block) is dropped by Clickhouse.
+        """
+        enable_deduplication(table)
+        for (first_block, last_block, window_rows) in split_by_window(rows, spans):
+            for chunk in arrange_rows(table, window_rows):
+                token = dedup_token(shovel_name, table, first_block, last_block, chunk)
+                with inflight_bytes.hold(estimate_size(chunk)):
+                    batch_insert_into_clickhouse_table(table, chunk, token)
+
+
+# Where flushed rows go. Tables and checkpoints are always in Clickhouse.
+SINKS = {
+    "clickhouse": ClickHouseSink,
+    "parquet": ParquetSink,
+    "null": NullSink,
+}
+sink = SINKS[os.getenv("SHOVEL_SINK", "clickhouse")]()
 
 
-def batch_insert_into_clickhouse_table(table, rows):
+def insert_table(table, rows, spans=()):
+    """
+    Writes one table's rows, as [block_number, row count] spans, to the configured sink.
+    """
+    sink.write(shovel_name, table, rows, spans)
+
+
+def batch_insert_into_clickhouse_table(table, rows, token=None):
+    """
+    Inserts rows of plain Python values using the native protocol, sent column by column.
+
+    If Clickhouse or the driver rejects the batch, every row is checked against the table's
+    schema. Rows that don't fit go to the dead letters table with the reason, and the rest are
+    inserted. Connection errors are raised so the whole batch is retried. So are rejections no
+    row can be blamed for, until the same batch has been rejected `INSERT_MAX_ATTEMPTS` times;
+    after that it is split in halves to find the rows being rejected.
+    """
+    key = (table, token)
+    with rejected_attempts_lock:
+        attempts = rejected_attempts.get(key, 0)
+    if attempts >= INSERT_MAX_ATTEMPTS:
+        # Retried after a connection error while being split up. Halves already inserted are
+        # dropped by their deduplication tokens.
+        _insert_halves(table, rows, token)
+        with rejected_attempts_lock:
+            rejected_attempts.pop(key, None)
+        return
     try:
         debug_log(f"Attempting to insert {len(rows)} rows into table {table}")
-        formatted_rows = ", ".join(
-            f"({','.join(str(value) for value in row)})" for row in rows
-        )
-        sql = f"INSERT INTO {table} SETTINGS async_insert=1, wait_for_async_insert=1 VALUES {formatted_rows}"
-        debug_log(f"Executing SQL: {sql}")
-        get_clickhouse_client().execute(sql)
+        _insert_rows(table, rows, token)
         debug_log(f"Successfully inserted {len(rows)} rows into table {table}")
+    except (NetworkError, SocketTimeoutError, EOFError, ConnectionError):
+        raise
     except Exception as e:
         debug_log(f"Error inserting into {table}: {str(e)}")
         debug_log(f"Error type: {type(e).__name__}")
-        if len(rows) > 1:
-            mid = len(rows) // 2
-            debug_log(f"Retrying with smaller batches... Splitting {len(rows)} rows into {mid} and {len(rows)-mid}")
-            batch_insert_into_clickhouse_table(table, rows[:mid])
-            batch_insert_into_clickhouse_table(table, rows[mid:])
+        columns = catalogue.refresh(table) or []
+        valid_rows = []
+        rejected = []
+        for row in rows:
+            error = row_error(columns, row)
+            if error is None:
+                valid_rows.append(row)
+            else:
+                rejected.append((row, error))
+
+        if not rejected:
+            with rejected_attempts_lock:
+                attempts = rejected_attempts[key] = rejected_attempts.get(key, 0) + 1
+            if attempts < INSERT_MAX_ATTEMPTS:
+                raise
+            logging.error(
+                f"Clickhouse rejected {len(rows)} rows for {table} {attempts} times without any "
+                f"row failing the schema check, splitting them up: {type(e).__name__}: {e}"
+            )
+            _insert_halves(table, rows, token)
         else:
-            debug_log(f"Error inserting single row into {table}: {e}")
-            formatted_rows = ", ".join(
-                f"({','.join(str(value) for value in row)})" for row in rows
+            logging.error(
+                f"Moving {len(rejected)} of {len(rows)} rows for {table} to {DEAD_LETTERS_TABLE}, "
+                f"e.g. {rejected[0][1]}"
             )
-            sql = f"INSERT INTO {table} SETTINGS async_insert=1, wait_for_async_insert=1 VALUES {formatted_rows}"
-            debug_log(f"Failed SQL: {sql}")
-            raise e
+            write_dead_letters(table, [(row, f"{error} ({type(e).__name__}: {e})") for (row, error) in rejected])
+            if valid_rows:
+                _insert_rows(table, valid_rows, token and f"{token}:valid")
+    with rejected_attempts_lock:
+        rejected_attempts.pop(key, None)
+
+
+def _insert_halves(table, rows, token):
+    """
+    Inserts each half of rows on its own, going on into the rejected half, to narrow a
+    rejection down to one row in about log2(len(rows)) inserts. When both halves are rejected
+    the problem isn't a single row, so all of their rows go to the dead letters table.
+    """
+    middle = (len(rows) + 1) // 2
+    rejected = []
+    for (i, half) in enumerate([rows[:middle], rows[middle:]]):
+        if not half:
+            continue
+        half_token = token and f"{token}:{i}"
+        try:
+            _insert_rows(table, half, half_token)
+        except (NetworkError, SocketTimeoutError, EOFError, ConnectionError):
+            raise
+        except Exception as e:
+            rejected.append((half, half_token, e))
+
+    if len(rejected) == 1 and len(rejected[0][0]) > 1:
+        (half, half_token, _) = rejected[0]
+        _insert_halves(table, half, half_token)
+    elif rejected:
+        dead = [(row, f"Rejected after {INSERT_MAX_ATTEMPTS} attempts ({type(e).__name__}: {e})")
+                for (half, _, e) in rejected for row in half]
+        logging.error(f"Moving {len(dead)} of {len(rows)} rows for {table} to {DEAD_LETTERS_TABLE}, e.g. {dead[0][1]}")
+        write_dead_letters(table, dead)
+
+
+def _insert_rows(table, rows, token=None):
+    # Lists rather than tuples, as the driver converts some column values in place
+    columns = [list(column) for column in zip(*rows)]
+    settings = insert_profile.settings
+    if token is not None:
+        settings = {**settings, "insert_deduplication_token": token}
+    get_clickhouse_client().execute(
+        f"INSERT INTO {table} VALUES",
+        columns,
+        columnar=True,
+        settings=settings,
+    )
 
 
 def buffer_insert(table_name, row):
     """
     Queues a row for insertion. This should be the only way data is inserted into Clickhouse.
+
+    Rows hold plain Python values in table column order (str, int, float, bool, None, lists,
+    tuples, dicts), not SQL literals. DateTime columns take a unix timestamp as an int.
+
+    Blocks while the buffer is over its memory budget. Prefer `buffer_insert_many` or
+    `buffer_insert_tables` when a block produces more than a handful of rows.
+    """
+    buffer_insert_tables({table_name: [row]})
+
+
+def buffer_insert_many(table_name, rows):
+    """
+    Queues all the rows a block produced for one table, taking the buffer lock once.
+    """
+    buffer_insert_tables({table_name: rows})
+
+
+def buffer_insert_tables(rows_by_table):
+    """
+    Queues the rows a block produced for several tables, as {table_name: rows}, taking the
+    buffer lock once.
+    """
+    global buffered_bytes, oldest_row_at, flush_requested, window_flush_due
+    drain = False
+    with buffer_condition:
+        while buffered_bytes + flushing_bytes >= BUFFER_MEMORY_BUDGET:
+            if flush_thread_pid != os.getpid():
+                drain = True
+                break
+            debug_log("Buffer over its memory budget, waiting for a flush...")
+            flush_requested = True
+            buffer_condition.notify_all()
+            buffer_condition.wait()
+
+        if wal is not None:
+            wal.append(("rows", current_block, {
+                table_name: new_rows for (table_name, new_rows) in rows_by_table.items() if new_rows
+            }))
+
+        due = False
+        for (table_name, new_rows) in rows_by_table.items():
+            if not new_rows:
+                continue
+            rows = buffer.get(table_name)
+            if rows is None:
+                rows = buffer[table_name] = []
+                row_sizes[table_name] = _value_size(new_rows[0])
+                debug_log(f"Created new buffer for table {table_name}")
+            if oldest_row_at is None:
+                oldest_row_at = time.monotonic()
+
+            rows.extend(new_rows)
+            spans = buffer_spans.setdefault(table_name, [])
+            if spans and spans[-1][0] == current_block:
+                spans[-1][1] += len(new_rows)
+            else:
+                spans.append([current_block, len(new_rows)])
+            buffered_bytes += len(new_rows) * row_sizes[table_name]
+            debug_log(f"Added {len(new_rows)} rows to buffer for table {table_name}. Buffer size: {len(rows)}")
+
+            due = due or len(rows) >= insert_profile.flush_max_rows
+
+        if not flush_requested and (due or buffered_bytes >= insert_profile.flush_max_bytes):
+            if insert_profile.align_to_windows and flush_thread_pid == os.getpid():
+                # Started by `set_current_block` once the current window is complete
+                window_flush_due = True
+            else:
+                flush_requested = True
+                buffer_condition.notify_all()
+
+    if drain:
+        drain_buffer()
+
+
+def open_wal(directory):
     """
-    global buffer
-    debug_log(f"Buffer insert called for table {table_name}")
+    Logs buffered rows to segment files in `directory` until they are flushed, so a restarted
+    shovel can insert them with `replay_wal` instead of scraping their blocks again.
+    """
+    global wal
+    wal = WriteAheadLog(directory, fsync=os.getenv("BUFFER_WAL_FSYNC", "") == "1")
+    logging.info(f"Logging buffered rows to {directory}")
+
+
+def disable_wal():
+    global wal
+    wal = None
+
+
+def log_checkpoint(block_number):
+    """
+    Records in the write-ahead log that every row up to and including block_number has been
+    buffered.
+    """
+    if wal is not None:
+        with buffer_lock:
+            wal.append(("checkpoint", block_number))
+
+
+def replay_wal(save_checkpoint):
+    """
+    Inserts the rows a previous run logged but never flushed, up to the last block it finished
+    processing, then calls save_checkpoint(block_number) and deletes the replayed segments.
+    Call before the flush thread starts.
+    """
+    if wal is None:
+        return
+    (rows_by_table, checkpoint) = read_unflushed(wal)
+    for (table_name, (rows, spans)) in rows_by_table.items():
+        logging.info(f"Replaying {len(rows)} rows for {table_name} from the write-ahead log")
+        insert_table(table_name, rows, spans)
+    if checkpoint is not None:
+        save_checkpoint(checkpoint)
+    wal.delete_through(wal.sequence - 1)
+
+
+def request_flush():
+    """
+    Starts a flush now rather than when a size or age limit is reached, e.g. once a newly
+    finalized block has been processed.
+    """
+    global flush_requested
+    with buffer_condition:
+        flush_requested = True
+        buffer_condition.notify_all()
+
+
+def requeue(tasks):
+    """
+    Puts tasks from a failed flush back, as [(table_name, rows, spans, size)], so they are
+    retried by the next flush. They are kept apart from rows buffered since, so each retried
+    chunk has the same deduplication token as the attempt that may have reached Clickhouse.
+    """
+    global buffered_bytes, oldest_row_at
     with buffer_lock:
-        if table_name not in buffer:
-            buffer[table_name] = []
-            debug_log(f"Created new buffer for table {table_name}")
+        retry_tasks.extend(tasks)
+        buffered_bytes += sum(size for (_, _, _, size) in tasks)
+        if tasks and oldest_row_at is None:
+            oldest_row_at = time.monotonic()
 
-        buffer[table_name].append(row)
-        debug_log(f"Added row to buffer for table {table_name}. Buffer size: {len(buffer[table_name])}")
 
-    # Throttle if buffer is getting too large
-    while table_name in buffer and len(buffer[table_name]) > 1_000_000:
-        debug_log(f"Buffer for table {table_name} too large ({len(buffer[table_name])} rows), throttling...")
-        sleep(1)
+def buffered_row_count():
+    with buffer_lock:
+        return sum(len(rows) for rows in buffer.values()) + sum(len(task[1]) for task in retry_tasks)
+
+
+def reset_buffer():
+    """
+    Discards all buffered rows without inserting them.
+    """
+    global buffered_bytes, flushing_bytes, oldest_row_at, flush_requested
+    with buffer_lock:
+        buffer.clear()
+        buffer_spans.clear()
+        retry_tasks.clear()
+        row_sizes.clear()
+        buffered_bytes = 0
+        flushing_bytes = 0
+        oldest_row_at = None
+        flush_requested = False
+
+
+def discard_blocks(first_block, last_block):
+    """
+    Discards the buffered rows of blocks first_block..last_block without inserting them,
+    including any waiting to be retried, e.g. once another process has taken over the range.
+    Rows a flush has already taken are not affected.
+    """
+    global buffered_bytes
+    with buffer_lock:
+        for table_name in list(buffer):
+            (rows, spans) = _drop_blocks(buffer[table_name], buffer_spans.get(table_name, []), first_block, last_block)
+            buffered_bytes -= (len(buffer[table_name]) - len(rows)) * row_sizes[table_name]
+            buffer[table_name][:] = rows
+            buffer_spans[table_name] = spans
+        for (i, (table_name, rows, spans, size)) in enumerate(retry_tasks):
+            (kept, kept_spans) = _drop_blocks(rows, spans, first_block, last_block)
+            kept_size = size * len(kept) // len(rows) if rows else 0
+            buffered_bytes -= size - kept_size
+            retry_tasks[i] = (table_name, kept, kept_spans, kept_size)
+        retry_tasks[:] = [task for task in retry_tasks if task[1]]
+        if wal is not None:
+            wal.append(("discard", first_block, last_block))
+
+
+def _drop_blocks(rows, spans, first_block, last_block):
+    kept_rows = []
+    kept_spans = []
+    offset = 0
+    for (block_number, count) in spans:
+        if block_number is None or not first_block <= block_number <= last_block:
+            kept_rows.extend(rows[offset:offset + count])
+            kept_spans.append([block_number, count])
+        offset += count
+    return (kept_rows, kept_spans)
+
+
+def _take_buffer():
+    """
+    Empties the buffer and returns its contents as [(table_name, rows, spans, size)], failed
+    tasks being retried first, along with the write-ahead log segment sealed to match, if
+    any. Call with buffer_lock held.
+    """
+    global buffered_bytes, flushing_bytes, oldest_row_at, last_flush_at, flush_requested
+    global window_flush_due, flush_cycles
+    tasks = retry_tasks + [
+        (table_name, rows, buffer_spans.pop(table_name, []), len(rows) * row_sizes[table_name])
+        for table_name, rows in buffer.items()
+    ]
+    retry_tasks.clear()
+    buffer.clear()
+    row_sizes.clear()
+    flushing_bytes += buffered_bytes
+    buffered_bytes = 0
+    oldest_row_at = None
+    last_flush_at = time.monotonic()
+    flush_requested = False
+    window_flush_due = False
+    flush_cycles += 1
+    buffer_condition.notify_all()
+    sealed_segment = wal.rotate() if wal is not None else None
+    return (tasks, sealed_segment)
+
+
+def _delete_flushed_segments(sealed_segment):
+    """
+    Rows requeued by a failed flush are only in older segments, so once a later flush fully
+    succeeds everything up to its own sealed segment is in Clickhouse.
+    """
+    if wal is not None and sealed_segment is not None:
+        with buffer_lock:
+            wal.delete_through(sealed_segment)
+
+
+def _seconds_until_flush():
+    """
+    Call with buffer_lock held. With nothing buffered a cycle still runs every `flush_max_age`
+    seconds, so shovels that produce no rows keep persisting their checkpoint.
+    """
+    if flush_requested:
+        return 0
+    if insert_profile.align_to_windows and oldest_row_at is not None:
+        # Requested by `set_current_block` at the next window boundary
+        return insert_profile.flush_max_age
+    since = oldest_row_at if oldest_row_at is not None else last_flush_at
+    return since + insert_profile.flush_max_age - time.monotonic()
+
+
+def _insert_task(table_name, rows, spans, size):
+    global flushing_bytes
+    try:
+        insert_table(table_name, rows, spans)
+    finally:
+        with buffer_condition:
+            flushing_bytes -= size
+            buffer_condition.notify_all()
+
+
+def drain_buffer():
+    """
+    Synchronously inserts everything currently buffered. Used where no flush thread is
+    running, e.g. inside backfill worker processes. Unlike `flush_buffer`, errors are raised,
+    once the tables that failed have been requeued for the next flush or drain to retry.
+    """
+    with flush_cycle_lock:
+        with buffer_lock:
+            (tasks, sealed_segment) = _take_buffer()
+
+        failures = _insert_tasks(tasks)
+        if failures:
+            raise failures[0][1]
+        _delete_flushed_segments(sealed_segment)
+    debug_log(f"Drained {len(tasks)} tables")
+    return (len(tasks), sum(len(task[1]) for task in tasks))
+
+
+def _insert_tasks(tasks, executor=None):
+    """
+    Inserts tasks taken from the buffer, concurrently on `executor`'s threads if given, and
+    requeues the ones that failed. Returns [(task, exception)] for those.
+    """
+    if executor is not None:
+        futures = [executor.submit(_insert_task, *task) for task in tasks]
+        debug_log(f"Submitted {len(futures)} tasks to executor")
+    failures = []
+    for (i, task) in enumerate(tasks):
+        try:
+            if executor is None:
+                _insert_task(*task)
+            else:
+                futures[i].result()
+            debug_log("Task completed successfully")
+        except Exception as e:
+            logging.error(f"Failed to insert {len(task[1])} rows into {task[0]}, will retry: {str(e)}")
+            debug_log(f"Task error type: {type(e).__name__}")
+            failures.append((task, e))
+
+    if failures:
+        requeue([task for (task, _) in failures])
+    return failures
 
 
-# Continuously flush the buffer
 def flush_buffer(executor, started_cb, done_cb):
     """
-    Continuously flush the buffer.
+    Continuously flush the buffer, whenever a size or age limit is reached or a flush is
+    requested.
+
+    Tables are inserted concurrently by `executor`'s threads, on connections from the pool.
+
+    `done_cb(tables, rows, ok)` is called after every cycle. `ok` is only True if every table
+    insert in the cycle was acknowledged; failed rows are requeued and retried.
     """
-    global buffer
+    global flush_thread_pid
+    flush_thread_pid = os.getpid()
     debug_log("Starting buffer flush thread")
     while True:
-        started_cb()
-        with buffer_lock:
-            tasks = [(table_name, rows) for table_name, rows in buffer.items()]
-            buffer.clear()
-            debug_log(f"Cleared buffer. Tasks to process: {len(tasks)}")
-
-        futures = [
-            executor.submit(batch_insert_into_clickhouse_table,
-                            table_name, rows)
-            for table_name, rows in tasks
-        ]
-        debug_log(f"Submitted {len(futures)} tasks to executor")
-        for future in futures:
-            try:
-                future.result()
-                debug_log("Task completed successfully")
-            except Exception as e:
-                debug_log(f"Task failed: {str(e)}")
-                debug_log(f"Task error type: {type(e).__name__}")
-        done_cb(len(tasks), sum(len(rows) for _, rows in tasks))
+        with buffer_condition:
+            while (wait := _seconds_until_flush()) > 0:
+                buffer_condition.wait(wait)
+
+        with flush_cycle_lock:
+            started_cb()
+            with buffer_lock:
+                (tasks, sealed_segment) = _take_buffer()
+                debug_log(f"Cleared buffer. Tasks to process: {len(tasks)}")
+
+            failures = _insert_tasks(tasks, executor)
+            done_cb(
+                len(tasks),
+                sum(len(task[1]) for task in tasks),
+                len(failures) == 0,
+            )
+            if not failures:
+                _delete_flushed_segments(sealed_segment)
         debug_log("Buffer flush cycle completed")
-        sleep(1)
+
+        if failures:
+            # Back off before retrying, even if producers are asking for a flush
+            time.sleep(FLUSH_MAX_AGE)
@@ -0,0 +1,57 @@
+from shared.clickhouse.utils import get_clickhouse_client, table_exists
+
+CHECKPOINTS_TABLE = "shovel_checkpoints"
+
+
+def create_checkpoints_table():
+    if not table_exists(CHECKPOINTS_TABLE):
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINTS_TABLE} (
+            shovel_name String,
+            block_number UInt64
+        ) ENGINE = ReplacingMergeTree()
+        ORDER BY (shovel_name)
+        """
+        get_clickhouse_client().execute(query)
+
+
+def read_checkpoints(shovel_names):
+    """
+    Returns {shovel_name: block_number} for the shovels that have a checkpoint.
+
+    Checkpoints only ever move forward, so the max over every row written for a shovel is its
+    checkpoint whether or not ReplacingMergeTree has merged the old rows away yet. That avoids
+    a FINAL scan and reads only the primary key range of the requested shovels.
+    """
+    if not table_exists(CHECKPOINTS_TABLE):
+        return {}
+
+    names = ", ".join(f"'{name}'" for name in shovel_names)
+    query = f"""
+        SELECT shovel_name, max(block_number)
+        FROM {CHECKPOINTS_TABLE}
+        WHERE shovel_name IN ({names})
+        GROUP BY shovel_name
+    """
+    return dict(get_clickhouse_client().execute(query))
+
+
+def read_checkpoint(shovel_name):
+    """
+    Returns the persisted checkpoint for a shovel, or None if it has never written one.
+    """
+    return read_checkpoints([shovel_name]).get(shovel_name)
+
+
+def write_checkpoint(shovel_name, block_number):
+    """
+    Synchronously persists a checkpoint. Only call this once every row up to and including
+    block_number has been acknowledged by Clickhouse.
+    """
+    create_checkpoints_table()
+    get_clickhouse_client().execute(
+        f"INSERT INTO {CHECKPOINTS_TABLE} (shovel_name, block_number) VALUES",
+        [(shovel_name, block_number)],
+        # Writing the same checkpoint twice changes nothing
+        retry=True,
+    )
@@ -0,0 +1,30 @@
+import json
+from shared.clickhouse.utils import get_clickhouse_client, table_exists
+
+DEAD_LETTERS_TABLE = "shovel_dead_letters"
+
+
+def create_dead_letters_table():
+    if not table_exists(DEAD_LETTERS_TABLE):
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {DEAD_LETTERS_TABLE} (
+            table_name String,
+            row String,
+            error String,
+            rejected_at DateTime DEFAULT now()
+        ) ENGINE = MergeTree()
+        ORDER BY (table_name, rejected_at)
+        """
+        get_clickhouse_client().execute(query)
+
+
+def write_dead_letters(table_name, rejected):
+    """
+    Stores rows that could not be inserted into table_name, as [(row, error)], with each row
+    encoded as JSON.
+    """
+    create_dead_letters_table()
+    get_clickhouse_client().execute(
+        f"INSERT INTO {DEAD_LETTERS_TABLE} (table_name, row, error) VALUES",
+        [(table_name, json.dumps(row, default=str), error) for (row, error) in rejected],
+    )
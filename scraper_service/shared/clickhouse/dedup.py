@@ -0,0 +1,127 @@
+from shared.clickhouse.utils import get_clickhouse_client
+import logging
+import marshal
+import os
+import sys
+import threading
+import xxhash
+
+# Rows are inserted in chunks of at most this many consecutive blocks, each with its own
+# deduplication token
+DEDUP_WINDOW_BLOCKS = int(os.getenv("DEDUP_WINDOW_BLOCKS", "100"))
+# How many recent insert tokens Clickhouse remembers per table
+DEDUP_HISTORY = int(os.getenv("DEDUP_HISTORY", "1000"))
+# Part of every shovel table's CREATE TABLE, so new tables keep insert tokens from the start
+DEDUP_TABLE_SETTINGS = f"SETTINGS non_replicated_deduplication_window = {DEDUP_HISTORY}"
+# Whether shovels also ALTER existing tables they insert into to keep DEDUP_HISTORY tokens. Off
+# by default, so existing tables are only altered by whoever runs `python -m shared.clickhouse.dedup`.
+DEDUP_CONFIGURE_TABLES = os.getenv("DEDUP_CONFIGURE_TABLES", "0") == "1"
+# Rows hashed at a time for a chunk's token
+HASH_SLICE_ROWS = 4096
+
+deduplicated_tables = set()
+deduplicated_tables_lock = threading.Lock()
+
+
+def split_by_window(rows, spans, window=DEDUP_WINDOW_BLOCKS):
+    """
+    Splits rows into chunks by block window. spans are [block, row count] runs in row order,
+    as recorded by the buffer. Yields (first_block, last_block, rows); rows buffered outside
+    of any block have None for both.
+    """
+    start = 0
+    chunk_start = 0
+    chunk_key = None
+    first_block = last_block = None
+    for (block, count) in spans:
+        key = None if block is None else block // window
+        if start > chunk_start and key != chunk_key:
+            yield (first_block, last_block, rows[chunk_start:start])
+            chunk_start = start
+            first_block = None
+        if first_block is None:
+            first_block = block
+        chunk_key = key
+        last_block = block
+        start += count
+    if start > chunk_start:
+        yield (first_block, last_block, rows[chunk_start:start])
+    if start < len(rows):
+        yield (None, None, rows[start:])
+
+
+def dedup_token(shovel_name, table, first_block, last_block, rows):
+    """
+    Identifies a chunk by where its rows came from and a hash of all of them, so re-inserting
+    the same rows for the same blocks is a no-op, while a chunk whose rows changed in any way
+    (e.g. re-indexed after a fix) is inserted.
+    """
+    return f"{shovel_name}:{table}:{first_block}-{last_block}:{len(rows)}:{hash_rows(rows)}"
+
+
+def hash_rows(rows):
+    """
+    xxh3 of every value, streamed a slice of rows at a time. marshal's version 2 format has no
+    back-references, so equal values always encode the same, and it is several times faster
+    than pickle or repr. Slices holding values marshal can't encode (e.g. datetimes) are hashed
+    by their repr instead.
+    """
+    digest = xxhash.xxh3_64()
+    for start in range(0, len(rows), HASH_SLICE_ROWS):
+        rows_slice = rows[start:start + HASH_SLICE_ROWS]
+        try:
+            digest.update(marshal.dumps(rows_slice, 2))
+        except ValueError:
+            digest.update(repr(rows_slice))
+    return digest.hexdigest()
+
+
+def enable_deduplication(table):
+    """
+    MergeTree tables that aren't replicated ignore insert tokens unless they keep a
+    deduplication window. With DEDUP_CONFIGURE_TABLES=1, set one the first time this process
+    inserts into a table.
+    """
+    if not DEDUP_CONFIGURE_TABLES:
+        return
+    with deduplicated_tables_lock:
+        if table in deduplicated_tables:
+            return
+        deduplicated_tables.add(table)
+    configure_table(table)
+
+
+def configure_table(table):
+    try:
+        get_clickhouse_client().execute(
+            f"ALTER TABLE {table} MODIFY SETTING non_replicated_deduplication_window = {DEDUP_HISTORY}"
+        )
+        logging.info(f"Clickhouse now remembers the last {DEDUP_HISTORY} insert tokens of {table}")
+    except Exception as e:
+        # e.g. a Replicated table, which deduplicates by default
+        logging.warning(f"Could not enable insert deduplication on {table}: {str(e)}")
+
+
+def configure_all_tables():
+    """
+    Sets DEDUP_HISTORY on every non-replicated shovel table that doesn't keep insert tokens yet.
+    """
+    tables = get_clickhouse_client().execute("""
+        SELECT name
+        FROM system.tables
+        WHERE database = currentDatabase() AND startsWith(name, 'shovel_')
+            AND engine LIKE '%MergeTree' AND NOT startsWith(engine, 'Replicated')
+            AND NOT match(create_table_query, 'non_replicated_deduplication_window')
+    """)
+    for (table,) in tables:
+        configure_table(table)
+
+
+if __name__ == "__main__":
+    # Setup step for existing tables: python -m shared.clickhouse.dedup (--all | <table> ...)
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["--all"]:
+        configure_all_tables()
+    else:
+        for table in sys.argv[1:]:
+            configure_table(table)
@@ -0,0 +1,118 @@
+import os
+import socket
+import time
+import uuid
+from shared.clickhouse.utils import get_clickhouse_client, table_exists
+
+LEASES_TABLE = "shovel_backfill_leases"
+
+
+def create_lease_table():
+    if not table_exists(LEASES_TABLE):
+        # One row per claim. Heartbeats and completion re-insert the same claim with a later
+        # heartbeat_at, which ReplacingMergeTree keeps.
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {LEASES_TABLE} (
+            shovel_name String,
+            range_start UInt64,
+            range_end UInt64,
+            owner String,
+            claimed_at DateTime64(6),
+            heartbeat_at DateTime64(6),
+            expires_at DateTime64(6),
+            done Bool
+        ) ENGINE = ReplacingMergeTree(heartbeat_at)
+        ORDER BY (shovel_name, range_start, owner, claimed_at)
+        """
+        get_clickhouse_client().execute(query)
+
+
+def new_lease_owner():
+    """
+    Returns an identifier unique to this worker, e.g. "indexer-2:4711:1f2e3d4c".
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def get_range_holder(shovel_name, range_start):
+    """
+    Returns (owner, claimed_at, done) for whoever currently holds a range, or None if it is
+    free. A finished range is held forever. Otherwise the earliest live claim wins, so
+    competing claimers all agree on the winner once their claims are visible.
+
+    All timestamps come from the Clickhouse server, so clocks on worker hosts don't matter.
+    """
+    query = f"""
+        SELECT owner, claimed_at, done
+        FROM {LEASES_TABLE} FINAL
+        WHERE shovel_name = '{shovel_name}'
+          AND range_start = {range_start}
+          AND (done OR expires_at > now64(6))
+        ORDER BY done DESC, claimed_at ASC, owner ASC
+        LIMIT 1
+    """
+    result = get_clickhouse_client().execute(query)
+    return result[0] if result else None
+
+
+def _write_lease(shovel_name, range_start, range_end, owner, claimed_at, ttl_seconds, done):
+    claimed_at_sql = "now64(6)" if claimed_at is None else f"toDateTime64('{claimed_at}', 6)"
+    query = f"""
+        INSERT INTO {LEASES_TABLE}
+        SELECT
+            '{shovel_name}', {range_start}, {range_end}, '{owner}',
+            {claimed_at_sql}, now64(6), now64(6) + toIntervalSecond({ttl_seconds}), {done}
+    """
+    # A repeated heartbeat or completion replaces itself, and a repeated claim is a later claim
+    # by the same owner, which never wins over its first one
+    get_clickhouse_client().execute(query, retry=True)
+
+
+def claim_range(shovel_name, range_start, range_end, owner, ttl_seconds, settle_seconds=1):
+    """
+    Tries to claim a block range. Returns the claim's claimed_at if this owner won it, or None
+    if the range is done or held by someone else.
+
+    The winner is re-checked after `settle_seconds`, so a competing claim that was stamped
+    earlier but committed later still takes precedence.
+    """
+    if get_range_holder(shovel_name, range_start) is not None:
+        return None
+
+    _write_lease(shovel_name, range_start, range_end, owner, None, ttl_seconds, "false")
+
+    for _ in range(2):
+        holder = get_range_holder(shovel_name, range_start)
+        if holder is None or holder[0] != owner or holder[2]:
+            return None
+        time.sleep(settle_seconds)
+    return holder[1]
+
+
+def renew_lease(shovel_name, range_start, range_end, owner, claimed_at, ttl_seconds):
+    """
+    Extends a lease. Returns False if it has already been lost to another owner, in which case
+    the caller must stop working on the range.
+    """
+    holder = get_range_holder(shovel_name, range_start)
+    if holder is None or holder[0] != owner or holder[2]:
+        return False
+    _write_lease(shovel_name, range_start, range_end, owner, claimed_at, ttl_seconds, "false")
+    return True
+
+
+def complete_range(shovel_name, range_start, range_end, owner, claimed_at):
+    _write_lease(shovel_name, range_start, range_end, owner, claimed_at, 0, "true")
+
+
+def get_done_ranges(shovel_name, from_block):
+    """
+    Returns {range_start: range_end} for every finished range starting at or after from_block.
+    """
+    query = f"""
+        SELECT range_start, max(range_end)
+        FROM {LEASES_TABLE} FINAL
+        WHERE shovel_name = '{shovel_name}' AND range_start >= {from_block} AND done
+        GROUP BY range_start
+    """
+    return dict(get_clickhouse_client().execute(query))
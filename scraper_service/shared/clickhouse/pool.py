@@ -0,0 +1,252 @@
+from clickhouse_driver import Client
+from clickhouse_driver.errors import NetworkError, SocketTimeoutError
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+import importlib
+import itertools
+import logging
+import os
+import threading
+import time
+
+# Errors after which a connection can't be trusted and is replaced
+BROKEN_CONNECTION_ERRORS = (NetworkError, SocketTimeoutError, EOFError, OSError)
+
+
+class PooledConnection:
+    def __init__(self, connection_id, client):
+        self.id = connection_id
+        self.client = client
+        self.last_used = time.monotonic()
+        self.queries = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+
+class ConnectionPool:
+    """
+    A bounded pool of Clickhouse connections shared by every thread of a process.
+
+    Idle connections are pinged every `check_interval` seconds and dropped if they fail.
+    Connections are created on demand, up to `size`; callers wait for one to be returned
+    beyond that. After a fork the child forgets its parent's connections.
+    """
+
+    def __init__(self, size, connect, check_interval):
+        self.size = size
+        self.connect = connect
+        self.check_interval = check_interval
+        self.condition = threading.Condition()
+        self.ids = itertools.count()
+        self.pid = None
+        self._reset()
+
+    def _reset(self):
+        if self.pid != os.getpid():
+            # The checker thread didn't survive the fork
+            self.pid = os.getpid()
+            self.checker = None
+        self.idle = deque()
+        self.open = 0
+        self.stats = {}
+
+    def reset(self):
+        """
+        Forgets every connection without closing it, e.g. in a forked child sharing its
+        parent's sockets.
+        """
+        with self.condition:
+            self._reset()
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        started = time.monotonic()
+        try:
+            yield connection.client
+        except BROKEN_CONNECTION_ERRORS:
+            connection.errors += 1
+            self._discard(connection)
+            raise
+        except Exception:
+            connection.errors += 1
+            self._release(connection, started)
+            raise
+        else:
+            self._release(connection, started)
+
+    def _acquire(self):
+        with self.condition:
+            if self.pid != os.getpid():
+                self._reset()
+            if self.checker is None:
+                self.checker = threading.Thread(target=self._check_idle_connections, daemon=True)
+                self.checker.start()
+            while not self.idle and self.open >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.open += 1
+
+        try:
+            connection = PooledConnection(next(self.ids), self.connect())
+        except Exception:
+            with self.condition:
+                self.open -= 1
+                self.condition.notify()
+            raise
+        logging.info(f"Opened Clickhouse connection {connection.id}")
+        return connection
+
+    def _release(self, connection, started):
+        connection.queries += 1
+        connection.seconds += time.monotonic() - started
+        connection.last_used = time.monotonic()
+        with self.condition:
+            self.stats[connection.id] = (connection.queries, connection.errors, connection.seconds)
+            self.idle.append(connection)
+            self.condition.notify()
+
+    def _discard(self, connection):
+        logging.warning(f"Dropping broken Clickhouse connection {connection.id}")
+        try:
+            connection.client.disconnect()
+        except Exception:
+            pass
+        with self.condition:
+            self.stats.pop(connection.id, None)
+            self.open -= 1
+            self.condition.notify()
+
+    def _check_idle_connections(self):
+        pid = os.getpid()
+        last_report = time.monotonic()
+        while self.pid == pid:
+            time.sleep(self.check_interval)
+            with self.condition:
+                stale = [c for c in self.idle if time.monotonic() - c.last_used >= self.check_interval]
+                for connection in stale:
+                    self.idle.remove(connection)
+
+            for connection in stale:
+                try:
+                    connection.client.execute("SELECT 1")
+                except Exception as e:
+                    logging.warning(f"Clickhouse connection {connection.id} failed its liveness check: {str(e)}")
+                    self._discard(connection)
+                    continue
+                connection.last_used = time.monotonic()
+                with self.condition:
+                    self.idle.append(connection)
+                    self.condition.notify()
+
+            if time.monotonic() - last_report >= 60:
+                last_report = time.monotonic()
+                self.report()
+
+    def report(self):
+        with self.condition:
+            stats = dict(self.stats)
+        if stats:
+            logging.info("Clickhouse connections: " + ", ".join(
+                f"#{connection_id} {queries} queries, {errors} errors, {seconds:.1f}s"
+                for connection_id, (queries, errors, seconds) in sorted(stats.items())
+            ))
+
+
+class PooledClient:
+    """
+    Stands in for a clickhouse_driver `Client`: each call borrows a connection from the pool,
+    and a query that fails because its connection broke is retried once on a new one.
+
+    A broken connection doesn't say whether the server had already applied the query, so
+    INSERTs are only retried when they carry an `insert_deduplication_token`, which makes a
+    second copy a no-op. Callers can pass `retry=True` for inserts that are safe to repeat
+    anyway, or `retry=False` for anything that isn't.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def execute(self, query, *args, retry=None, **kwargs):
+        if retry is None:
+            retry = _is_retryable(query, kwargs.get("settings"))
+        try:
+            with self.pool.connection() as client:
+                return client.execute(query, *args, **kwargs)
+        except BROKEN_CONNECTION_ERRORS as e:
+            if not retry:
+                raise
+            logging.warning(f"Clickhouse connection broke, retrying on a new one: {str(e)}")
+            with self.pool.connection() as client:
+                return client.execute(query, *args, **kwargs)
+
+
+def _is_retryable(query, settings):
+    if not query.lstrip().upper().startswith("INSERT"):
+        return True
+    return bool(settings) and "insert_deduplication_token" in settings
+
+
+# Modules clickhouse_driver needs for each compression method
+COMPRESSION_MODULES = {
+    "lz4": ("lz4", "clickhouse_cityhash"),
+    "lz4hc": ("lz4", "clickhouse_cityhash"),
+    "zstd": ("zstd", "clickhouse_cityhash"),
+}
+
+
+@lru_cache(maxsize=None)
+def get_compression():
+    """
+    The CLICKHOUSE_COMPRESSION method, or False if it is off or its modules aren't installed,
+    in which case every connection would otherwise fail.
+    """
+    compression = os.getenv("CLICKHOUSE_COMPRESSION", "lz4")
+    if compression in ("", "none"):
+        return False
+    try:
+        for module in COMPRESSION_MODULES.get(compression, ()):
+            importlib.import_module(module)
+    except ImportError as e:
+        logging.warning(f"Not compressing Clickhouse traffic, {compression} needs {e.name}: pip install -r requirements.txt")
+        return False
+    return compression
+
+
+def connect(retries=10, delay=1):
+    """
+    Opens a connection, retrying with exponential backoff (capped at 30s) while the server is
+    unreachable.
+    """
+    compression = get_compression()
+    attempt = 0
+    while True:
+        try:
+            client = Client(
+                host=os.getenv("CLICKHOUSE_HOST"),
+                port=int(os.getenv("CLICKHOUSE_PORT", "8123")),
+                user=os.getenv("CLICKHOUSE_USER"),
+                password=os.getenv("CLICKHOUSE_PASSWORD"),
+                database=os.getenv("CLICKHOUSE_DB"),
+                compression=compression,
+            )
+            client.execute("SELECT 1")
+            return client
+        except Exception as e:
+            attempt += 1
+            if attempt >= retries:
+                raise e
+            print(f"Error connecting to Clickhouse: {e}")
+            print(f"Retrying in {delay}s...")
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+pool = ConnectionPool(
+    size=int(os.getenv("CLICKHOUSE_POOL_SIZE", "8")),
+    connect=connect,
+    check_interval=float(os.getenv("CLICKHOUSE_POOL_CHECK_INTERVAL", "30")),
+)
+client = PooledClient(pool)
@@ -0,0 +1,221 @@
+from datetime import date, datetime
+from shared.clickhouse import pool
+import logging
+import threading
+
+# Columns an INSERT without a column list expects
+INSERTABLE_COLUMNS = "default_kind NOT IN ('MATERIALIZED', 'ALIAS')"
+
+
+class SchemaCatalogue:
+    """
+    In-memory copy of the columns, partition key and sorting key of every shovel_* table,
+    loaded from system.columns and system.tables. Tables that aren't in it yet (e.g. created by
+    another shovel since) are looked up individually and added once they exist, so a missing
+    table is never cached.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = None
+        self.table_keys = {}
+
+    def load(self):
+        rows = pool.client.execute(f"""
+            SELECT table, name, type
+            FROM system.columns
+            WHERE database = currentDatabase() AND startsWith(table, 'shovel_')
+                AND {INSERTABLE_COLUMNS}
+            ORDER BY table, position
+        """)
+        tables = {}
+        for (table_name, column_name, column_type) in rows:
+            tables.setdefault(table_name, []).append((column_name, column_type))
+        table_keys = {
+            table_name: (partition_key, sorting_key)
+            for (table_name, partition_key, sorting_key) in pool.client.execute("""
+                SELECT name, partition_key, sorting_key
+                FROM system.tables
+                WHERE database = currentDatabase() AND startsWith(name, 'shovel_')
+            """)
+        }
+        with self.lock:
+            self.tables = tables
+            self.table_keys = table_keys
+        logging.info(f"Loaded the schema of {len(tables)} tables")
+
+    def columns(self, table_name):
+        """
+        Returns [(name, type)] for the table's columns, or None if it doesn't exist.
+        """
+        if self.tables is None:
+            self.load()
+        with self.lock:
+            columns = self.tables.get(table_name)
+        if columns is None:
+            columns = self.refresh(table_name)
+        return columns
+
+    def table_exists(self, table_name):
+        return self.columns(table_name) is not None
+
+    def keys(self, table_name):
+        """
+        Returns the table's (partition_key, sorting_key) expressions, empty if it has none.
+        """
+        if self.columns(table_name) is None:
+            return ("", "")
+        with self.lock:
+            return self.table_keys.get(table_name, ("", ""))
+
+    def refresh(self, table_name):
+        """
+        Re-reads one table's columns, e.g. after creating or altering it.
+        """
+        columns = get_table_columns(table_name) or None
+        keys = get_table_keys(table_name) if columns is not None else None
+        with self.lock:
+            if self.tables is None:
+                self.tables = {}
+            if columns is None:
+                self.tables.pop(table_name, None)
+                self.table_keys.pop(table_name, None)
+            else:
+                self.tables[table_name] = columns
+                self.table_keys[table_name] = keys
+        return columns
+
+
+def get_table_columns(table_name):
+    """
+    Returns [(name, type)] for the columns an INSERT without a column list expects.
+    """
+    return pool.client.execute(
+        f"""
+        SELECT name, type
+        FROM system.columns
+        WHERE database = currentDatabase() AND table = %(table)s AND {INSERTABLE_COLUMNS}
+        ORDER BY position
+        """,
+        {"table": table_name},
+    )
+
+
+def get_table_keys(table_name):
+    """
+    Returns (partition_key, sorting_key) as Clickhouse prints them, e.g.
+    ("toYYYYMM(timestamp)", "coldkey, hotkey, timestamp").
+    """
+    rows = pool.client.execute(
+        """
+        SELECT partition_key, sorting_key
+        FROM system.tables
+        WHERE database = currentDatabase() AND name = %(table)s
+        """,
+        {"table": table_name},
+    )
+    return rows[0] if rows else ("", "")
+
+
+catalogue = SchemaCatalogue()
+
+
+INTEGER_RANGES = {
+    f"{prefix}Int{bits}": (0, 2**bits - 1) if prefix == "U" else (-2**(bits - 1), 2**(bits - 1) - 1)
+    for prefix in ("U", "")
+    for bits in (8, 16, 32, 64, 128, 256)
+}
+
+
+def split_type_arguments(arguments):
+    """
+    Splits "UInt16, Tuple(UInt8, String)" into ["UInt16", "Tuple(UInt8, String)"].
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for (i, char) in enumerate(arguments):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(arguments[start:i].strip())
+            start = i + 1
+    parts.append(arguments[start:].strip())
+    return parts
+
+
+def value_error(column_type, value):
+    """
+    Returns why value can't be inserted into a column of column_type, or None if it can.
+    Types this doesn't know are assumed to accept anything.
+    """
+    (name, _, arguments) = column_type.partition("(")
+    arguments = split_type_arguments(arguments[:-1]) if arguments else []
+
+    if name == "Nullable":
+        return None if value is None else value_error(arguments[0], value)
+    if value is None:
+        return f"NULL in non-Nullable {column_type}"
+    if name == "LowCardinality":
+        return value_error(arguments[0], value)
+
+    if name in INTEGER_RANGES:
+        if not isinstance(value, int):
+            return f"{type(value).__name__} {value!r} in {column_type}"
+        (low, high) = INTEGER_RANGES[name]
+        if not low <= value <= high:
+            return f"{value} out of range for {column_type}"
+    elif name in ("Float32", "Float64"):
+        if not isinstance(value, (int, float)):
+            return f"{type(value).__name__} {value!r} in {column_type}"
+    elif name == "Bool":
+        if not isinstance(value, int):
+            return f"{type(value).__name__} {value!r} in {column_type}"
+    elif name in ("String", "FixedString"):
+        if not isinstance(value, (str, bytes)):
+            return f"{type(value).__name__} {value!r} in {column_type}"
+    elif name in ("DateTime", "DateTime64"):
+        if not isinstance(value, (int, datetime)) or (isinstance(value, int) and value < 0):
+            return f"{type(value).__name__} {value!r} in {column_type}"
+    elif name in ("Date", "Date32"):
+        if not isinstance(value, (int, date)):
+            return f"{type(value).__name__} {value!r} in {column_type}"
+    elif name == "Array":
+        if not isinstance(value, (list, tuple)):
+            return f"{type(value).__name__} in {column_type}"
+        for item in value:
+            error = value_error(arguments[0], item)
+            if error is not None:
+                return error
+    elif name == "Tuple":
+        if not isinstance(value, (list, tuple)) or len(value) != len(arguments):
+            return f"{value!r} does not match {column_type}"
+        for (item_type, item) in zip(arguments, value):
+            # Named tuple elements are "name Type"
+            error = value_error(item_type.split(" ")[-1] if " " in item_type else item_type, item)
+            if error is not None:
+                return error
+    elif name == "Map":
+        if not isinstance(value, dict):
+            return f"{type(value).__name__} in {column_type}"
+        for (key, item) in value.items():
+            error = value_error(arguments[0], key) or value_error(arguments[1], item)
+            if error is not None:
+                return error
+    return None
+
+
+def row_error(columns, row):
+    """
+    Returns why row can't be inserted into a table with the given [(name, type)] columns, or
+    None if it can.
+    """
+    if len(row) != len(columns):
+        return f"{len(row)} values for {len(columns)} columns"
+    for ((column_name, column_type), value) in zip(columns, row):
+        error = value_error(column_type, value)
+        if error is not None:
+            return f"{column_name}: {error}"
+    return None
@@ -0,0 +1,107 @@
+from shared.clickhouse.dedup import split_by_window
+from shared.clickhouse.partitions import arrange_rows
+from shared.clickhouse.schema import catalogue, split_type_arguments
+import logging
+import os
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class NullSink:
+    """
+    Discards every row, so shovels can be benchmarked on extraction alone.
+    """
+
+    def __init__(self):
+        self.rows = 0
+
+    def write(self, shovel_name, table_name, rows, spans):
+        self.rows += len(rows)
+
+
+# Clickhouse types with a direct Arrow equivalent that Clickhouse reads back as the same type
+ARROW_TYPES = {
+    "UInt8": "uint8", "UInt16": "uint16", "UInt32": "uint32", "UInt64": "uint64",
+    "Int8": "int8", "Int16": "int16", "Int32": "int32", "Int64": "int64",
+    "Float32": "float32", "Float64": "float64", "Bool": "bool_", "String": "string",
+    "Date": "date32", "Date32": "date32",
+}
+
+
+def arrow_type(column_type):
+    """
+    Returns the Arrow type Clickhouse loads back into column_type. Types without one (e.g.
+    UInt128) are written as strings, which Clickhouse parses on load.
+    """
+    (name, _, arguments) = column_type.partition("(")
+    arguments = split_type_arguments(arguments[:-1]) if arguments else []
+    if name in ("Nullable", "LowCardinality"):
+        return arrow_type(arguments[0])
+    if name in ARROW_TYPES:
+        return getattr(pyarrow, ARROW_TYPES[name])()
+    if name == "DateTime":
+        return pyarrow.timestamp("s")
+    if name == "Array":
+        return pyarrow.list_(arrow_type(arguments[0]))
+    if name == "Tuple":
+        return pyarrow.struct([
+            (str(i + 1), arrow_type(item.split(" ")[-1])) for (i, item) in enumerate(arguments)
+        ])
+    if name == "Map":
+        return pyarrow.map_(arrow_type(arguments[0]), arrow_type(arguments[1]))
+    return pyarrow.string()
+
+
+class ParquetSink:
+    """
+    Writes rows to Parquet files instead of Clickhouse, one file per table per block window:
+    `{directory}/{table}/{first_block}-{last_block}.parquet`, with the table's column names and
+    types. Rewriting a window replaces its file. Load them later with
+
+        INSERT INTO table FROM INFILE 'directory/table/*.parquet' FORMAT Parquet
+
+    Tables are still created and checkpoints still stored in Clickhouse.
+    """
+
+    def __init__(self, directory=None):
+        if pyarrow is None:
+            raise ImportError("SHOVEL_SINK=parquet needs pyarrow, pip install -r requirements.txt")
+        self.directory = directory or os.getenv("PARQUET_SINK_DIR", "parquet")
+
+    def write(self, shovel_name, table_name, rows, spans):
+        columns = catalogue.columns(table_name)
+        if columns is None:
+            raise ValueError(f"Table {table_name} doesn't exist, so its columns are unknown")
+        schema = pyarrow.schema([
+            pyarrow.field(name, arrow_type(column_type), nullable=column_type.startswith("Nullable"))
+            for (name, column_type) in columns
+        ])
+        table_directory = os.path.join(self.directory, table_name)
+        os.makedirs(table_directory, exist_ok=True)
+
+        for (first_block, last_block, window_rows) in split_by_window(rows, spans):
+            if first_block is None:
+                name = f"unknown-{time.time_ns()}"
+            else:
+                name = f"{first_block:012d}-{last_block:012d}"
+            arranged = [row for chunk in arrange_rows(table_name, window_rows) for row in chunk]
+            arrays = [
+                pyarrow.array(
+                    [value if field.type != pyarrow.string() or value is None else str(value) for value in column],
+                    type=field.type,
+                )
+                for (field, column) in zip(schema, zip(*arranged))
+            ]
+            path = os.path.join(table_directory, f"{name}.parquet")
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_arrays(arrays, schema=schema),
+                path + ".tmp",
+                compression="zstd",
+            )
+            os.replace(path + ".tmp", path)
+            logging.debug(f"Wrote {len(window_rows)} rows to {path}")
@@ -1,10 +1,5 @@
-import os
-import time
-from clickhouse_driver import Client
-from functools import lru_cache
-import threading
-
-thread_local = threading.local()
+from shared.clickhouse.pool import client, pool
+from shared.clickhouse.schema import catalogue
 
 RESERVED_KEYWORDS = {
     "INDEX",
@@ -49,40 +44,24 @@ def escape_column_name(column_name):
     return column_name
 
 
-@lru_cache(maxsize=None)
 def table_exists(table_name):
-    client = get_clickhouse_client()
-    query = f"SHOW TABLES LIKE '{table_name}'"
-    result = client.execute(query)
-    return len(result) > 0
+    """
+    Answered from the schema catalogue, which only queries Clickhouse for tables it hasn't
+    seen yet.
+    """
+    return catalogue.table_exists(table_name)
+
 
+def reset_clickhouse_client():
+    """
+    Forgets every pooled connection so the next query reconnects, e.g. in a forked worker.
+    """
+    pool.reset()
 
-def get_clickhouse_client(retries=10, delay=1):
-    if not hasattr(thread_local, "client"):
-        clickhouse_host = os.getenv("CLICKHOUSE_HOST")
-        clickhouse_port = int(os.getenv("CLICKHOUSE_PORT", "8123"))
-        clickhouse_db = os.getenv("CLICKHOUSE_DB")
-        clickhouse_user = os.getenv("CLICKHOUSE_USER")
-        clickhouse_password = os.getenv("CLICKHOUSE_PASSWORD")
 
-        attempt = 0
-        while attempt < retries:
-            try:
-                thread_local.client = Client(
-                    host=clickhouse_host,
-                    port=clickhouse_port,
-                    user=clickhouse_user,
-                    password=clickhouse_password,
-                    database=clickhouse_db,
-                )
-                thread_local.client.execute("SELECT 1")
-                break
-            except Exception as e:
-                print(f"Error connecting to Clickhouse: {e}")
-                print(f"Retrying in {delay}s...")
-                attempt += 1
-                if attempt < retries:
-                    time.sleep(delay)
-                else:
-                    raise e
-    return thread_local.client
+def get_clickhouse_client():
+    """
+    Returns a client whose queries run on connections borrowed from the process-wide pool, see
+    shared/clickhouse/pool.py.
+    """
+    return client
@@ -0,0 +1,119 @@
+import logging
+import os
+import pickle
+import struct
+import zlib
+
+# Every record is its payload length and CRC32, followed by the pickled payload
+RECORD_HEADER = struct.Struct("<II")
+
+
+class WriteAheadLog:
+    """
+    Append-only log of buffered rows, split into numbered segment files.
+
+    Records are ("rows", block_number, {table_name: rows}), ("checkpoint", block_number),
+    written once every row of a block has been logged, or ("discard", first_block, last_block)
+    for rows dropped from the buffer before being flushed. Each flush seals the current segment,
+    and sealed segments are deleted once everything taken by the flush has been inserted.
+    """
+
+    def __init__(self, directory, fsync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        segments = self.segments()
+        self.sequence = segments[-1] + 1 if segments else 0
+        self.file = None
+
+    def segments(self):
+        return sorted(
+            int(name[:-len(".wal")])
+            for name in os.listdir(self.directory)
+            if name.endswith(".wal")
+        )
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:012d}.wal")
+
+    def append(self, record):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.file is None:
+            self.file = open(self._path(self.sequence), "ab")
+        self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        # Flushed to the OS, so the record survives the process being killed. fsync is only
+        # needed to survive the host going down.
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def rotate(self):
+        """
+        Seals the current segment and returns its sequence number.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        sealed = self.sequence
+        self.sequence += 1
+        return sealed
+
+    def delete_through(self, sequence):
+        for segment in self.segments():
+            if segment <= sequence:
+                os.remove(self._path(segment))
+
+    def read(self):
+        """
+        Yields the records of every segment on disk, oldest first. A segment is read up to its
+        first torn or corrupt record, which can only be the last one written before a crash.
+        """
+        for segment in self.segments():
+            if segment >= self.sequence:
+                continue
+            with open(self._path(segment), "rb") as f:
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    (length, crc) = RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        logging.warning(f"Ignoring torn record at the end of WAL segment {segment}")
+                        break
+                    yield pickle.loads(payload)
+
+
+def read_unflushed(wal):
+    """
+    Returns ({table_name: (rows, spans)}, checkpoint) for the rows logged before the last
+    checkpoint record, with spans the [block_number, row count] runs they came from. Rows
+    after it belong to a block that never finished processing, so are dropped; that block is
+    scraped again. So are rows of blocks discarded from the buffer.
+    """
+    committed = {}
+    pending = []
+    checkpoint = None
+    for record in wal.read():
+        if record[0] == "rows":
+            # Logs written before rows were tagged with their block have no block number
+            (block_number, rows_by_table) = record[1:] if len(record) == 3 else (None, record[1])
+            pending.append((block_number, rows_by_table))
+        elif record[0] == "checkpoint":
+            for (block_number, rows_by_table) in pending:
+                for (table_name, rows) in rows_by_table.items():
+                    (table_rows, spans) = committed.setdefault(table_name, ([], []))
+                    table_rows.extend(rows)
+                    if spans and spans[-1][0] == block_number:
+                        spans[-1][1] += len(rows)
+                    else:
+                        spans.append([block_number, len(rows)])
+            pending = []
+            checkpoint = record[1]
+        elif record[0] == "discard":
+            (first_block, last_block) = record[1:]
+            pending = [
+                (block_number, rows_by_table) for (block_number, rows_by_table) in pending
+                if block_number is None or not first_block <= block_number <= last_block
+            ]
+    return (committed, checkpoint)
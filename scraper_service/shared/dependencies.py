@@ -0,0 +1,154 @@
+from shared.clickhouse.checkpoints import read_checkpoints
+from shared.pipeline import stage_timings
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+
+
+class CheckpointWatcher:
+    """
+    Lets shovels wait until the shovels they depend on have durably passed a block.
+
+    Checkpoints persisted in this process are announced with `publish` and wake waiters
+    immediately. With a socket directory shared by every shovel on the host (e.g. a volume
+    mounted into every container), each process that waits binds a datagram socket there and
+    `publish` sends the checkpoint to all of them, so shovels in other processes are woken
+    immediately too. Checkpoints that don't arrive that way (other hosts, or no socket
+    directory) are picked up by a single background thread that reads all of them in one
+    query, and only while something is actually waiting.
+    """
+
+    def __init__(self, poll_interval, socket_dir=""):
+        self.poll_interval = poll_interval
+        self.socket_dir = socket_dir
+        self.socket_path = None
+        self.condition = threading.Condition()
+        self.checkpoints = {}
+        self.waiting = {}
+        # Dependencies the last wait had to block on, so waits are logged when that changes
+        self.blocked = set()
+        self.pid = None
+
+    def notify(self, shovel_name, block_number):
+        with self.condition:
+            if block_number > self.checkpoints.get(shovel_name, -1):
+                self.checkpoints[shovel_name] = block_number
+                self.condition.notify_all()
+
+    def publish(self, shovel_name, block_number):
+        """
+        Announces a persisted checkpoint to waiters in this process and, through the socket
+        directory, in every other process on the host.
+        """
+        self.notify(shovel_name, block_number)
+        if not self.socket_dir:
+            return
+        try:
+            names = os.listdir(self.socket_dir)
+        except OSError:
+            return
+        message = f"{shovel_name} {block_number}".encode()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            sender.setblocking(False)
+            for name in names:
+                path = os.path.join(self.socket_dir, name)
+                if not name.endswith(".sock") or path == self.socket_path:
+                    continue
+                try:
+                    sender.sendto(message, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Left behind by a process that has exited
+                    _remove(path)
+                except OSError:
+                    # e.g. the receiver's queue is full; its poll catches up
+                    pass
+
+    def wait_for(self, shovel_names, block_number):
+        """
+        Blocks until every shovel in shovel_names has persisted a checkpoint >= block_number.
+        Time spent waiting on each dependency is recorded as a `wait:<shovel>` stage.
+        """
+        for shovel_name in shovel_names:
+            with self.condition:
+                if self.checkpoints.get(shovel_name, -1) >= block_number:
+                    if shovel_name in self.blocked:
+                        self.blocked.discard(shovel_name)
+                        logging.info(f"{shovel_name} is ahead of block {block_number}, no longer waiting on it")
+                    continue
+                self._ensure_poller()
+                if shovel_name not in self.blocked:
+                    self.blocked.add(shovel_name)
+                    logging.info(f"Waiting for {shovel_name} to reach block {block_number}")
+                else:
+                    logging.debug(f"Waiting for {shovel_name} to reach block {block_number}")
+                started = time.monotonic()
+                self.waiting[shovel_name] = self.waiting.get(shovel_name, 0) + 1
+                self.condition.notify_all()
+                try:
+                    while self.checkpoints.get(shovel_name, -1) < block_number:
+                        self.condition.wait()
+                finally:
+                    self.waiting[shovel_name] -= 1
+                    if self.waiting[shovel_name] == 0:
+                        del self.waiting[shovel_name]
+            stage_timings.add(f"wait:{shovel_name}", time.monotonic() - started)
+
+    def _ensure_poller(self):
+        # Threads do not survive a fork, so backfill workers start their own poller
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if self.socket_dir:
+                self._start_listener()
+            threading.Thread(target=self._poll, daemon=True).start()
+
+    def _start_listener(self):
+        try:
+            os.makedirs(self.socket_dir, exist_ok=True)
+            # Container hostnames keep processes with the same pid in different containers apart
+            path = os.path.join(self.socket_dir, f"{socket.gethostname()}-{os.getpid()}.sock")
+            _remove(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            listener.bind(path)
+        except OSError as e:
+            logging.warning(f"Not listening for checkpoints in {self.socket_dir}, polling only: {str(e)}")
+            return
+        self.socket_path = path
+        atexit.register(_remove, path)
+        threading.Thread(target=self._listen, args=(listener,), daemon=True).start()
+
+    def _listen(self, listener):
+        while True:
+            (shovel_name, block_number) = listener.recv(1024).decode().rsplit(" ", 1)
+            self.notify(shovel_name, int(block_number))
+
+    def _poll(self):
+        while True:
+            with self.condition:
+                while not self.waiting:
+                    self.condition.wait()
+                shovel_names = list(self.waiting)
+            try:
+                for (shovel_name, block_number) in read_checkpoints(shovel_names).items():
+                    self.notify(shovel_name, block_number)
+            except Exception as e:
+                logging.warning(f"Failed to read checkpoints of {', '.join(shovel_names)}: {str(e)}")
+            time.sleep(self.poll_interval)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+CHECKPOINT_SOCKET_DIR = os.getenv("CHECKPOINT_SOCKET_DIR", "")
+# Checkpoints published through CHECKPOINT_SOCKET_DIR arrive at once, so Clickhouse is only
+# polled as a fallback, for dependencies running on other hosts
+checkpoint_watcher = CheckpointWatcher(
+    float(os.getenv("DEPENDENCY_POLL_INTERVAL") or ("30" if CHECKPOINT_SOCKET_DIR else "1")),
+    CHECKPOINT_SOCKET_DIR,
+)
@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+import time
+
+# Weight of the newest sample in each endpoint's latency and error rate averages
+SMOOTHING = float(os.getenv("SUBSTRATE_ENDPOINT_SMOOTHING", "0.2"))
+# Seconds an endpoint is skipped after a failure, doubled for each further consecutive failure
+COOLDOWN = float(os.getenv("SUBSTRATE_ENDPOINT_COOLDOWN", "5"))
+MAX_COOLDOWN = 300
+# Whether a request still unanswered after its hedge delay is also sent to the next endpoint
+HEDGE_REQUESTS = os.getenv("SUBSTRATE_HEDGE_REQUESTS", "1") == "1"
+HEDGE_MIN_DELAY = float(os.getenv("SUBSTRATE_HEDGE_MIN_DELAY", "0.05"))
+# Hedge delay for a method an endpoint hasn't answered yet
+UNKNOWN_HEDGE_DELAY = 1.0
+# Every PROBE_INTERVAL-th request for a method goes first to the endpoint measured least
+# recently, so one that was slow for a moment gets the chance to show it has recovered
+PROBE_INTERVAL = int(os.getenv("SUBSTRATE_ENDPOINT_PROBE_INTERVAL", "20"))
+
+
+def get_endpoint_urls():
+    """
+    Archive node URLs from `SUBSTRATE_ARCHIVE_NODE_URLS` (comma-separated), or the single
+    `SUBSTRATE_ARCHIVE_NODE_URL` when it isn't set.
+    """
+    urls = os.getenv("SUBSTRATE_ARCHIVE_NODE_URLS") or os.getenv("SUBSTRATE_ARCHIVE_NODE_URL") or ""
+    return [url.strip() for url in urls.split(",") if url.strip()]
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        # {method: (average seconds, average deviation, monotonic time measured)}
+        self.latency = {}
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+
+class EndpointPool:
+    """
+    Latency and error statistics of every archive node, shared by every thread of a process.
+
+    Latency is averaged per method, as a `state_call` of a large runtime API takes far longer
+    than `chain_getBlockHash`. Requests go to the healthy endpoint with the lowest latency,
+    weighted by its recent error rate. An endpoint that fails is skipped for a cooldown that
+    doubles with each consecutive failure; when every endpoint is cooling down, the one due back
+    first is tried anyway.
+    """
+
+    def __init__(self, urls):
+        if not urls:
+            raise ValueError("No archive node configured, set SUBSTRATE_ARCHIVE_NODE_URLS")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.method_requests = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.last_report = time.monotonic()
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # The lock may have been held by a thread that didn't survive the fork
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+
+    def ranked(self, method):
+        """
+        Returns the endpoints to try for method, best first. Endpoints that haven't answered
+        method yet come first, so every endpoint gets measured.
+        """
+        self._check_fork()
+        now = time.monotonic()
+        with self.lock:
+            healthy = [e for e in self.endpoints if e.down_until <= now]
+            if not healthy:
+                return sorted(self.endpoints, key=lambda e: e.down_until)
+            ranked = sorted(healthy, key=lambda e: self._score(e, method))
+            self.method_requests[method] = self.method_requests.get(method, 0) + 1
+            if self.method_requests[method] % PROBE_INTERVAL == 0:
+                stalest = min(ranked, key=lambda e: e.latency.get(method, (0.0, 0.0, 0.0))[2])
+                ranked.remove(stalest)
+                ranked.insert(0, stalest)
+            return ranked
+
+    def _score(self, endpoint, method):
+        (average, _, _) = endpoint.latency.get(method, (0.0, 0.0, 0.0))
+        return average / max(1.0 - endpoint.error_rate, 0.1)
+
+    def hedge_delay(self, endpoint, method):
+        """
+        Seconds to wait for endpoint to answer method before also asking the next endpoint, or
+        None if requests aren't hedged. Like TCP's retransmission timeout, it's the average
+        latency plus four times its average deviation, so only unusually slow requests are
+        hedged.
+        """
+        if not HEDGE_REQUESTS:
+            return None
+        with self.lock:
+            if method not in endpoint.latency:
+                return UNKNOWN_HEDGE_DELAY
+            (average, deviation, _) = endpoint.latency[method]
+        return max(HEDGE_MIN_DELAY, average + 4 * deviation)
+
+    def record_latency(self, endpoint, method, seconds):
+        """
+        Records that endpoint answered method in seconds. Also used for a hedged request that
+        lost, with the time it had taken when it was abandoned.
+        """
+        self._check_fork()
+        with self.lock:
+            if method in endpoint.latency:
+                (average, deviation, _) = endpoint.latency[method]
+                # A single stall mustn't make a fast endpoint look slow for the next hundred
+                # requests, so outliers count as only moderately slow. Deviation still grows
+                # with them, so a node that stays slow is soon ranked as such.
+                sample = min(seconds, max(average + 4 * deviation, 2 * average))
+                deviation = (1 - SMOOTHING) * deviation + SMOOTHING * abs(sample - average)
+                average = (1 - SMOOTHING) * average + SMOOTHING * sample
+            else:
+                (average, deviation) = (seconds, seconds / 2)
+            endpoint.latency[method] = (average, deviation, time.monotonic())
+            endpoint.error_rate *= 1 - SMOOTHING
+            endpoint.consecutive_failures = 0
+            endpoint.down_until = 0.0
+            endpoint.requests += 1
+            endpoint.seconds += seconds
+        self._maybe_report()
+
+    def record_failure(self, endpoint, error):
+        self._check_fork()
+        with self.lock:
+            endpoint.error_rate = (1 - SMOOTHING) * endpoint.error_rate + SMOOTHING
+            endpoint.consecutive_failures += 1
+            cooldown = min(COOLDOWN * 2 ** (endpoint.consecutive_failures - 1), MAX_COOLDOWN)
+            endpoint.down_until = time.monotonic() + cooldown
+            endpoint.requests += 1
+            endpoint.errors += 1
+        logging.warning(f"Archive node {endpoint.url} failed, skipping it for {cooldown:.0f}s: {str(error)}")
+        self._maybe_report()
+
+    def _maybe_report(self):
+        if time.monotonic() - self.last_report >= 60:
+            self.last_report = time.monotonic()
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            stats = [
+                (e.url, e.requests, e.errors, e.seconds, e.error_rate, e.down_until - now)
+                for e in self.endpoints
+            ]
+        logging.info("Archive nodes: " + ", ".join(
+            f"{url} {requests} requests, {errors} errors ({error_rate:.0%} recently), "
+            f"{seconds / max(requests - errors, 1) * 1000:.0f}ms average"
+            + (f", down for {down:.0f}s" if down > 0 else "")
+            for (url, requests, errors, seconds, error_rate, down) in stats
+        ))
+
+
+endpoint_pool = None
+
+
+def get_endpoint_pool():
+    global endpoint_pool
+    if endpoint_pool is None:
+        endpoint_pool = EndpointPool(get_endpoint_urls())
+    return endpoint_pool
@@ -0,0 +1,64 @@
+import mmap
+import os
+import struct
+import threading
+
+# Block hash and unix timestamp, stored at offset block_number * RECORD.size. A timestamp of 0
+# means the block hasn't been written.
+RECORD = struct.Struct("<32sQ")
+
+
+class HeaderIndex:
+    """
+    File of fixed-width block header records, indexed by block number, written by the block
+    timestamps shovel. Every other process on the host maps it read-only and shares the same
+    page cache, so a lookup is a slice of memory rather than a Clickhouse or Substrate query.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.map = None
+        self.fd = None
+
+    def put(self, block_number, block_hash, timestamp):
+        if self.fd is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        offset = block_number * RECORD.size
+        os.pwrite(self.fd, bytes.fromhex(block_hash.removeprefix("0x")), offset)
+        # Readers take a record as complete once its timestamp is set, so it's written last
+        os.pwrite(self.fd, struct.pack("<Q", timestamp), offset + 32)
+
+    def get(self, block_number):
+        """
+        Returns (block_hash, timestamp) for block_number, or None if it isn't indexed yet.
+        """
+        offset = block_number * RECORD.size
+        with self.lock:
+            if (self.map is None or offset + RECORD.size > len(self.map)) and not self._remap(offset + RECORD.size):
+                return None
+            (raw_hash, timestamp) = RECORD.unpack_from(self.map, offset)
+        if timestamp == 0:
+            return None
+        return ("0x" + raw_hash.hex(), timestamp)
+
+    def _remap(self, size_needed):
+        """
+        Maps the file again once the writer has grown it past size_needed.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return False
+        if size < size_needed:
+            return False
+        if self.map is not None:
+            self.map.close()
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        return True
+
+
+header_index_path = os.getenv("BLOCK_HEADER_INDEX_PATH", "")
+header_index = HeaderIndex(header_index_path) if header_index_path else None
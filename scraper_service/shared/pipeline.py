@@ -0,0 +1,90 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+
+class StageTimings:
+    """
+    Accumulates the wall time spent in each stage of block processing, so it is easy to see
+    whether a shovel is bound by the archive node (fetch), decoding (transform) or Clickhouse
+    (insert).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.last_report = time.monotonic()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.totals[stage] += seconds
+            self.counts[stage] += 1
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - started)
+
+    def snapshot(self):
+        """
+        Returns {stage: (calls, total seconds)}.
+        """
+        with self.lock:
+            return {stage: (self.counts[stage], self.totals[stage]) for stage in self.totals}
+
+    def report(self, every_seconds=60):
+        """
+        Logs and resets the accumulated timings at most once every `every_seconds`.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_report < every_seconds:
+                return
+            elapsed = now - self.last_report
+            stats = {stage: (self.counts[stage], self.totals[stage]) for stage in self.totals}
+            self.totals.clear()
+            self.counts.clear()
+            self.last_report = now
+
+        if stats:
+            summary = ", ".join(
+                f"{stage}: {total:.1f}s over {count} calls ({total / elapsed:.0%} of wall time)"
+                for stage, (count, total) in sorted(stats.items())
+            )
+            logging.info(f"Stage timings for the last {elapsed:.0f}s: {summary}")
+
+
+stage_timings = StageTimings()
+
+
+def prefetch_blocks(fetch, block_numbers, depth, executor):
+    """
+    Yields (block_number, future) in order, keeping up to `depth` blocks ahead being fetched
+    on `executor`. Pass the same long-lived executor on every call: each of its threads keeps
+    its own Substrate client and connections. The bounded look-ahead applies backpressure when
+    the consumer falls behind.
+    """
+    blocks = iter(block_numbers)
+    pending = deque()
+
+    def submit_next():
+        n = next(blocks, None)
+        if n is not None:
+            pending.append((n, executor.submit(fetch, n)))
+
+    try:
+        for _ in range(depth):
+            submit_next()
+        while pending:
+            n, future = pending.popleft()
+            submit_next()
+            yield (n, future)
+    finally:
+        for (_, future) in pending:
+            future.cancel()
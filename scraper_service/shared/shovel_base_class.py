@@ -1,17 +1,52 @@
-from shared.clickhouse.batch_insert import buffer_insert, flush_buffer, batch_insert_into_clickhouse_table
-from shared.substrate import get_substrate_client, reconnect_substrate
-from time import sleep
-from shared.clickhouse.utils import (
-    get_clickhouse_client,
-    table_exists,
+from shared.clickhouse.batch_insert import (
+    BACKFILL_INSERT_PROFILE,
+    TAIL_INSERT_PROFILE,
+    buffered_row_count,
+    disable_wal,
+    discard_blocks,
+    drain_buffer,
+    flush_buffer,
+    log_checkpoint,
+    open_wal,
+    replay_wal,
+    request_flush,
+    reset_buffer,
+    set_current_block,
+    set_insert_profile,
+    set_shovel_name,
+)
+from shared.clickhouse.checkpoints import read_checkpoint, write_checkpoint
+from shared.clickhouse.leases import (
+    claim_range,
+    complete_range,
+    create_lease_table,
+    get_done_ranges,
+    new_lease_owner,
+    renew_lease,
 )
-from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
+from shared.async_substrate import reset_async_substrate, run_async
+from shared.substrate import create_substrate_client, get_substrate_client, reconnect_substrate
+from time import sleep
+from shared.clickhouse.schema import catalogue
+from shared.clickhouse.utils import reset_clickhouse_client
+from shared.dependencies import checkpoint_watcher
+from shared.exceptions import DatabaseConnectionError, ShovelException, ShovelProcessingError
+from shared.pipeline import prefetch_blocks, stage_timings
+from mpire import WorkerPool
 from tqdm import tqdm
 import logging
+import os
+import queue
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
+from websocket import WebSocketException
 import sys
 
+# Errors of the finalized heads subscription's connection, after which the shovel falls back
+# to polling. Anything else it raises stops the shovel, like an error while polling.
+SUBSCRIPTION_ERRORS = (WebSocketException, OSError)
+
 
 class ShovelBaseClass:
     checkpoint_block_number = 0
@@ -21,6 +56,56 @@ class ShovelBaseClass:
     MAX_RETRIES = 3
     RETRY_DELAY = 5
 
+    # Historical catch-up can be split into chunks and processed by a pool of worker
+    # processes. Shovels that carry state from one block to the next must set
+    # `parallel_backfill = False` so they keep walking blocks in order.
+    parallel_backfill = True
+    backfill_workers = int(os.getenv("BACKFILL_WORKERS", "1"))
+    backfill_chunk_size = int(os.getenv("BACKFILL_CHUNK_SIZE", "1000"))
+    backfill_flush_rows = int(os.getenv("BACKFILL_FLUSH_ROWS", "500000"))
+
+    # With BACKFILL_COORDINATION=lease, catch-up ranges are claimed through leases in
+    # Clickhouse, so several processes (on any number of hosts) can backfill the same shovel.
+    backfill_coordination = os.getenv("BACKFILL_COORDINATION", "")
+    backfill_lease_ttl = int(os.getenv("BACKFILL_LEASE_TTL", "300"))
+
+    # Shovels that split their work into `fetch_block` and `transform_block` have the next
+    # `prefetch_depth` blocks fetched in background threads while the current one is transformed.
+    prefetch_depth = int(os.getenv("PREFETCH_DEPTH", "4"))
+    prefetch_executor = None
+    prefetch_executor_pid = None
+
+    # Blocks more than `tail_distance` behind the finalized head are inserted with
+    # `backfill_insert_profile`, the rest with `tail_insert_profile`. Shovels can override any
+    # of the three with their own thresholds and settings, see shared/clickhouse/batch_insert.py.
+    tail_distance = int(os.getenv("INSERT_TAIL_DISTANCE", "300"))
+    backfill_insert_profile = BACKFILL_INSERT_PROFILE
+    tail_insert_profile = TAIL_INSERT_PROFILE
+
+    # Number of tables inserted concurrently by the buffer flush
+    flush_workers = int(os.getenv("CLICKHOUSE_FLUSH_WORKERS", "4"))
+
+    # With BUFFER_WAL_DIR set, buffered rows are also logged to disk until flushed, and rows a
+    # crashed run never flushed are inserted at startup rather than scraped again
+    buffer_wal_dir = os.getenv("BUFFER_WAL_DIR", "")
+
+    # Periodic shovels can declare which blocks they need, see shared/block_schedule.py. Only
+    # scheduled blocks are visited and checkpointed. None visits every `skip_interval` blocks.
+    block_schedule = None
+
+    # Set by shovels that read System.Events, so a ShovelHost can fetch them once per block
+    # for all co-hosted shovels
+    uses_block_events = False
+
+    # Names of the shovels whose tables this shovel reads. Block n is only processed once all
+    # of them have persisted a checkpoint at or past n.
+    dependencies = ()
+
+    # Once caught up, "subscribe" processes each block as soon as it is finalized, falling back
+    # to "poll" (every POLL_INTERVAL seconds) if the subscription drops.
+    tail_mode = os.getenv("TAIL_MODE", "subscribe")
+    POLL_INTERVAL = 12
+
     def __init__(self, name, skip_interval=1):
         """
         Choose a unique name for the shovel.
@@ -28,6 +113,13 @@ class ShovelBaseClass:
         self.name = name
         self.skip_interval = skip_interval
         self.starting_block = 0  # Default value, can be overridden by subclasses
+        # block number -> time.time() at which we learned it was finalized
+        self.finalized_at = {}
+        # The checkpoint is read from Clickhouse once and then kept authoritatively in memory.
+        # The persisted copy trails it and only moves once rows are acknowledged by Clickhouse.
+        self.checkpoint_loaded = False
+        self.persisted_checkpoint_block_number = 0
+        self.finalized_block_number = 0
 
     def start(self):
         retry_count = 0
@@ -39,10 +131,22 @@ class ShovelBaseClass:
                 print("Fetching the finalized block")
                 finalized_block_hash = substrate.get_chain_finalised_head()
                 finalized_block_number = substrate.get_block_number(finalized_block_hash)
+                self.finalized_block_number = finalized_block_number
+
+                print("Loading the Clickhouse schema")
+                catalogue.load()
+                set_shovel_name(self.name)
+
+                last_scraped_block_number = self.get_checkpoint()
+                if self.buffer_wal_dir:
+                    open_wal(os.path.join(self.buffer_wal_dir, self.name))
+                    replay_wal(self._restore_replayed_checkpoint)
+                    last_scraped_block_number = self.checkpoint_block_number
+                logging.info(f"Last scraped block is {last_scraped_block_number}")
 
                 # Start the clickhouse buffer
                 print("Starting Clickhouse buffer")
-                executor = ThreadPoolExecutor(max_workers=1)
+                executor = ThreadPoolExecutor(max_workers=self.flush_workers)
                 buffer_thread = threading.Thread(
                     target=flush_buffer,
                     args=(executor, self._buffer_flush_started, self._buffer_flush_done),
@@ -50,41 +154,38 @@ class ShovelBaseClass:
                 )
                 buffer_thread.start()
 
-                last_scraped_block_number = self.get_checkpoint()
-                logging.info(f"Last scraped block is {last_scraped_block_number}")
-
                 # Create a list of block numbers to scrape
                 while True:
                     try:
-                        block_numbers = list(range(
+                        block_numbers = self._scheduled_blocks(
                             last_scraped_block_number + 1,
-                            finalized_block_number + 1,
-                            self.skip_interval
-                        ))
+                            finalized_block_number
+                        )
 
                         if len(block_numbers) > 0:
                             logging.info(f"Catching up {len(block_numbers)} blocks")
-                            for block_number in tqdm(block_numbers):
-                                try:
-                                    self.process_block(block_number)
-                                    self.checkpoint_block_number = block_number
-                                except DatabaseConnectionError as e:
-                                    logging.error(f"Database connection error while processing block {block_number}: {str(e)}")
-                                    raise  # Re-raise to be caught by outer try-except
-                                except Exception as e:
-                                    logging.error(f"Fatal error while processing block {block_number}: {str(e)}")
-                                    raise ShovelProcessingError(f"Failed to process block {block_number}: {str(e)}")
+                            if self._should_coordinate_backfill(block_numbers):
+                                self._coordinated_backfill(block_numbers[0], block_numbers[-1])
+                            elif self._should_backfill_in_parallel(block_numbers):
+                                self._parallel_backfill(block_numbers)
+                            else:
+                                self._process_blocks(tqdm(block_numbers))
+                            request_flush()
                         else:
-                            logging.info("Already up to latest finalized block, checking again in 12s...")
+                            logging.info("Already up to latest finalized block")
 
                         # Reset retry count on successful iteration
                         retry_count = 0
 
-                        # Make sure to sleep so buffer with checkpoint update is flushed to Clickhouse
-                        sleep(12)
+                        if self.tail_mode == "subscribe":
+                            self._follow_finalized_heads()
+                        else:
+                            logging.info(f"Checking for new finalized blocks in {self.POLL_INTERVAL}s...")
+                            sleep(self.POLL_INTERVAL)
                         last_scraped_block_number = self.get_checkpoint()
                         finalized_block_hash = substrate.get_chain_finalised_head()
                         finalized_block_number = substrate.get_block_number(finalized_block_hash)
+                        self.finalized_block_number = finalized_block_number
 
                     except DatabaseConnectionError as e:
                         retry_count += 1
@@ -106,62 +207,401 @@ class ShovelBaseClass:
                 sys.exit(1)
 
     def process_block(self, n):
+        if self._is_async():
+            return run_async(self.process_block_async(n))
+        if self._is_pipelined():
+            return self.transform_block(n, self.fetch_block(n))
         raise NotImplementedError(
             "Please implement the process_block method in your shovel class!"
         )
 
+    def fetch_block(self, n):
+        """
+        Optional prefetch stage: do all of the archive node round-trips for block n and return
+        whatever `transform_block` needs. Must not touch the Clickhouse buffer.
+        """
+        raise NotImplementedError
+
+    def transform_block(self, n, fetched):
+        """
+        Optional transform stage: decode the result of `fetch_block` and `buffer_insert` it.
+        """
+        raise NotImplementedError
+
+    def _scheduled_blocks(self, start, end):
+        """
+        Returns the block numbers between start and end (inclusive) this shovel must process.
+        """
+        if self.block_schedule is None:
+            return list(range(start, end + 1, self.skip_interval))
+        return list(self.block_schedule(start, end))
+
+    def _is_scheduled(self, n):
+        return len(self._scheduled_blocks(n, n)) > 0
+
+    async def process_block_async(self, n):
+        """
+        Optional coroutine variant of `process_block`, run on a persistent event loop. Use
+        `shared.async_substrate.get_async_substrate_client()` to send many Substrate requests
+        concurrently, e.g. with `asyncio.gather`.
+        """
+        raise NotImplementedError
+
+    def _is_async(self):
+        return type(self).process_block_async is not ShovelBaseClass.process_block_async
+
+    def _is_pipelined(self):
+        return type(self).fetch_block is not ShovelBaseClass.fetch_block
+
+    def _timed_fetch_block(self, n):
+        with stage_timings.measure("fetch"):
+            return self.fetch_block(n)
+
+    def _process_blocks(self, block_numbers, on_block_done=None, advance_checkpoint=True):
+        if self._is_pipelined() and self.prefetch_depth > 0:
+            blocks = prefetch_blocks(
+                self._timed_fetch_block, block_numbers, self.prefetch_depth, self._get_prefetch_executor()
+            )
+        else:
+            blocks = ((block_number, None) for block_number in block_numbers)
+
+        for (block_number, fetched) in blocks:
+            self._process_block(block_number, fetched, advance_checkpoint)
+            if on_block_done is not None:
+                on_block_done()
+
+    def _get_prefetch_executor(self):
+        """
+        Threads fetching blocks ahead, kept for the life of the process and reused by every
+        catch-up range, backfill chunk and finalized head, so their Substrate clients are too.
+        """
+        if self.prefetch_executor is None or self.prefetch_executor_pid != os.getpid():
+            # A forked backfill worker doesn't inherit its parent's threads
+            self.prefetch_executor = ThreadPoolExecutor(
+                max_workers=self.prefetch_depth, thread_name_prefix="prefetch"
+            )
+            self.prefetch_executor_pid = os.getpid()
+        return self.prefetch_executor
+
+    def _wait_for_dependencies(self, block_number, dependencies=None):
+        if dependencies is None:
+            dependencies = self.dependencies
+        if dependencies:
+            checkpoint_watcher.wait_for(dependencies, block_number)
+
+    def _process_block(self, block_number, fetched=None, advance_checkpoint=True):
+        try:
+            self._wait_for_dependencies(block_number)
+            if self.finalized_block_number - block_number > self.tail_distance:
+                set_insert_profile(self.backfill_insert_profile)
+            else:
+                set_insert_profile(self.tail_insert_profile)
+            set_current_block(block_number)
+            if fetched is None:
+                with stage_timings.measure("process"):
+                    self.process_block(block_number)
+            else:
+                with stage_timings.measure("fetch_wait"):
+                    data = fetched.result()
+                with stage_timings.measure("transform"):
+                    self.transform_block(block_number, data)
+            if advance_checkpoint:
+                self.checkpoint_block_number = block_number
+                log_checkpoint(self.checkpoint_block_number)
+        except DatabaseConnectionError as e:
+            logging.error(f"Database connection error while processing block {block_number}: {str(e)}")
+            raise  # Re-raise to be caught by outer try-except
+        except Exception as e:
+            logging.error(f"Fatal error while processing block {block_number}: {str(e)}")
+            raise ShovelProcessingError(f"Failed to process block {block_number}: {str(e)}")
+
+    def _follow_finalized_heads(self):
+        """
+        Processes new blocks the moment they are finalized, driven by a
+        `chain_subscribeFinalizedHeads` subscription on a dedicated connection. The subscription
+        only queues the heads it receives and blocks are processed here, so processing errors
+        are raised just like when polling.
+
+        Only returns if the subscription drops, after waiting one poll interval so the caller
+        falls back to polling before subscribing again.
+        """
+        heads = queue.Queue()
+
+        def on_finalized_head(obj, update_nr, subscription_id):
+            finalized_block_number = obj["header"]["number"]
+            if isinstance(finalized_block_number, str):
+                finalized_block_number = int(finalized_block_number, 16)
+            heads.put((finalized_block_number, time.time()))
+
+        def subscribe():
+            try:
+                subscription_substrate.subscribe_block_headers(on_finalized_head, finalized_only=True)
+                heads.put(ConnectionError("Subscription ended"))
+            except Exception as e:
+                heads.put(e)
+
+        logging.info("Subscribing to finalized heads")
+        subscription_substrate = create_substrate_client()
+        subscription_thread = threading.Thread(target=subscribe, name="finalized-heads", daemon=True)
+        subscription_thread.start()
+        try:
+            while True:
+                head = heads.get()
+                if isinstance(head, SUBSCRIPTION_ERRORS):
+                    logging.warning(
+                        f"Finalized heads subscription dropped, falling back to polling in {self.POLL_INTERVAL}s: {str(head)}"
+                    )
+                    sleep(self.POLL_INTERVAL)
+                    return
+                if isinstance(head, Exception):
+                    raise head
+
+                (finalized_block_number, received_at) = head
+                self.finalized_block_number = finalized_block_number
+                block_numbers = self._scheduled_blocks(
+                    self.checkpoint_block_number + 1,
+                    finalized_block_number
+                )
+                for block_number in block_numbers:
+                    self.finalized_at.setdefault(block_number, received_at)
+                self._process_blocks(block_numbers)
+                # Don't keep a new block's rows waiting for the buffer to fill up
+                request_flush()
+        finally:
+            # Closes the subscription's connection too, which ends its thread
+            subscription_substrate.close()
+            subscription_thread.join(timeout=10)
+            if subscription_thread.is_alive():
+                logging.warning("Finalized heads subscription thread didn't stop after closing its connection")
+
+    def _report_finalization_latency(self, flushed_block_number):
+        now = time.time()
+        for block_number in [n for n in self.finalized_at if n <= flushed_block_number]:
+            latency = now - self.finalized_at.pop(block_number)
+            stage_timings.add("finalized_to_clickhouse", latency)
+            logging.info(f"Block {block_number} in Clickhouse {latency:.2f}s after finalization")
+
+    def _should_backfill_in_parallel(self, block_numbers):
+        return (
+            self.parallel_backfill
+            and self.backfill_workers > 1
+            and len(block_numbers) > self.backfill_chunk_size
+        )
+
+    def _parallel_backfill(self, block_numbers):
+        """
+        Splits the catch-up range into chunks and processes them in a pool of worker processes.
+
+        Workers flush their own buffer before reporting a chunk as complete, so the checkpoint
+        only ever advances over a contiguous run of completed chunks.
+        """
+        chunks = [
+            block_numbers[i:i + self.backfill_chunk_size]
+            for i in range(0, len(block_numbers), self.backfill_chunk_size)
+        ]
+        logging.info(
+            f"Backfilling {len(chunks)} chunks of {self.backfill_chunk_size} blocks with {self.backfill_workers} workers"
+        )
+
+        completed_chunks = set()
+        next_chunk = 0
+        with WorkerPool(n_jobs=self.backfill_workers, start_method="fork") as pool:
+            for chunk_index in pool.imap_unordered(
+                self._backfill_chunk,
+                list(enumerate(chunks)),
+                chunk_size=1,
+                worker_init=_backfill_worker_init,
+                progress_bar=True,
+            ):
+                completed_chunks.add(chunk_index)
+                while next_chunk in completed_chunks:
+                    completed_chunks.remove(next_chunk)
+                    self.checkpoint_block_number = chunks[next_chunk][-1]
+                    next_chunk += 1
+
+    def _backfill_chunk(self, chunk_index, block_numbers):
+        """
+        Runs inside a backfill worker process.
+        """
+        self._process_blocks(block_numbers, on_block_done=_drain_if_large(self.backfill_flush_rows))
+        drain_buffer()
+        return chunk_index
+
+    def _should_coordinate_backfill(self, block_numbers):
+        return (
+            self.backfill_coordination == "lease"
+            and self.parallel_backfill
+            and len(block_numbers) > self.backfill_chunk_size
+        )
+
+    def _coordinated_backfill(self, first_block, last_block):
+        """
+        Backfills first_block..last_block together with any other workers doing the same.
+
+        The range is cut into `backfill_chunk_size` ranges aligned to block 0, so every worker
+        agrees on range boundaries. Workers claim free or expired ranges, heartbeat their lease
+        while working, flush their rows and mark the range done. The checkpoint advances over
+        contiguous done ranges. Only whole ranges are coordinated; the remainder is left to the
+        normal catch-up loop.
+        """
+        create_lease_table()
+        owner = new_lease_owner()
+        size = self.backfill_chunk_size
+        first_range = first_block - first_block % size
+        ranges = [
+            (range_start, range_start + size - 1)
+            for range_start in range(first_range, last_block + 1, size)
+            if range_start + size - 1 <= last_block
+        ]
+        logging.info(f"Coordinating backfill of {len(ranges)} ranges as {owner}")
+
+        while True:
+            done_ranges = get_done_ranges(self.name, first_range)
+            self._advance_checkpoint_over_done_ranges(ranges, done_ranges)
+            pending = [r for r in ranges if r[0] not in done_ranges]
+            if not pending:
+                return
+
+            claimed_any = False
+            for (range_start, range_end) in pending:
+                claimed_at = claim_range(self.name, range_start, range_end, owner, self.backfill_lease_ttl)
+                if claimed_at is None:
+                    continue
+                claimed_any = True
+                self._backfill_leased_range(
+                    max(range_start, first_block), range_end, owner, claimed_at
+                )
+                done_ranges = get_done_ranges(self.name, first_range)
+                self._advance_checkpoint_over_done_ranges(ranges, done_ranges)
+
+            if not claimed_any:
+                # Everything left is leased by other workers. Wait for them to finish, or for
+                # their leases to expire.
+                sleep(min(30, self.backfill_lease_ttl / 4))
+
+    def _backfill_leased_range(self, first_block, range_end, owner, claimed_at):
+        range_start = first_block - first_block % self.backfill_chunk_size
+        lease_lost = threading.Event()
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(self.backfill_lease_ttl / 3):
+                if not renew_lease(self.name, range_start, range_end, owner, claimed_at, self.backfill_lease_ttl):
+                    lease_lost.set()
+                    return
+
+        def check_lease():
+            if lease_lost.is_set():
+                raise LeaseLost()
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            logging.info(f"Backfilling leased range {range_start}-{range_end}")
+            # Other workers may still be behind us, so the checkpoint only moves once ranges are done
+            self._process_blocks(
+                self._scheduled_blocks(first_block, range_end),
+                on_block_done=check_lease,
+                advance_checkpoint=False,
+            )
+            # The heartbeat may not have noticed yet, e.g. after this process was suspended
+            if not renew_lease(self.name, range_start, range_end, owner, claimed_at, self.backfill_lease_ttl):
+                raise LeaseLost()
+            drain_buffer()
+            complete_range(self.name, range_start, range_end, owner, claimed_at)
+        except LeaseLost:
+            # The worker that took the range over inserts its rows, so ours must not be flushed
+            discard_blocks(first_block, range_end)
+            logging.warning(f"Lost lease on range {range_start}-{range_end}, discarded its buffered rows, moving on")
+        finally:
+            stop_heartbeat.set()
+
+    def _advance_checkpoint_over_done_ranges(self, ranges, done_ranges):
+        for (range_start, range_end) in ranges:
+            if range_start not in done_ranges:
+                return
+            if range_end > self.checkpoint_block_number:
+                self.checkpoint_block_number = range_end
+
     def _buffer_flush_started(self):
         self.last_buffer_flush_call_block_number = self.checkpoint_block_number
+        self.last_buffer_flush_started_at = time.monotonic()
+
+    def _buffer_flush_done(self, tables, rows, ok=True):
+        if tables > 0:
+            stage_timings.add("insert", time.monotonic() - self.last_buffer_flush_started_at)
+        stage_timings.report()
 
-    def _buffer_flush_done(self, tables, rows):
         if self.last_buffer_flush_call_block_number == 0:
             return
 
+        if not ok:
+            logging.warning(
+                f"Not all inserts were acknowledged, holding checkpoint at {self.persisted_checkpoint_block_number}"
+            )
+            return
+
+        if self.finalized_at:
+            self._report_finalization_latency(self.last_buffer_flush_call_block_number)
+
         print(
             f"Block {self.last_buffer_flush_call_block_number}: Flushed {
                 rows} rows across {tables} tables to Clickhouse"
         )
 
-        # Create checkpoint table if it doesn't exist
-        if not table_exists("shovel_checkpoints"):
-            query = """
-            CREATE TABLE IF NOT EXISTS shovel_checkpoints (
-                shovel_name String,
-                block_number UInt64
-            ) ENGINE = ReplacingMergeTree()
-            ORDER BY (shovel_name)
-            """
-            get_clickhouse_client().execute(query)
-
-        # Update checkpoint
-        buffer_insert(
-            "shovel_checkpoints",
-            [f"'{self.name}'", self.last_buffer_flush_call_block_number],
-        )
+        self._save_checkpoint(self.last_buffer_flush_call_block_number)
+
+    def _save_checkpoint(self, block_number):
+        if block_number <= self.persisted_checkpoint_block_number:
+            return
+        try:
+            write_checkpoint(self.name, block_number)
+            self.persisted_checkpoint_block_number = block_number
+            checkpoint_watcher.publish(self.name, block_number)
+        except Exception as e:
+            logging.error(f"Failed to persist checkpoint {block_number}, will retry: {str(e)}")
+
+    def _restore_replayed_checkpoint(self, block_number):
+        if block_number > self.checkpoint_block_number:
+            logging.info(f"Restored buffered rows up to block {block_number} from the write-ahead log")
+            self.checkpoint_block_number = block_number
+        self._buffer_flush_started()
+        self._save_checkpoint(self.checkpoint_block_number)
 
     def get_checkpoint(self):
-        if not table_exists("shovel_checkpoints"):
-            return max(0, self.starting_block - 1)
-
-        # First check if our shovel has any entries
-        query = f"""
-            SELECT count(*)
-            FROM shovel_checkpoints
-            WHERE shovel_name = '{self.name}'
-        """
-        count = get_clickhouse_client().execute(query)[0][0]
-        if count == 0:
-            return max(0, self.starting_block - 1)
-
-        query = f"""
-            SELECT block_number
-            FROM shovel_checkpoints
-            WHERE shovel_name = '{self.name}'
-            ORDER BY block_number DESC
-            LIMIT 1
-        """
-        res = get_clickhouse_client().execute(query)
-        if res:
-            return res[0][0]
-        else:
-            return max(0, self.starting_block - 1)  # This case shouldn't happen due to count check above
+        """
+        Returns the last processed block. Clickhouse is only read the first time; after that the
+        in-memory checkpoint is authoritative.
+        """
+        if not self.checkpoint_loaded:
+            persisted = read_checkpoint(self.name)
+            if persisted is None:
+                self.checkpoint_block_number = max(0, self.starting_block - 1)
+            else:
+                self.checkpoint_block_number = persisted
+                self.persisted_checkpoint_block_number = persisted
+            self.checkpoint_loaded = True
+        return self.checkpoint_block_number
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def _drain_if_large(max_rows):
+    def drain():
+        if buffered_row_count() >= max_rows:
+            drain_buffer()
+    return drain
+
+
+def _backfill_worker_init():
+    """
+    Forked workers inherit the parent's clients and unflushed rows. Drop them so every worker
+    talks to Substrate and Clickhouse over its own connections and only flushes its own rows.
+    """
+    reset_buffer()
+    disable_wal()
+    reset_clickhouse_client()
+    reconnect_substrate()
+    reset_async_substrate()
@@ -0,0 +1,182 @@
+from shared.block_metadata import block_cache, get_block_events, get_block_metadata
+from shared.block_schedule import merge_schedules
+from shared.clickhouse.batch_insert import drain_buffer, log_checkpoint, set_current_block
+from shared.clickhouse.dedup import DEDUP_WINDOW_BLOCKS
+from shared.shovel_base_class import ShovelBaseClass
+import importlib
+import logging
+import os
+
+
+class ShovelHost(ShovelBaseClass):
+    """
+    Runs several shovels in one process.
+
+    Each block's hash, timestamp and (if any hosted shovel needs them) System.Events are
+    fetched once into the shared block cache and then every hosted shovel processes the block,
+    reading that data from the cache instead of the archive node. Each hosted shovel keeps its
+    own checkpoint and is only handed blocks past it.
+
+    Hosted shovels run upstream first. A shovel that depends on a co-hosted shovel is deferred:
+    its blocks are run every `dependency_batch_blocks` blocks, and whenever a deduplication
+    window or the range being processed ends, after a single drain of the buffer puts the
+    upstream rows in Clickhouse. A chain of co-hosted dependencies takes one drain per link.
+    """
+
+    dependency_batch_blocks = int(os.getenv("HOST_DEPENDENCY_BATCH_BLOCKS", "32"))
+
+    def __init__(self, shovels, name="host"):
+        super().__init__(name)
+        self.shovels = _upstream_first(shovels)
+        self.hosted_names = {shovel.name for shovel in shovels}
+        self.levels = _dependency_levels(self.shovels)
+        self.parallel_backfill = all(shovel.parallel_backfill for shovel in shovels)
+        self.uses_block_events = any(shovel.uses_block_events for shovel in shovels)
+        # Blocks processed by the host itself, and those still to be run by deferred shovels
+        self.scanned_block_number = 0
+        self.deferred_blocks = []
+        self.advance_hosted_checkpoints = True
+        if any(self.levels.values()):
+            # Keep deferred blocks' hash, timestamp and events cached until they are run
+            block_cache.size = max(block_cache.size, 3 * (self.dependency_batch_blocks + self.prefetch_depth))
+        logging.info(f"Hosting shovels: {', '.join(shovel.name for shovel in shovels)}")
+
+    @property
+    def checkpoint_block_number(self):
+        if self.deferred_blocks:
+            return min(self.scanned_block_number, self.deferred_blocks[0] - 1)
+        return self.scanned_block_number
+
+    @checkpoint_block_number.setter
+    def checkpoint_block_number(self, block_number):
+        # Hosted shovels advance their own checkpoints as they run, see `_run_hosted`
+        self.scanned_block_number = block_number
+
+    def get_checkpoint(self):
+        if not self.checkpoint_loaded:
+            for shovel in self.shovels:
+                shovel.get_checkpoint()
+                logging.info(f"Last scraped block for {shovel.name} is {shovel.checkpoint_block_number}")
+            self.scanned_block_number = min(shovel.checkpoint_block_number for shovel in self.shovels)
+            self.checkpoint_loaded = True
+        return self.checkpoint_block_number
+
+    def _scheduled_blocks(self, start, end):
+        # Every block is needed as soon as one hosted shovel walks every block
+        if any(shovel.block_schedule is None for shovel in self.shovels):
+            return super()._scheduled_blocks(start, end)
+        return list(merge_schedules(
+            shovel._scheduled_blocks(max(start, shovel.checkpoint_block_number + 1), end)
+            for shovel in self.shovels
+        ))
+
+    def fetch_block(self, n):
+        (block_timestamp, block_hash) = get_block_metadata(n)
+        if self.uses_block_events:
+            get_block_events(n, block_hash)
+
+    def _process_blocks(self, block_numbers, on_block_done=None, advance_checkpoint=True):
+        super()._process_blocks(block_numbers, on_block_done, advance_checkpoint)
+        self._run_deferred()
+
+    def _process_block(self, block_number, fetched=None, advance_checkpoint=True):
+        # Deferred blocks are run before the next window starts, so their rows are buffered
+        # under their own window
+        if self.deferred_blocks and (
+            len(self.deferred_blocks) >= self.dependency_batch_blocks
+            or block_number // DEDUP_WINDOW_BLOCKS != self.deferred_blocks[0] // DEDUP_WINDOW_BLOCKS
+        ):
+            self._run_deferred()
+        self.advance_hosted_checkpoints = advance_checkpoint
+        super()._process_block(block_number, fetched, advance_checkpoint)
+
+    def transform_block(self, n, fetched):
+        deferred = False
+        for shovel in self.shovels:
+            if self.levels[shovel.name] == 0:
+                self._run_hosted(shovel, n)
+            elif self._needs_block(shovel, n):
+                deferred = True
+        if deferred and (not self.deferred_blocks or n > self.deferred_blocks[-1]):
+            self.deferred_blocks.append(n)
+
+    def _run_deferred(self):
+        """
+        Runs the deferred shovels over the deferred blocks, one dependency level at a time, each
+        after draining the buffer. If a drain fails its rows are requeued and the blocks stay
+        deferred, holding back the checkpoint.
+        """
+        if not self.deferred_blocks:
+            return
+        for level in range(1, max(self.levels.values()) + 1):
+            drain_buffer()
+            for n in self.deferred_blocks:
+                set_current_block(n)
+                for shovel in self.shovels:
+                    if self.levels[shovel.name] == level:
+                        self._run_hosted(shovel, n)
+        self.deferred_blocks = []
+        if self.advance_hosted_checkpoints:
+            log_checkpoint(self.checkpoint_block_number)
+
+    def _needs_block(self, shovel, n):
+        return n > shovel.checkpoint_block_number and shovel._is_scheduled(n)
+
+    def _run_hosted(self, shovel, n):
+        if not self._needs_block(shovel, n):
+            return
+        shovel._wait_for_dependencies(n, [
+            dependency for dependency in shovel.dependencies
+            if dependency not in self.hosted_names
+        ])
+        shovel.process_block(n)
+        if self.advance_hosted_checkpoints:
+            shovel.checkpoint_block_number = n
+
+    def _save_checkpoint(self, block_number):
+        # Every hosted shovel has run, or isn't scheduled at, the blocks up to block_number
+        for shovel in self.shovels:
+            shovel._save_checkpoint(block_number)
+
+
+def _upstream_first(shovels):
+    by_name = {shovel.name: shovel for shovel in shovels}
+    ordered = []
+
+    def visit(shovel, path):
+        if shovel in ordered:
+            return
+        if shovel.name in path:
+            raise ValueError(f"Circular dependency between hosted shovels: {' -> '.join(path)}")
+        for dependency in shovel.dependencies:
+            if dependency in by_name:
+                visit(by_name[dependency], path + [shovel.name])
+        ordered.append(shovel)
+
+    for shovel in shovels:
+        visit(shovel, [])
+    return ordered
+
+
+def _dependency_levels(shovels):
+    """
+    Returns {shovel_name: level}, 0 for shovels with no co-hosted dependency and otherwise one
+    more than their deepest co-hosted dependency. Expects shovels upstream first.
+    """
+    levels = {}
+    for shovel in shovels:
+        levels[shovel.name] = max(
+            (levels[dependency] + 1 for dependency in shovel.dependencies if dependency in levels),
+            default=0,
+        )
+    return levels
+
+
+def load_shovel(spec):
+    """
+    Instantiates a shovel from a "module:ClassName:shovel_name" spec, e.g.
+    "shovel_events.main:EventsShovel:events".
+    """
+    (module_name, class_name, shovel_name) = spec.strip().split(":")
+    shovel_class = getattr(importlib.import_module(module_name), class_name)
+    return shovel_class(name=shovel_name)
@@ -1,25 +1,247 @@
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import lru_cache
+from shared.endpoints import get_endpoint_pool
 from substrateinterface import SubstrateInterface
+from substrateinterface.exceptions import SubstrateRequestException
+from substrateinterface.storage import StorageKey
 import threading
+import time
 
 thread_local = threading.local()
 
+# Seconds a websocket waits for a node's reply before the request fails over to the next node
+REQUEST_TIMEOUT = float(os.getenv("SUBSTRATE_REQUEST_TIMEOUT", "60"))
+
+
+def _is_node_error(e):
+    # A JSON-RPC error object is the node's answer, anything else (e.g. an HTTP 502) isn't
+    return isinstance(e, SubstrateRequestException) and bool(e.args) and isinstance(e.args[0], dict)
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class RequestAttempt:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.monotonic()
+        self.connection = None
+        self.abandoned = False
+
+
+class RoutedSubstrateInterface(SubstrateInterface):
+    """
+    `SubstrateInterface` spread over every archive node of the endpoint pool. Each RPC request
+    goes to the fastest healthy node for its method, and fails over to the next one if the node
+    can't be reached or stops responding. A request unanswered after its hedge delay is also
+    sent to the next node, the first reply wins and the slower request is abandoned.
+
+    Subscriptions stay on the node they started on. Errors the node answers with (e.g. an
+    unknown block) are raised as they are, without trying another node.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        # Idle connection to each node, {url: SubstrateInterface}, used only for `rpc_request`
+        self.connections = {}
+        # Requests whose connection is taken out of `connections`, e.g. a running subscription
+        self.active_attempts = set()
+        self.active_attempts_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2 * len(pool.endpoints))
+        super().__init__(url=pool.endpoints[0].url)
+
+    def connect_websocket(self):
+        # Connections to the nodes are opened when first used
+        pass
+
+    def close(self):
+        """
+        Closes every connection, including those of requests still running, so a subscription
+        waiting for its next notification fails straight away.
+        """
+        with self.active_attempts_lock:
+            active = list(self.active_attempts)
+        for attempt in active:
+            self._abandon(attempt)
+        for connection in self.connections.values():
+            _close(connection)
+        self.connections = {}
+        self.executor.shutdown(wait=False)
+        self.extensions.unregister_all()
+
+    def rpc_request(self, method, params, result_handler=None):
+        if result_handler is not None:
+            attempt = RequestAttempt(self.pool.ranked(method)[0])
+            try:
+                return self._send(attempt, method, params, result_handler)
+            except Exception as e:
+                if not _is_node_error(e):
+                    self.pool.record_failure(attempt.endpoint, e)
+                raise
+        # Runtime API calls vary the most in cost, so each is timed separately
+        timed_method = f"{method} {params[0]}" if method == "state_call" and params else method
+        return self._routed_request(timed_method, method, params)
+
+    def _routed_request(self, timed_method, method, params):
+        candidates = self.pool.ranked(timed_method)
+        pending = {}
+        last_error = None
+        launch = True
+        while True:
+            if launch and candidates:
+                attempt = RequestAttempt(candidates.pop(0))
+                pending[self.executor.submit(self._send, attempt, method, params)] = attempt
+                delay = self.pool.hedge_delay(attempt.endpoint, timed_method)
+            if not pending:
+                raise last_error
+
+            (done, _) = wait(pending, timeout=delay if candidates else None, return_when=FIRST_COMPLETED)
+            # Hedge when nothing answered in time, fail over at once when a node failed
+            launch = not done
+            for future in done:
+                attempt = pending.pop(future)
+                error = future.exception()
+                if error is not None and not _is_node_error(error):
+                    self.pool.record_failure(attempt.endpoint, error)
+                    last_error = error
+                    launch = True
+                    continue
+
+                self.pool.record_latency(attempt.endpoint, timed_method, time.monotonic() - attempt.started)
+                for other in pending.values():
+                    self.pool.record_latency(other.endpoint, timed_method, time.monotonic() - other.started)
+                    self._abandon(other)
+                if error is not None:
+                    raise error
+                return future.result()
+
+    def _send(self, attempt, method, params, result_handler=None):
+        url = attempt.endpoint.url
+        connection = self.connections.pop(url, None)
+        if connection is None:
+            connection = SubstrateInterface(
+                url, auto_discover=False, ws_options={"timeout": REQUEST_TIMEOUT}
+            )
+        attempt.connection = connection
+        with self.active_attempts_lock:
+            self.active_attempts.add(attempt)
+        reusable = True
+        try:
+            return connection.rpc_request(method, params, result_handler)
+        except Exception as e:
+            reusable = _is_node_error(e)
+            raise
+        finally:
+            with self.active_attempts_lock:
+                self.active_attempts.discard(attempt)
+            if reusable and not attempt.abandoned:
+                self.connections[url] = connection
+            else:
+                _close(connection)
+
+    def _abandon(self, attempt):
+        """
+        Stops waiting on a slower hedged request: its websocket is shut so the request fails
+        straight away and the connection is thrown away rather than reused.
+        """
+        attempt.abandoned = True
+        connection = attempt.connection
+        if connection is not None and connection.websocket is not None:
+            try:
+                connection.websocket.shutdown()
+            except Exception:
+                pass
+
+
+def create_substrate_client():
+    """
+    Returns a new, unshared `SubstrateInterface` routed over every archive node. Prefer
+    `get_substrate_client` unless you need a dedicated connection, e.g. for a long-running
+    subscription.
+    """
+    return RoutedSubstrateInterface(get_endpoint_pool())
+
 
 def get_substrate_client():
     if not hasattr(thread_local, "client"):
-        url = os.getenv("SUBSTRATE_ARCHIVE_NODE_URL")
-        thread_local.client = SubstrateInterface(url)
+        thread_local.client = create_substrate_client()
+        thread_local.client_pid = os.getpid()
     return thread_local.client
 
 
+def get_block_hashes(block_numbers):
+    """
+    Returns the hashes of block_numbers, None for blocks the node doesn't have yet, in a single
+    request: `chain_getBlockHash` also takes a list of block numbers.
+    """
+    if not block_numbers:
+        return []
+    response = get_substrate_client().rpc_request("chain_getBlockHash", [list(block_numbers)])
+    return response["result"]
+
+
 def reconnect_substrate():
+    """
+    Replaces this thread's client with a new one, closing the old one's connections. A forked
+    child (e.g. a backfill worker) only drops the client it inherited, as its connections are
+    still its parent's.
+    """
     print("Reconnecting Substrate...")
     if hasattr(thread_local, "client"):
+        client = thread_local.client
         del thread_local.client
+        if thread_local.client_pid == os.getpid():
+            client.close()
     get_substrate_client()
 
 
 @lru_cache
 def create_storage_key_cached(pallet, storage, args):
     return get_substrate_client().create_storage_key(pallet, storage, list(args))
+
+
+# Storage keys read per `state_queryStorageAt` request
+QUERY_BATCH_SIZE = int(os.getenv("SUBSTRATE_QUERY_BATCH_SIZE", "500"))
+
+
+# Storage keys kept by `create_storage_key_at`, across all runtime versions
+STORAGE_KEY_CACHE_SIZE = int(os.getenv("SUBSTRATE_STORAGE_KEY_CACHE_SIZE", "100000"))
+
+
+@lru_cache(maxsize=STORAGE_KEY_CACHE_SIZE)
+def create_storage_key_at(runtime_version, pallet, storage, args):
+    """
+    Builds a storage key with the metadata of runtime_version, which this thread's client must
+    currently be initialized at, see `query_storage_batch`.
+    """
+    substrate = get_substrate_client()
+    return StorageKey.create_from_storage_function(
+        pallet, storage, list(args), runtime_config=substrate.runtime_config, metadata=substrate.metadata
+    )
+
+
+def query_storage_batch(items, block_hash):
+    """
+    Reads several storage entries at block_hash with one `state_queryStorageAt` request per
+    QUERY_BATCH_SIZE keys, instead of a `query` round-trip each.
+
+    items are (pallet, storage, params) tuples. Returns their decoded values in the same order,
+    with the storage default (None for optional entries) where nothing is stored. Keys are
+    built and values decoded with the metadata of the runtime at block_hash.
+    """
+    substrate = get_substrate_client()
+    substrate.init_runtime(block_hash=block_hash)
+    keys = [
+        create_storage_key_at(substrate.runtime_version, pallet, storage, tuple(params))
+        for (pallet, storage, params) in items
+    ]
+    values = {}
+    for i in range(0, len(keys), QUERY_BATCH_SIZE):
+        for (storage_key, value) in substrate.query_multi(keys[i:i + QUERY_BATCH_SIZE], block_hash=block_hash):
+            values[storage_key.to_hex()] = value.value
+    return [values.get(key.to_hex()) for key in keys]
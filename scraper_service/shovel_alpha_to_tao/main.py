@@ -1,6 +1,7 @@
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.batch_insert import buffer_insert_many
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.shovel_base_class import ShovelBaseClass
-from shared.substrate import get_substrate_client
+from shared.substrate import get_substrate_client, query_storage_batch
 from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
@@ -39,6 +40,7 @@ def do_process_block(self, n):
                 ) ENGINE = ReplacingMergeTree()
                 PARTITION BY toYYYYMM(timestamp)
                 ORDER BY (block_number, netuid)
+                {DEDUP_TABLE_SETTINGS}
                 """
                 get_clickhouse_client().execute(query)
         except Exception as e:
@@ -60,29 +62,24 @@ def do_process_block(self, n):
             )
             networks = [int(net[0].value) for net in networks_added]
 
+            # Read every subnet's TAO and alpha reserves in one request
+            reserves = query_storage_batch(
+                [('SubtensorModule', storage, [netuid]) for netuid in networks for storage in ('SubnetTAO', 'SubnetAlphaIn')],
+                block_hash,
+            )
+
             # Process each subnet
-            for netuid in networks:
-                subnet_tao = substrate.query(
-                    'SubtensorModule',
-                    'SubnetTAO',
-                    [netuid],
-                    block_hash=block_hash
-                ).value / 1e9
-
-                subnet_alpha_in = substrate.query(
-                    'SubtensorModule',
-                    'SubnetAlphaIn',
-                    [netuid],
-                    block_hash=block_hash
-                ).value / 1e9
+            rows = []
+            for (i, netuid) in enumerate(networks):
+                subnet_tao = reserves[2 * i] / 1e9
+                subnet_alpha_in = reserves[2 * i + 1] / 1e9
 
                 # Calculate exchange rate (TAO per Alpha)
                 alpha_to_tao = 1 if netuid == 0 else (subnet_tao / subnet_alpha_in if subnet_alpha_in > 0 else 0)
 
-                buffer_insert(
-                    self.table_name,
-                    [n, block_timestamp, netuid, alpha_to_tao]
-                )
+                rows.append([n, block_timestamp, netuid, alpha_to_tao])
+
+            buffer_insert_many(self.table_name, rows)
 
         except Exception as e:
             raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
@@ -1,4 +1,8 @@
+from shared.block_metadata import get_block_hash
 from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
+from shared.clickhouse.schema import catalogue
+from shared.header_index import header_index
 from shared.shovel_base_class import ShovelBaseClass
 from shared.substrate import get_substrate_client
 from shared.clickhouse.utils import (
@@ -34,16 +38,25 @@ def do_process_block(self, n):
                 CREATE TABLE IF NOT EXISTS {self.table_name} (
                     block_number UInt64 CODEC(Delta, ZSTD),
                     timestamp DateTime CODEC(Delta, ZSTD),
+                    block_hash String CODEC(ZSTD),
                 ) ENGINE = ReplacingMergeTree()
                 PARTITION BY toYYYYMM(timestamp)
                 ORDER BY block_number
+                {DEDUP_TABLE_SETTINGS}
                 """
                 get_clickhouse_client().execute(query)
+                catalogue.refresh(self.table_name)
+            elif not any(name == "block_hash" for (name, _) in catalogue.columns(self.table_name)):
+                # Hashes are stored so other shovels don't have to ask the chain for them
+                get_clickhouse_client().execute(
+                    f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS block_hash String CODEC(ZSTD)"
+                )
+                catalogue.refresh(self.table_name)
         except Exception as e:
             raise DatabaseConnectionError(f"Failed to create/check table: {str(e)}")
 
         try:
-            block_hash = substrate.get_block_hash(n)
+            block_hash = get_block_hash(n)
             block_timestamp = int(
                 substrate.query(
                     "Timestamp",
@@ -59,10 +72,13 @@ def do_process_block(self, n):
             raise ShovelProcessingError(f"Invalid block timestamp (0) for block {n}")
 
         try:
-            buffer_insert(self.table_name, [n, block_timestamp])
+            buffer_insert(self.table_name, [n, block_timestamp, block_hash])
         except Exception as e:
             raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
+        if header_index is not None:
+            header_index.put(n, block_hash, block_timestamp)
+
     except (DatabaseConnectionError, ShovelProcessingError):
         # Re-raise these exceptions to be handled by the base class
         raise
@@ -1,9 +1,11 @@
 import logging
 
 from shared.block_metadata import get_block_metadata
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.batch_insert import buffer_insert_many
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.clickhouse.utils import get_clickhouse_client, table_exists
 from shared.shovel_base_class import ShovelBaseClass
+from shared.block_schedule import every_n_blocks
 from shared.substrate import get_substrate_client, reconnect_substrate
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 
@@ -14,14 +16,13 @@ BLOCKS_PER_DAY = 7200
 
 class BalanceDailyMapShovel(ShovelBaseClass):
     table_name = "shovel_balance_daily_map"
+    block_schedule = staticmethod(every_n_blocks(BLOCKS_PER_DAY))
 
     def process_block(self, n):
         do_process_block(n, self.table_name)
 
 
 def do_process_block(n, table_name):
-    if n % BLOCKS_PER_DAY != 0:
-        return
     try:
         # Create table if it doesn't exist
         try:
@@ -37,6 +38,7 @@ def do_process_block(n, table_name):
                 ) ENGINE = ReplacingMergeTree()
                 PARTITION BY toYYYYMM(timestamp)
                 ORDER BY (address, timestamp)
+                {DEDUP_TABLE_SETTINGS}
                 """
                 get_clickhouse_client().execute(query)
         except Exception as e:
@@ -58,11 +60,10 @@ def do_process_block(n, table_name):
         logging.info(f"Processing block {n}. Found {len(results)} balance entries")
 
         try:
-            for address, balance in results.items():
-                buffer_insert(
-                    table_name,
-                    [n, block_timestamp, f"'{address}'", balance["free"], balance["reserved"], balance["frozen"]]
-                )
+            buffer_insert_many(table_name, [
+                [n, block_timestamp, address, balance["free"], balance["reserved"], balance["frozen"]]
+                for address, balance in results.items()
+            ])
         except Exception as e:
             raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
@@ -2,9 +2,11 @@ import logging
 
 import rust_bindings
 from shared.block_metadata import get_block_metadata
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.batch_insert import buffer_insert_many
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.clickhouse.utils import get_clickhouse_client, table_exists
 from shared.shovel_base_class import ShovelBaseClass
+from shared.block_schedule import every_n_blocks
 from shared.substrate import reconnect_substrate
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 
@@ -15,14 +17,13 @@ BLOCKS_PER_DAY = 7200
 
 class StakeDailyMapShovel(ShovelBaseClass):
     table_name = "shovel_stake_daily_map"
+    block_schedule = staticmethod(every_n_blocks(BLOCKS_PER_DAY))
 
     def process_block(self, n):
         do_process_block(n, self.table_name)
 
 
 def do_process_block(n, table_name):
-    if n % BLOCKS_PER_DAY != 0:
-        return
     try:
         # Create table if it doesn't exist
         try:
@@ -37,6 +38,7 @@ def do_process_block(n, table_name):
                 ) ENGINE = ReplacingMergeTree()
                 PARTITION BY toYYYYMM(timestamp)
                 ORDER BY (coldkey, hotkey, timestamp)
+                {DEDUP_TABLE_SETTINGS}
                 """
                 get_clickhouse_client().execute(query)
         except Exception as e:
@@ -58,13 +60,12 @@ def do_process_block(n, table_name):
         logging.info(f"Processing block {n}. Found {len(results)} stake entries")
 
         try:
+            rows = []
             for result in results:
                 coldkey, stake = result[1][0]  # First element is hotkey, second is list of (coldkey, stake) pairs
                 hotkey = result[0]
-                buffer_insert(
-                    table_name,
-                    [n, block_timestamp, f"'{coldkey}'", f"'{hotkey}'", stake]
-                )
+                rows.append([n, block_timestamp, coldkey, hotkey, stake])
+            buffer_insert_many(table_name, rows)
         except Exception as e:
             raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
@@ -1,5 +1,9 @@
+use futures::future::select_ok;
+use pyo3::exceptions::{PyConnectionError, PyTimeoutError};
 use pyo3::prelude::*;
+use std::future::Future;
 use std::sync::Arc;
+use std::time::Duration;
 use subxt::{
     backend::{legacy::LegacyBackend, rpc::RpcClient},
     utils::{AccountId32, H256},
@@ -9,21 +13,87 @@ use subxt::{
 #[subxt::subxt(runtime_metadata_path = "./metadata.scale")]
 pub mod subtensor {}
 
-async fn get_api() -> OnlineClient<PolkadotConfig> {
-    let url = std::env::var("SUBSTRATE_ARCHIVE_NODE_URL").unwrap();
-    let client = RpcClient::from_insecure_url(url.clone())
+/// Archive node URLs from SUBSTRATE_ARCHIVE_NODE_URLS (comma-separated), or the single
+/// SUBSTRATE_ARCHIVE_NODE_URL.
+fn archive_node_urls() -> Vec<String> {
+    std::env::var("SUBSTRATE_ARCHIVE_NODE_URLS")
+        .or_else(|_| std::env::var("SUBSTRATE_ARCHIVE_NODE_URL"))
+        .unwrap_or_default()
+        .split(',')
+        .map(|url| url.trim().to_string())
+        .filter(|url| !url.is_empty())
+        .collect()
+}
+
+fn env_seconds(name: &str, default: f64) -> Duration {
+    let seconds = std::env::var(name)
+        .ok()
+        .and_then(|value| value.parse().ok())
+        .unwrap_or(default);
+    Duration::from_secs_f64(seconds)
+}
+
+fn rpc_error<E: std::fmt::Display>(e: E) -> PyErr {
+    PyConnectionError::new_err(e.to_string())
+}
+
+async fn connect(url: String) -> Result<(String, OnlineClient<PolkadotConfig>), String> {
+    let attempt = async {
+        let client = RpcClient::from_insecure_url(url.clone())
+            .await
+            .map_err(|e| e.to_string())?;
+        let backend = LegacyBackend::<PolkadotConfig>::builder()
+            .storage_page_size(1000)
+            .build(client);
+        OnlineClient::from_backend(Arc::new(backend))
+            .await
+            .map_err(|e| e.to_string())
+    };
+    let connected = tokio::time::timeout(env_seconds("SUBSTRATE_CONNECT_TIMEOUT", 30.0), attempt).await;
+    match connected {
+        Ok(Ok(api)) => Ok((url, api)),
+        Ok(Err(e)) => Err(format!("{}: {}", url, e)),
+        Err(_) => Err(format!("{}: timed out", url)),
+    }
+}
+
+/// Connects to every archive node at once and keeps the first one ready, i.e. the one that
+/// answered the metadata and runtime version requests fastest. Nodes that are down or don't
+/// answer within SUBSTRATE_CONNECT_TIMEOUT are skipped.
+async fn get_api_with_url() -> PyResult<(String, OnlineClient<PolkadotConfig>)> {
+    let urls = archive_node_urls();
+    if urls.is_empty() {
+        return Err(PyConnectionError::new_err(
+            "No archive node configured, set SUBSTRATE_ARCHIVE_NODE_URLS",
+        ));
+    }
+    select_ok(urls.into_iter().map(|url| Box::pin(connect(url))))
         .await
-        .expect("Failed to connect to node");
-    let backend = LegacyBackend::<PolkadotConfig>::builder()
-        .storage_page_size(1000)
-        .build(client);
-    OnlineClient::from_backend(Arc::new(backend)).await.unwrap()
+        .map(|(connected, _)| connected)
+        .map_err(|e| rpc_error(format!("No archive node reachable, last error: {}", e)))
+}
+
+async fn get_api() -> PyResult<OnlineClient<PolkadotConfig>> {
+    Ok(get_api_with_url().await?.1)
+}
+
+/// The next storage entry of an iteration, failing instead of waiting forever when the node
+/// doesn't send it within SUBSTRATE_REQUEST_TIMEOUT.
+async fn next_kv<T, E: std::fmt::Display>(
+    next: impl Future<Output = Option<Result<T, E>>>,
+) -> PyResult<Option<T>> {
+    match tokio::time::timeout(env_seconds("SUBSTRATE_REQUEST_TIMEOUT", 60.0), next).await {
+        Ok(None) => Ok(None),
+        Ok(Some(Ok(kv))) => Ok(Some(kv)),
+        Ok(Some(Err(e))) => Err(rpc_error(e)),
+        Err(_) => Err(PyTimeoutError::new_err("Archive node stopped responding")),
+    }
 }
 
 async fn query_block_stakes_inner(
     block_hash: String,
 ) -> PyResult<Vec<(String, Vec<(String, u64)>)>> {
-    let api = get_api().await;
+    let api = get_api().await?;
     let block_hash = hex::decode(block_hash.trim_start_matches("0x")).expect("Decoding failed");
     let block_hash = H256::from_slice(&block_hash);
     let query = subtensor::storage().subtensor_module().stake_iter();
@@ -32,10 +102,10 @@ async fn query_block_stakes_inner(
         .at(block_hash.clone())
         .iter(query)
         .await
-        .unwrap();
+        .map_err(rpc_error)?;
     let mut kvs: Vec<(String, Vec<(String, u64)>)> = Vec::new();
 
-    while let Some(Ok(kv)) = iter.next().await {
+    while let Some(kv) = next_kv(iter.next()).await? {
         let coldkey_bytes: [u8; 32] = kv.key_bytes[kv.key_bytes.len() - 64..kv.key_bytes.len() - 32].try_into().unwrap();
         let hotkey_bytes: [u8; 32] = kv.key_bytes[kv.key_bytes.len() - 32..].try_into().unwrap();
         let coldkey = AccountId32::from(coldkey_bytes).to_string();
@@ -1,5 +1,5 @@
-from shared.block_metadata import get_block_metadata
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.block_metadata import get_block_events, get_block_metadata
+from shared.clickhouse.batch_insert import buffer_insert_tables
 from shared.shovel_base_class import ShovelBaseClass
 from shared.substrate import get_substrate_client, reconnect_substrate
 from shared.clickhouse.utils import (
@@ -20,35 +20,41 @@ logging.basicConfig(level=logging.INFO,
 
 
 class EventsShovel(ShovelBaseClass):
-    def process_block(self, n):
-        do_process_block(n)
+    uses_block_events = True
+
+    def fetch_block(self, n):
+        return fetch_block_events(n)
+
+    def transform_block(self, n, fetched):
+        (block_timestamp, events) = fetched
+        do_process_block(n, block_timestamp, events)
 
 
 def main():
     EventsShovel(name="events").start()
 
 
-def do_process_block(n):
+def fetch_block_events(n):
     try:
-        try:
-            substrate = get_substrate_client()
-            (block_timestamp, block_hash) = get_block_metadata(n)
-        except Exception as e:
-            raise ShovelProcessingError(f"Failed to initialize block processing: {str(e)}")
+        (block_timestamp, block_hash) = get_block_metadata(n)
+    except Exception as e:
+        raise ShovelProcessingError(f"Failed to initialize block processing: {str(e)}")
 
-        try:
-            events = substrate.query(
-                "System",
-                "Events",
-                block_hash=block_hash,
-            )
-            if not events and n != 0:
-                raise ShovelProcessingError(f"No events returned for block {n}")
-        except Exception as e:
-            raise ShovelProcessingError(f"Failed to fetch events from substrate: {str(e)}")
+    try:
+        events = get_block_events(n, block_hash)
+        if not events and n != 0:
+            raise ShovelProcessingError(f"No events returned for block {n}")
+    except Exception as e:
+        raise ShovelProcessingError(f"Failed to fetch events from substrate: {str(e)}")
 
+    return (block_timestamp, events)
+
+
+def do_process_block(n, block_timestamp, events):
+    try:
         # Needed to handle edge case of duplicate events in the same block
         event_id = 0
+        rows_by_table = {}
         for e in events:
             try:
                 event = e.value["event"]
@@ -70,17 +76,13 @@ def do_process_block(n):
                 except Exception as e:
                     raise DatabaseConnectionError(f"Failed to create/check table {table_name}: {str(e)}")
 
-                try:
-                    # Insert event data into table
-                    all_values = [
-                        n,
-                        block_timestamp,
-                        event_id,
-                    ] + values
-                    buffer_insert(table_name, all_values)
-                    event_id += 1
-                except Exception as e:
-                    raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
+                all_values = [
+                    n,
+                    block_timestamp,
+                    event_id,
+                ] + values
+                rows_by_table.setdefault(table_name, []).append(all_values)
+                event_id += 1
 
             except DatabaseConnectionError:
                 raise
@@ -88,6 +90,12 @@ def do_process_block(n):
                 # Convert any other errors to ShovelProcessingError to fail the shovel
                 raise ShovelProcessingError(f"Failed to process event in block {n}: {str(e)}")
 
+        try:
+            # Insert event data into tables
+            buffer_insert_tables(rows_by_table)
+        except Exception as e:
+            raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
+
     except (DatabaseConnectionError, ShovelProcessingError):
         # Re-raise these exceptions to be handled by the base class
         raise
@@ -1,6 +1,8 @@
 import json
 from functools import lru_cache
 from substrateinterface.base import is_valid_ss58_address
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
+from shared.clickhouse.schema import catalogue
 from shared.clickhouse.utils import (
     escape_column_name,
     get_clickhouse_client,
@@ -9,28 +11,15 @@ from shared.clickhouse.utils import (
 
 
 def format_value(value):
-    if value is None:
-        return "NULL"
-    elif isinstance(value, (int, float)):
+    """
+    Lists are stored as JSON and anything without a native column type as its string form
+    """
+    if value is None or isinstance(value, (str, int, float)):
         return value
-    elif isinstance(value, str):
-        escaped_value = value.replace("'", "\\'")
-        return f"'{escaped_value}'"
     elif isinstance(value, list):
-        if len(value) > 0 and all(isinstance(x, (int, float)) for x in value):
-            return f"[{','.join(str(x) for x in value)}]"
-        elif len(value) > 0 and all(isinstance(x, str) for x in value):
-            escaped_strings = []
-            for x in value:
-                escaped = x.replace("'", "\\'")
-                escaped_strings.append(f"'{escaped}'")
-            return f"[{','.join(escaped_strings)}]"
-        else:
-            json_str = json.dumps(value).replace("'", "\\'")
-            return f"'{json_str}'"
+        return json.dumps(value)
     else:
-        escaped = str(value).replace("'", "\\'")
-        return f"'{escaped}'"
+        return str(value)
 
 
 def get_column_type(value):
@@ -107,7 +96,7 @@ def create_clickhouse_table(table_name, column_names, column_types, values):
     order_by = ["timestamp", "event_index"]
     for i, value in enumerate(values):
         if isinstance(value, str) and is_valid_ss58_address(value):
-            order_by.append(column_names[i])
+            order_by.append(escape_column_name(column_names[i]))
 
     sql = f"""
     CREATE TABLE IF NOT EXISTS {table_name} (
@@ -115,9 +104,11 @@ def create_clickhouse_table(table_name, column_names, column_types, values):
     ) ENGINE = ReplacingMergeTree()
     PARTITION BY toYYYYMM(timestamp)
     ORDER BY ({", ".join(order_by)})
+    {DEDUP_TABLE_SETTINGS}
     """
 
     get_clickhouse_client().execute(sql)
+    catalogue.refresh(table_name)
 
 
 @lru_cache(maxsize=None)
@@ -133,7 +124,6 @@ def get_table_name(module_id, event_id, columns):
     """
     event_id = f"{module_id}_{event_id}"
     columns = ["block_number", "timestamp", "event_index"] + list(columns)
-    client = get_clickhouse_client()
 
     version = 0
 
@@ -151,8 +141,7 @@ def get_table_name(module_id, event_id, columns):
         # If table exists, we need to check the schema at this version matches the event we're
         # currently processing
         else:
-            query = f"DESCRIBE TABLE '{table_name}'"
-            result = client.execute(query)
+            result = catalogue.columns(table_name)
             different_version = False
 
             if len(result) != len(columns):
@@ -1,5 +1,5 @@
-from shared.block_metadata import get_block_metadata
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.block_metadata import get_block_events, get_block_metadata
+from shared.clickhouse.batch_insert import buffer_insert_tables
 from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
@@ -22,37 +22,43 @@ logging.basicConfig(level=logging.INFO,
 
 
 class ExtrinsicsShovel(ShovelBaseClass):
-    def process_block(self, n):
-        do_process_block(n)
+    uses_block_events = True
+
+    def fetch_block(self, n):
+        return fetch_block_extrinsics(n)
+
+    def transform_block(self, n, fetched):
+        (block_timestamp, extrinsics, events) = fetched
+        do_process_block(n, block_timestamp, extrinsics, events)
 
 
 def main():
     ExtrinsicsShovel(name="extrinsics").start()
 
 
-def do_process_block(n):
+def fetch_block_extrinsics(n):
     try:
-        try:
-            substrate = get_substrate_client()
-            (block_timestamp, block_hash) = get_block_metadata(n)
-        except Exception as e:
-            raise ShovelProcessingError(f"Failed to initialize block processing: {str(e)}")
+        substrate = get_substrate_client()
+        (block_timestamp, block_hash) = get_block_metadata(n)
+    except Exception as e:
+        raise ShovelProcessingError(f"Failed to initialize block processing: {str(e)}")
+
+    try:
+        extrinsics = substrate.get_extrinsics(block_number=n)
+        if not extrinsics and n != 0:
+            raise ShovelProcessingError(f"No extrinsics returned for block {n}")
+
+        events = get_block_events(n, block_hash)
+        if not events and n != 0:
+            raise ShovelProcessingError(f"No events returned for block {n}")
+    except Exception as e:
+        raise ShovelProcessingError(f"Failed to fetch extrinsics or events from substrate: {str(e)}")
+
+    return (block_timestamp, extrinsics, events)
 
-        try:
-            extrinsics = substrate.get_extrinsics(block_number=n)
-            if not extrinsics and n != 0:
-                raise ShovelProcessingError(f"No extrinsics returned for block {n}")
-
-            events = substrate.query(
-                "System",
-                "Events",
-                block_hash=block_hash,
-            )
-            if not events and n != 0:
-                raise ShovelProcessingError(f"No events returned for block {n}")
-        except Exception as e:
-            raise ShovelProcessingError(f"Failed to fetch extrinsics or events from substrate: {str(e)}")
 
+def do_process_block(n, block_timestamp, extrinsics, events):
+    try:
         # Map extrinsic success/failure status
         extrinsics_success_map = {}
         for e in events:
@@ -65,6 +71,7 @@ def do_process_block(n):
 
         # Needed to handle edge case of duplicate events in the same block
         extrinsic_id = 0
+        rows_by_table = {}
         for e in extrinsics:
             try:
                 extrinsic = e.value
@@ -111,11 +118,8 @@ def do_process_block(n):
                 except Exception as e:
                     raise DatabaseConnectionError(f"Failed to create/check table {table_name}: {str(e)}")
 
-                try:
-                    buffer_insert(table_name, values)
-                    extrinsic_id += 1
-                except Exception as e:
-                    raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
+                rows_by_table.setdefault(table_name, []).append(values)
+                extrinsic_id += 1
 
             except DatabaseConnectionError:
                 raise
@@ -128,6 +132,11 @@ def do_process_block(n):
             raise ShovelProcessingError(
                 f"Expected {len(extrinsics_success_map)} extrinsics, but only found {extrinsic_id}")
 
+        try:
+            buffer_insert_tables(rows_by_table)
+        except Exception as e:
+            raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
+
     except (DatabaseConnectionError, ShovelProcessingError):
         # Re-raise these exceptions to be handled by the base class
         raise
@@ -1,5 +1,7 @@
 import json
 from functools import lru_cache
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
+from shared.clickhouse.schema import catalogue
 from shared.clickhouse.utils import (
     escape_column_name,
     get_clickhouse_client,
@@ -8,25 +10,12 @@ from shared.clickhouse.utils import (
 
 
 def format_value(value, column_type=None):
-    if value is None:
-        return "NULL"
-    elif isinstance(value, str):
-        # Use proper escaping for ClickHouse
-        # Escape backslashes first, then single quotes, then other special chars
-        escaped_value = value.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n').replace('\t', '\\t').replace('\r', '\\r')
-        return f"'{escaped_value}'"
-    elif isinstance(value, list):
-        if isinstance(column_type, str) and "Array" in column_type:
-            return value
-        else:
-            # json.dumps() already handles escaping within the JSON itself
-            # We only need to escape single quotes for SQL string literal
-            json_str = json.dumps(value)
-            if "'" in json_str:
-                json_str = json_str.replace("'", "\\'")
-            return f"'{json_str}'"
-    else:
-        return value
+    """
+    Lists that are not stored in an Array column are stored as JSON
+    """
+    if isinstance(value, list) and not (isinstance(column_type, str) and "Array" in column_type):
+        return json.dumps(value)
+    return value
 
 
 def get_column_type(value, value_type=None, key=None):
@@ -145,9 +134,11 @@ def create_clickhouse_table(table_name, column_names, column_types):
     ) ENGINE = ReplacingMergeTree()
     PARTITION BY toYYYYMM(timestamp)
     ORDER BY ({", ".join(order_by)})
+    {DEDUP_TABLE_SETTINGS}
     """
 
     get_clickhouse_client().execute(sql)
+    catalogue.refresh(table_name)
 
 
 @lru_cache(maxsize=None)
@@ -162,7 +153,6 @@ def get_table_name(module_id, function_id, columns):
     'columns' must be passed as a tuple to be hashable.
     """
     extrinsic_id = f"{module_id}_{function_id}"
-    client = get_clickhouse_client()
 
     version = 0
 
@@ -180,8 +170,7 @@ def get_table_name(module_id, function_id, columns):
         # If table exists, we need to check the schema at this version matches the extrinsic we're
         # currently processing
         else:
-            query = f"DESCRIBE TABLE '{table_name}'"
-            result = client.execute(query)
+            result = catalogue.columns(table_name)
             different_version = False
 
             if len(result) != len(columns):
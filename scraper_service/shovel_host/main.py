@@ -0,0 +1,22 @@
+from shared.shovel_host import ShovelHost, load_shovel
+import logging
+import os
+
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(process)d %(message)s")
+
+DEFAULT_HOSTED_SHOVELS = ",".join([
+    "shovel_block_timestamp.main:BlockTimestampShovel:block_timestamps",
+    "shovel_events.main:EventsShovel:events",
+    "shovel_extrinsics.main:ExtrinsicsShovel:extrinsics",
+])
+
+
+def main():
+    specs = os.getenv("HOSTED_SHOVELS", DEFAULT_HOSTED_SHOVELS).split(",")
+    ShovelHost([load_shovel(spec) for spec in specs if spec.strip()]).start()
+
+
+if __name__ == "__main__":
+    main()
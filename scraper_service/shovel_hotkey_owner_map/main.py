@@ -1,5 +1,6 @@
 from shared.block_metadata import get_block_metadata
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.batch_insert import buffer_insert_many
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.shovel_base_class import ShovelBaseClass
 from shared.substrate import get_substrate_client
 from shared.clickhouse.utils import (
@@ -69,6 +70,7 @@ def do_process_block(self, n):
                 ) ENGINE = ReplacingMergeTree()
                 PARTITION BY toYYYYMM(timestamp)
                 ORDER BY (hotkey, coldkey, timestamp)
+                {DEDUP_TABLE_SETTINGS}
                 """
                 get_clickhouse_client().execute(query)
         except Exception as e:
@@ -102,11 +104,10 @@ def do_process_block(self, n):
                 last_owners = owners
 
             try:
-                for (hotkey, coldkey) in owners:
-                    buffer_insert(
-                        self.table_name,
-                        [n, block_timestamp, f"'{hotkey}'", f"'{coldkey}'"]
-                    )
+                buffer_insert_many(self.table_name, [
+                    [n, block_timestamp, hotkey, coldkey]
+                    for (hotkey, coldkey) in owners
+                ])
             except Exception as e:
                 raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
@@ -1,5 +1,7 @@
 from functools import lru_cache
 from substrateinterface.base import is_valid_ss58_address
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
+from shared.clickhouse.schema import catalogue
 from shared.clickhouse.utils import (
     escape_column_name,
     get_clickhouse_client,
@@ -7,16 +9,6 @@ from shared.clickhouse.utils import (
 )
 
 
-def format_value(value):
-    """
-    SQL requires strings to be wrapped in single quotes
-    """
-    if isinstance(value, str):
-        return f"'{value}'"
-    else:
-        return value
-
-
 def get_column_type(value):
     if isinstance(value, str):
         return "String"
@@ -63,7 +55,7 @@ def generate_column_definitions(item, parent_key=None):
             column_name = parent_key if parent_key else "value"
             column_names.append(column_name)
             column_types.append(column_type)
-            values.append(format_value(item))
+            values.append(item)
 
     return (column_names, column_types, values)
 
@@ -89,16 +81,18 @@ def create_clickhouse_table(table_name, column_names, column_types, values):
     order_by = ["block_number", "timestamp"]
     for i, value in enumerate(values):
         if isinstance(value, str) and is_valid_ss58_address(value):
-            order_by.append(column_names[i])
+            order_by.append(escape_column_name(column_names[i]))
 
     sql = f"""
     CREATE TABLE IF NOT EXISTS {table_name} (
         {column_definitions}
     ) ENGINE = ReplacingMergeTree()
     ORDER BY ({", ".join(order_by)})
+    {DEDUP_TABLE_SETTINGS}
     """
 
     get_clickhouse_client().execute(sql)
+    catalogue.refresh(table_name)
 
 
 @lru_cache(maxsize=None)
@@ -114,7 +108,6 @@ def get_table_name(module_id, event_id, columns):
     """
     event_id = f"{module_id}_{event_id}"
     columns = ["block_number", "timestamp"] + list(columns)
-    client = get_clickhouse_client()
 
     version = 0
 
@@ -132,8 +125,7 @@ def get_table_name(module_id, event_id, columns):
         # If table exists, we need to check the schema at this version matches the event we're
         # currently processing
         else:
-            query = f"DESCRIBE TABLE '{table_name}'"
-            result = client.execute(query)
+            result = catalogue.columns(table_name)
             different_version = False
 
             if len(result) != len(columns):
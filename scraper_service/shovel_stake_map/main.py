@@ -1,16 +1,16 @@
 from collections import defaultdict
 import logging
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
 )
 from shared.substrate import get_substrate_client
 from shared.shovel_base_class import ShovelBaseClass
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.batch_insert import buffer_insert_many
 from shared.block_metadata import get_block_metadata
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 from datetime import datetime
-import time
 import rust_bindings
 from tqdm import tqdm
 from functools import lru_cache
@@ -49,6 +49,10 @@ def check_root_read_proof(block_hash):
 
 class StakeDoubleMapShovel(ShovelBaseClass):
     table_name = "shovel_stake_double_map"
+    # stake_map and prev_pending_emissions are carried over from block to block
+    parallel_backfill = False
+    # agg_stake_events joins the events and hotkey_owner_map tables
+    dependencies = ("events", "hotkey_owner_map")
 
     def process_block(self, n):
         do_process_block(n, self.table_name)
@@ -69,6 +73,7 @@ def do_process_block(n, table_name):
                 ) ENGINE = ReplacingMergeTree()
                 PARTITION BY toYYYYMM(timestamp)
                 ORDER BY (coldkey, hotkey, timestamp)
+                {DEDUP_TABLE_SETTINGS}
                 """
                 get_clickhouse_client().execute(query)
 
@@ -144,22 +149,6 @@ def do_process_block(n, table_name):
             raise ShovelProcessingError(f"Failed to process subnet data: {str(e)}")
 
         try:
-            # Check if we're up to date with dependencies
-            events_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'events';"
-            events_synced_block = get_clickhouse_client().execute(
-                events_synced_block_query)[0][0]
-            hotkey_owner_map_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'hotkey_owner_map';"
-            hotkey_owner_map_synced_block = get_clickhouse_client().execute(
-                hotkey_owner_map_synced_block_query)[0][0]
-
-            while (events_synced_block < n or hotkey_owner_map_synced_block < n):
-                logging.info("Waiting for events and hotkey_owner_map tables to sync...")
-                time.sleep(60)
-                events_synced_block = get_clickhouse_client().execute(
-                    events_synced_block_query)[0][0]
-                hotkey_owner_map_synced_block = get_clickhouse_client().execute(
-                    hotkey_owner_map_synced_block_query)[0][0]
-
             # Get hotkeys with stake events this block
             dt_object = datetime.fromtimestamp(block_timestamp)
             formatted_date = dt_object.strftime("%Y-%m-%d %H:%M:%S")
@@ -187,11 +176,10 @@ def do_process_block(n, table_name):
                     stake_map[(hotkey, coldkey)] = stake
 
             try:
-                for ((hotkey, coldkey), stake) in stake_map.items():
-                    buffer_insert(
-                        table_name,
-                        [n, block_timestamp, f"'{hotkey}'", f"'{coldkey}'", stake]
-                    )
+                buffer_insert_many(table_name, [
+                    [n, block_timestamp, hotkey, coldkey, stake]
+                    for ((hotkey, coldkey), stake) in stake_map.items()
+                ])
             except Exception as e:
                 raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
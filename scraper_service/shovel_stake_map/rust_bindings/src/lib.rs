@@ -1,9 +1,12 @@
 use deadpool::unmanaged;
-use futures::future::join_all;
+use futures::future::{join_all, select_ok};
 use parity_scale_codec::Decode;
+use pyo3::exceptions::{PyConnectionError, PyTimeoutError};
 use pyo3::prelude::*;
+use std::future::Future;
 use std::str::FromStr;
 use std::sync::Arc;
+use std::time::Duration;
 use subxt::{
     backend::{legacy::LegacyBackend, rpc::RpcClient},
     utils::{AccountId32, H256},
@@ -13,27 +16,103 @@ use subxt::{
 #[subxt::subxt(runtime_metadata_path = "./metadata.scale")]
 pub mod subtensor {}
 
-async fn get_api() -> OnlineClient<PolkadotConfig> {
-    let url = std::env::var("SUBSTRATE_ARCHIVE_NODE_URL").unwrap();
-    let client = RpcClient::from_insecure_url(url.clone())
+/// Archive node URLs from SUBSTRATE_ARCHIVE_NODE_URLS (comma-separated), or the single
+/// SUBSTRATE_ARCHIVE_NODE_URL.
+fn archive_node_urls() -> Vec<String> {
+    std::env::var("SUBSTRATE_ARCHIVE_NODE_URLS")
+        .or_else(|_| std::env::var("SUBSTRATE_ARCHIVE_NODE_URL"))
+        .unwrap_or_default()
+        .split(',')
+        .map(|url| url.trim().to_string())
+        .filter(|url| !url.is_empty())
+        .collect()
+}
+
+fn env_seconds(name: &str, default: f64) -> Duration {
+    let seconds = std::env::var(name)
+        .ok()
+        .and_then(|value| value.parse().ok())
+        .unwrap_or(default);
+    Duration::from_secs_f64(seconds)
+}
+
+fn rpc_error<E: std::fmt::Display>(e: E) -> PyErr {
+    PyConnectionError::new_err(e.to_string())
+}
+
+async fn connect(url: String) -> Result<(String, OnlineClient<PolkadotConfig>), String> {
+    let attempt = async {
+        let client = RpcClient::from_insecure_url(url.clone())
+            .await
+            .map_err(|e| e.to_string())?;
+        let backend = LegacyBackend::<PolkadotConfig>::builder()
+            .storage_page_size(1000)
+            .build(client);
+        OnlineClient::from_backend(Arc::new(backend))
+            .await
+            .map_err(|e| e.to_string())
+    };
+    let connected = tokio::time::timeout(env_seconds("SUBSTRATE_CONNECT_TIMEOUT", 30.0), attempt).await;
+    match connected {
+        Ok(Ok(api)) => Ok((url, api)),
+        Ok(Err(e)) => Err(format!("{}: {}", url, e)),
+        Err(_) => Err(format!("{}: timed out", url)),
+    }
+}
+
+/// Connects to every archive node at once and keeps the first one ready, i.e. the one that
+/// answered the metadata and runtime version requests fastest. Nodes that are down or don't
+/// answer within SUBSTRATE_CONNECT_TIMEOUT are skipped.
+async fn get_api_with_url() -> PyResult<(String, OnlineClient<PolkadotConfig>)> {
+    let urls = archive_node_urls();
+    if urls.is_empty() {
+        return Err(PyConnectionError::new_err(
+            "No archive node configured, set SUBSTRATE_ARCHIVE_NODE_URLS",
+        ));
+    }
+    select_ok(urls.into_iter().map(|url| Box::pin(connect(url))))
         .await
-        .expect("Failed to connect to node");
-    let backend = LegacyBackend::<PolkadotConfig>::builder()
-        .storage_page_size(1000)
-        .build(client);
-    OnlineClient::from_backend(Arc::new(backend)).await.unwrap()
+        .map(|(connected, _)| connected)
+        .map_err(|e| rpc_error(format!("No archive node reachable, last error: {}", e)))
+}
+
+async fn get_api() -> PyResult<OnlineClient<PolkadotConfig>> {
+    Ok(get_api_with_url().await?.1)
+}
+
+/// `concurrency` connections, all to the archive node that connected fastest.
+async fn get_api_pool(concurrency: usize) -> PyResult<unmanaged::Pool<OnlineClient<PolkadotConfig>>> {
+    let (url, api) = get_api_with_url().await?;
+    let mut apis = vec![api];
+    for connected in join_all((1..concurrency).map(|_| connect(url.clone()))).await {
+        apis.push(connected.map_err(rpc_error)?.1);
+    }
+    Ok(unmanaged::Pool::from(apis))
+}
+
+/// The next storage entry of an iteration, failing instead of waiting forever when the node
+/// doesn't send it within SUBSTRATE_REQUEST_TIMEOUT.
+async fn next_kv<T, E: std::fmt::Display>(
+    next: impl Future<Output = Option<Result<T, E>>>,
+) -> PyResult<Option<T>> {
+    match tokio::time::timeout(env_seconds("SUBSTRATE_REQUEST_TIMEOUT", 60.0), next).await {
+        Ok(None) => Ok(None),
+        Ok(Some(Ok(kv))) => Ok(Some(kv)),
+        Ok(Some(Err(e))) => Err(rpc_error(e)),
+        Err(_) => Err(PyTimeoutError::new_err("Archive node stopped responding")),
+    }
 }
 
 async fn query_map_pending_emission_inner(block_hash: String) -> PyResult<Vec<(u16, u64)>> {
-    let api = get_api().await;
+    let api = get_api().await?;
     let block_hash = hex::decode(block_hash.trim_start_matches("0x")).expect("Decoding failed");
     let block_hash = H256::from_slice(&block_hash);
     let query = subtensor::storage()
         .subtensor_module()
         .pending_emission_iter();
-    let mut iter = api.storage().at(block_hash).iter(query).await.unwrap();
+    let mut iter = api.storage().at(block_hash).iter(query).await.map_err(rpc_error)?;
     let mut kvs = Vec::new();
-    while let Some(Ok(kv)) = iter.next().await {
+    while let Some(kv) = next_kv(iter.next()).await? {
         let mut last_two_bytes = &kv.key_bytes[kv.key_bytes.len() - 2..];
         let subnet_id = u16::decode(&mut last_two_bytes).unwrap();
         kvs.push((subnet_id, kv.value));
@@ -45,15 +124,15 @@ async fn query_subnet_hotkeys_inner(
     block_hash: String,
     subnet_id: u16,
 ) -> PyResult<Vec<(u16, String)>> {
-    let api = get_api().await;
+    let api = get_api().await?;
     let block_hash = hex::decode(block_hash.trim_start_matches("0x")).expect("Decoding failed");
     let block_hash = H256::from_slice(&block_hash);
     let query = subtensor::storage()
         .subtensor_module()
         .keys_iter1(subnet_id);
-    let mut iter = api.storage().at(block_hash).iter(query).await.unwrap();
+    let mut iter = api.storage().at(block_hash).iter(query).await.map_err(rpc_error)?;
     let mut kvs = Vec::new();
-    while let Some(Ok(kv)) = iter.next().await {
+    while let Some(kv) = next_kv(iter.next()).await? {
         let mut last_two_bytes = &kv.key_bytes[kv.key_bytes.len() - 2..];
         let neuron_id = u16::decode(&mut last_two_bytes).unwrap();
         kvs.push((neuron_id, kv.value.to_string()));
@@ -65,7 +144,7 @@ async fn query_hotkey_stakes_inner(
     api: &OnlineClient<PolkadotConfig>,
     block_hash: &H256,
     hotkey: &String,
-) -> Vec<(String, u64)> {
+) -> PyResult<Vec<(String, u64)>> {
     let hotkey = AccountId32::from_str(hotkey.as_str()).expect("Invalid hotkey");
     let query = subtensor::storage().subtensor_module().stake_iter1(hotkey);
     let mut iter = api
@@ -73,14 +152,14 @@ async fn query_hotkey_stakes_inner(
         .at(block_hash.clone())
         .iter(query)
         .await
-        .unwrap();
+        .map_err(rpc_error)?;
     let mut kvs = Vec::new();
-    while let Some(Ok(kv)) = iter.next().await {
+    while let Some(kv) = next_kv(iter.next()).await? {
         let last_32_bytes: [u8; 32] = kv.key_bytes[kv.key_bytes.len() - 32..].try_into().unwrap();
         let coldkey = AccountId32::from(last_32_bytes).to_string();
         kvs.push((coldkey, kv.value));
     }
-    kvs
+    Ok(kvs)
 }
 
 async fn query_hotkeys_stakes_inner(
@@ -91,9 +170,7 @@ async fn query_hotkeys_stakes_inner(
     let block_hash = H256::from_slice(&block_hash);
 
     let concurrency = 32;
-    let api_futures = (0..concurrency).map(|_| get_api()).collect::<Vec<_>>();
-    let api_pool = join_all(api_futures).await.into_iter().collect::<Vec<_>>();
-    let api_pool = unmanaged::Pool::from(api_pool);
+    let api_pool = get_api_pool(concurrency).await?;
 
     let futures = hotkeys.iter().map(|hotkey| {
         let hotkey = hotkey.clone();
@@ -105,8 +182,11 @@ async fn query_hotkeys_stakes_inner(
             (hotkey, stakes)
         }
     });
-    let r = join_all(futures).await;
-    Ok(r)
+    join_all(futures)
+        .await
+        .into_iter()
+        .map(|(hotkey, stakes)| stakes.map(|stakes| (hotkey, stakes)))
+        .collect()
 }
 
 #[pyfunction]
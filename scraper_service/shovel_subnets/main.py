@@ -1,6 +1,6 @@
 from shared.substrate import reconnect_substrate
 from shared.block_metadata import get_block_metadata
-from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.batch_insert import buffer_insert_many
 from shared.shovel_base_class import ShovelBaseClass
 import logging
 import rust_bindings
@@ -13,6 +13,11 @@ logging.basicConfig(level=logging.INFO,
 
 
 class SubnetsShovel(ShovelBaseClass):
+    # The axon cache is loaded once and then updated from each block's serve_axon extrinsics
+    parallel_backfill = False
+    # Axon updates come from extrinsics, coldkeys and stakes from the map shovels
+    dependencies = ("extrinsics", "stake_double_map", "hotkey_owner_map")
+
     def process_block(self, n):
         try:
             do_process_block(n)
@@ -63,6 +68,7 @@ def do_process_block(n):
         axon_cache = get_axon_cache()
 
         try:
+            rows = []
             for neuron in neurons:
                 subnet_id = neuron.subnet_id
                 hotkey = neuron.hotkey
@@ -72,19 +78,19 @@ def do_process_block(n):
                     logging.error(f"{hotkey} has no coldkey and stake!")
                     raise ShovelProcessingError(f"Neuron {hotkey} has no coldkey and stake data")
 
-                buffer_insert("shovel_subnets", [
+                rows.append([
                     n,  # block_number UInt64 CODEC(Delta, ZSTD),
                     block_timestamp,  # timestamp DateTime CODEC(Delta, ZSTD),
                     neuron.subnet_id,  # subnet_id UInt16 CODEC(Delta, ZSTD),
                     neuron.neuron_id,  # neuron_id UInt16 CODEC(Delta, ZSTD),
 
-                    f"'{neuron.hotkey}'",  # hotkey String CODEC(ZSTD),
-                    f"'{coldkey_and_stake[0]}'",  # coldkey String CODEC(ZSTD),
+                    neuron.hotkey,  # hotkey String CODEC(ZSTD),
+                    coldkey_and_stake[0],  # coldkey String CODEC(ZSTD),
                     neuron.active,  # active Bool CODEC(ZSTD),
 
                     axon.block,  # axon_block UInt64 CODEC(Delta, ZSTD),
                     axon.version,  # axon_version UInt32 CODEC(Delta, ZSTD),
-                    f'{axon.ip}',  # axon_ip String CODEC(ZSTD),
+                    str(axon.ip),  # axon_ip String CODEC(ZSTD),
                     axon.port,  # axon_port UInt16 CODEC(Delta, ZSTD),
                     axon.ip_type,  # axon_ip_type UInt8 CODEC(Delta, ZSTD),
                     axon.protocol,  # axon_protocol UInt8 CODEC(Delta, ZSTD),
@@ -106,6 +112,8 @@ def do_process_block(n):
                     neuron.validator_permit,
                     neuron.pruning_scores  # pruning_score UInt16 CODEC(Delta, ZSTD)
                 ])
+
+            buffer_insert_many("shovel_subnets", rows)
         except Exception as e:
             if isinstance(e, DatabaseConnectionError):
                 raise
@@ -1,8 +1,11 @@
 use crate::subtensor::runtime_types::pallet_subtensor::pallet::AxonInfo;
 use deadpool::unmanaged;
-use futures::future::join_all;
+use futures::future::{join_all, select_ok};
 use parity_scale_codec::Decode;
+use pyo3::exceptions::{PyConnectionError, PyTimeoutError};
 use pyo3::prelude::*;
+use std::future::Future;
+use std::time::Duration;
 use std::{collections::HashMap, sync::Arc};
 use subxt::{
     backend::{legacy::LegacyBackend, rpc::RpcClient},
@@ -97,26 +100,107 @@ macro_rules! fetch_and_process_kvs {
     ($api_pool:expr, $block_hash:expr, $query:expr, $label:expr) => {{
         async {
             let api = $api_pool.get().await.unwrap();
-            let mut iter = api.storage().at($block_hash).iter($query).await.unwrap();
+            let mut iter = api
+                .storage()
+                .at($block_hash)
+                .iter($query)
+                .await
+                .map_err(rpc_error)?;
             let mut kvs = Vec::new();
 
-            while let Some(Ok(kv)) = iter.next().await {
+            while let Some(kv) = next_kv(iter.next()).await? {
                 kvs.push((kv.key_bytes, kv.value));
             }
-            kvs
+            Ok::<_, PyErr>(kvs)
         }
     }};
 }
 
-async fn get_api() -> OnlineClient<PolkadotConfig> {
-    let url = std::env::var("SUBSTRATE_ARCHIVE_NODE_URL").unwrap();
-    let client = RpcClient::from_insecure_url(url.clone())
+/// Archive node URLs from SUBSTRATE_ARCHIVE_NODE_URLS (comma-separated), or the single
+/// SUBSTRATE_ARCHIVE_NODE_URL.
+fn archive_node_urls() -> Vec<String> {
+    std::env::var("SUBSTRATE_ARCHIVE_NODE_URLS")
+        .or_else(|_| std::env::var("SUBSTRATE_ARCHIVE_NODE_URL"))
+        .unwrap_or_default()
+        .split(',')
+        .map(|url| url.trim().to_string())
+        .filter(|url| !url.is_empty())
+        .collect()
+}
+
+fn env_seconds(name: &str, default: f64) -> Duration {
+    let seconds = std::env::var(name)
+        .ok()
+        .and_then(|value| value.parse().ok())
+        .unwrap_or(default);
+    Duration::from_secs_f64(seconds)
+}
+
+fn rpc_error<E: std::fmt::Display>(e: E) -> PyErr {
+    PyConnectionError::new_err(e.to_string())
+}
+
+async fn connect(url: String) -> Result<(String, OnlineClient<PolkadotConfig>), String> {
+    let attempt = async {
+        let client = RpcClient::from_insecure_url(url.clone())
+            .await
+            .map_err(|e| e.to_string())?;
+        let backend = LegacyBackend::<PolkadotConfig>::builder()
+            .storage_page_size(1000)
+            .build(client);
+        OnlineClient::from_backend(Arc::new(backend))
+            .await
+            .map_err(|e| e.to_string())
+    };
+    let connected = tokio::time::timeout(env_seconds("SUBSTRATE_CONNECT_TIMEOUT", 30.0), attempt).await;
+    match connected {
+        Ok(Ok(api)) => Ok((url, api)),
+        Ok(Err(e)) => Err(format!("{}: {}", url, e)),
+        Err(_) => Err(format!("{}: timed out", url)),
+    }
+}
+
+/// Connects to every archive node at once and keeps the first one ready, i.e. the one that
+/// answered the metadata and runtime version requests fastest. Nodes that are down or don't
+/// answer within SUBSTRATE_CONNECT_TIMEOUT are skipped.
+async fn get_api_with_url() -> PyResult<(String, OnlineClient<PolkadotConfig>)> {
+    let urls = archive_node_urls();
+    if urls.is_empty() {
+        return Err(PyConnectionError::new_err(
+            "No archive node configured, set SUBSTRATE_ARCHIVE_NODE_URLS",
+        ));
+    }
+    select_ok(urls.into_iter().map(|url| Box::pin(connect(url))))
         .await
-        .expect("Failed to connect to node");
-    let backend = LegacyBackend::<PolkadotConfig>::builder()
-        .storage_page_size(1000)
-        .build(client);
-    OnlineClient::from_backend(Arc::new(backend)).await.unwrap()
+        .map(|(connected, _)| connected)
+        .map_err(|e| rpc_error(format!("No archive node reachable, last error: {}", e)))
+}
+
+async fn get_api() -> PyResult<OnlineClient<PolkadotConfig>> {
+    Ok(get_api_with_url().await?.1)
+}
+
+/// `concurrency` connections, all to the archive node that connected fastest.
+async fn get_api_pool(concurrency: usize) -> PyResult<unmanaged::Pool<OnlineClient<PolkadotConfig>>> {
+    let (url, api) = get_api_with_url().await?;
+    let mut apis = vec![api];
+    for connected in join_all((1..concurrency).map(|_| connect(url.clone()))).await {
+        apis.push(connected.map_err(rpc_error)?.1);
+    }
+    Ok(unmanaged::Pool::from(apis))
+}
+
+/// The next storage entry of an iteration, failing instead of waiting forever when the node
+/// doesn't send it within SUBSTRATE_REQUEST_TIMEOUT.
+async fn next_kv<T, E: std::fmt::Display>(
+    next: impl Future<Output = Option<Result<T, E>>>,
+) -> PyResult<Option<T>> {
+    match tokio::time::timeout(env_seconds("SUBSTRATE_REQUEST_TIMEOUT", 60.0), next).await {
+        Ok(None) => Ok(None),
+        Ok(Some(Ok(kv))) => Ok(Some(kv)),
+        Ok(Some(Err(e))) => Err(rpc_error(e)),
+        Err(_) => Err(PyTimeoutError::new_err("Archive node stopped responding")),
+    }
 }
 
 async fn query_neuron_info_inner(block_hash: String) -> PyResult<(Vec<NeuronInfo>, Vec<String>)> {
@@ -153,9 +237,7 @@ async fn query_neuron_info_inner(block_hash: String) -> PyResult<(Vec<NeuronInfo
     // let axons_query = subtensor::storage().subtensor_module().axons_iter();
 
     let concurrency = 32;
-    let api_futures = (0..concurrency).map(|_| get_api()).collect::<Vec<_>>();
-    let api_pool = join_all(api_futures).await.into_iter().collect::<Vec<_>>();
-    let api_pool = unmanaged::Pool::from(api_pool);
+    let api_pool = get_api_pool(concurrency).await?;
 
     let (
         keys_kvs,
@@ -172,7 +254,7 @@ async fn query_neuron_info_inner(block_hash: String) -> PyResult<(Vec<NeuronInfo
         validator_permit_kvs,
         weights_kvs,
         bonds_kvs,
-    ) = tokio::join!(
+    ) = tokio::try_join!(
         fetch_and_process_kvs!(&api_pool, block_hash, keys_query, "keys"),
         fetch_and_process_kvs!(&api_pool, block_hash, active_query, "active"),
         fetch_and_process_kvs!(&api_pool, block_hash, rank_query, "rank"),
@@ -202,7 +284,7 @@ async fn query_neuron_info_inner(block_hash: String) -> PyResult<(Vec<NeuronInfo
         ),
         fetch_and_process_kvs!(&api_pool, block_hash, weights_query, "weights"),
         fetch_and_process_kvs!(&api_pool, block_hash, bonds_query, "bonds"),
-    );
+    )?;
     let end = std::time::Instant::now();
     println!("Get main stuff elapsed: {:?}", end - start);
 
@@ -390,16 +472,16 @@ async fn query_neuron_info_inner(block_hash: String) -> PyResult<(Vec<NeuronInfo
 async fn query_axons_inner(
     block_hash: String,
 ) -> PyResult<HashMap<(u16, String), PyClassAxonInfo>> {
-    let api = get_api().await;
+    let api = get_api().await?;
     let query = subtensor::storage().subtensor_module().axons_iter();
     let block_hash =
         hex::decode(block_hash.trim_start_matches("0x")).expect("Decoding block_hash failed");
     let block_hash = H256::from_slice(&block_hash);
 
-    let mut iter = api.storage().at(block_hash).iter(query).await.unwrap();
+    let mut iter = api.storage().at(block_hash).iter(query).await.map_err(rpc_error)?;
     let mut kvs = HashMap::new();
 
-    while let Some(Ok(kv)) = iter.next().await {
+    while let Some(kv) = next_kv(iter.next()).await? {
         let last_32_bytes: &[u8; 32] = &kv.key_bytes[kv.key_bytes.len() - 32..].try_into().unwrap();
         let mut last_50th_to_48th_bytes =
             &kv.key_bytes[kv.key_bytes.len() - 50..kv.key_bytes.len() - 48];
@@ -1,9 +1,9 @@
 from datetime import datetime
 from tqdm import tqdm
-import time
 import os
 import rust_bindings
-from shared.substrate import get_substrate_client
+from shared.substrate import query_storage_batch
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
@@ -58,6 +58,7 @@ def create_table():
             ) ENGINE = ReplacingMergeTree()
             PARTITION BY toYYYYMM(timestamp)
             ORDER BY (subnet_id, neuron_id, timestamp)
+            {DEDUP_TABLE_SETTINGS}
             """
             try:
                 get_clickhouse_client().execute(query)
@@ -82,31 +83,6 @@ def get_axon_cache():
 def refresh_axon_cache(block_timestamp, block_hash, block_number):
     global axon_cache
 
-    try:
-        extrinsics_synced_block_query = f"SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'extrinsics';"
-        try:
-            result = get_clickhouse_client().execute(extrinsics_synced_block_query)
-            if not result:
-                raise DatabaseConnectionError("No checkpoint found for extrinsics shovel")
-            extrinsics_synced_block = result[0][0]
-        except Exception as e:
-            raise DatabaseConnectionError(f"Failed to query extrinsics sync status: {str(e)}")
-
-        while (extrinsics_synced_block < block_number):
-            logging.info("Waiting for extrinsics table to sync...")
-            time.sleep(60)
-            try:
-                result = get_clickhouse_client().execute(extrinsics_synced_block_query)
-                if not result:
-                    raise DatabaseConnectionError("No checkpoint found for extrinsics shovel")
-                extrinsics_synced_block = result[0][0]
-            except Exception as e:
-                raise DatabaseConnectionError(f"Failed to query extrinsics sync status during wait: {str(e)}")
-    except Exception as e:
-        if isinstance(e, DatabaseConnectionError):
-            raise
-        raise DatabaseConnectionError(f"Failed to check extrinsics sync status: {str(e)}")
-
     # Init the axon cache on first run
     if len(axon_cache) == 0:
         try:
@@ -181,12 +157,6 @@ def refresh_axon_cache(block_timestamp, block_hash, block_number):
 
 coldkey_stake_cache = {}
 
-hotkey_owner_map_synced_block = -1
-
-stake_map_synced_block = -1
-
-stake_map_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'stake_double_map';"
-hotkey_owner_map_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'hotkey_owner_map';"
 
 
 def batch(iterable, n=1):
@@ -202,29 +172,6 @@ def get_coldkeys_and_stakes(hotkeys, block_timestamp, block_hash, block_number):
         raise ShovelProcessingError("Empty hotkeys list provided")
 
     global coldkey_stake_cache
-    global stake_map_synced_block
-    global hotkey_owner_map_synced_block
-
-    try:
-        while (hotkey_owner_map_synced_block < block_number or stake_map_synced_block < block_number):
-            if hotkey_owner_map_synced_block > -1 and stake_map_synced_block > -1:
-                logging.info("Waiting for stake_double_map and hotkey_owner_map tables to sync...")
-                time.sleep(1)
-            try:
-                stake_result = get_clickhouse_client().execute(stake_map_synced_block_query)
-                hotkey_result = get_clickhouse_client().execute(hotkey_owner_map_synced_block_query)
-
-                if not stake_result or not hotkey_result:
-                    raise DatabaseConnectionError("No checkpoint found for stake_map or hotkey_owner_map")
-
-                stake_map_synced_block = stake_result[0][0]
-                hotkey_owner_map_synced_block = hotkey_result[0][0]
-            except Exception as e:
-                raise DatabaseConnectionError(f"Failed to query dependency sync status: {str(e)}")
-    except Exception as e:
-        if isinstance(e, DatabaseConnectionError):
-            raise
-        raise DatabaseConnectionError(f"Failed to check dependency sync status: {str(e)}")
 
     need_to_query = []
     for hotkey in hotkeys:
@@ -293,32 +240,35 @@ def get_coldkeys_and_stakes(hotkeys, block_timestamp, block_hash, block_number):
             except Exception as e:
                 raise ShovelProcessingError(f"Failed to process response data: {str(e)}")
 
+    # handle hotkeys without a stake, reading all their owners and then all their stakes in
+    # one request each
+    unstaked = [hotkey for hotkey in hotkeys if (block_timestamp, hotkey) not in coldkey_stake_cache]
+    if unstaked:
+        try:
+            coldkeys = query_storage_batch(
+                [("SubtensorModule", "Owner", [hotkey]) for hotkey in unstaked], block_hash
+            )
+            for (hotkey, coldkey) in zip(unstaked, coldkeys):
+                if coldkey is None:
+                    raise ShovelProcessingError(f"Failed to get coldkey for hotkey {hotkey}")
+            stakes = query_storage_batch(
+                [("SubtensorModule", "Stake", [hotkey, coldkey]) for (hotkey, coldkey) in zip(unstaked, coldkeys)],
+                block_hash,
+            )
+        except Exception as e:
+            if isinstance(e, ShovelProcessingError):
+                raise
+            raise ShovelProcessingError(f"Failed to query substrate for {len(unstaked)} hotkeys: {str(e)}")
+        unstaked = {hotkey: (coldkey, stake) for (hotkey, coldkey, stake) in zip(unstaked, coldkeys, stakes)}
+
     coldkeys_and_stakes = dict()
     for hotkey in hotkeys:
         try:
             # handle a hotkey without a stake
             if (block_timestamp, hotkey) not in coldkey_stake_cache:
-                try:
-                    coldkey_result = get_substrate_client().query(
-                        "SubtensorModule",
-                        "Owner",
-                        block_hash=block_hash,
-                        params=[hotkey],
-                    )
-                    if coldkey_result is None or coldkey_result.value is None:
-                        raise ShovelProcessingError(f"Failed to get coldkey for hotkey {hotkey}")
-                    coldkey = coldkey_result.value
-
-                    stake = get_substrate_client().query(
-                        "SubtensorModule",
-                        "Stake",
-                        block_hash=block_hash,
-                        params=[hotkey, coldkey],
-                    )
-                    if stake is None:
-                        raise ShovelProcessingError(f"Failed to get stake for hotkey {hotkey}")
-                except Exception as e:
-                    raise ShovelProcessingError(f"Failed to query substrate for hotkey {hotkey}: {str(e)}")
+                (coldkey, stake) = unstaked[hotkey]
+                if stake is None:
+                    raise ShovelProcessingError(f"Failed to get stake for hotkey {hotkey}")
 
                 if stake != 0:
                     logging.error(
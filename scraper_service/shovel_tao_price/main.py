@@ -2,6 +2,7 @@ import logging
 
 from cmc_client import get_price_by_time, CMC_TOKEN
 from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.shovel_base_class import ShovelBaseClass
 from shared.substrate import get_substrate_client, reconnect_substrate
 from shared.clickhouse.utils import (
@@ -10,6 +11,7 @@ from shared.clickhouse.utils import (
 )
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 from shared.block_metadata import get_block_metadata
+from shared.block_schedule import every_n_blocks_until
 
 BLOCKS_A_DAY = (24 * 60 * 60) / 12
 FETCH_EVERY_N_BLOCKS = (60 * 5) / 12
@@ -24,18 +26,14 @@ logging.basicConfig(level=logging.INFO,
 class TaoPriceShovel(ShovelBaseClass):
     table_name = "shovel_tao_price"
     starting_block = 2137
+    block_schedule = staticmethod(
+        every_n_blocks_until(THRESHOLD_BLOCK, BLOCKS_A_DAY, FETCH_EVERY_N_BLOCKS)
+    )
+    # CMC rate limits would only be hit harder by parallel workers
+    parallel_backfill = False
 
     def process_block(self, n):
         try:
-            # `skip_interval` has a hiccup sometimes
-            # for unknown reasons and its not elastic
-            # enough to handle conditions
-            if n > THRESHOLD_BLOCK:
-                if n % FETCH_EVERY_N_BLOCKS != 0:
-                    return
-            else:
-                if n % BLOCKS_A_DAY != 0:
-                    return
             do_process_block(n, self.table_name)
         except Exception as e:
             if isinstance(e, (DatabaseConnectionError, ShovelProcessingError)):
@@ -92,6 +90,7 @@ def first_run(table_name):
         ) ENGINE = ReplacingMergeTree()
         PARTITION BY toYYYYMM(timestamp)
         ORDER BY timestamp
+        {DEDUP_TABLE_SETTINGS}
         """
         get_clickhouse_client().execute(query)
     except Exception as e:
@@ -1,13 +1,16 @@
 from time import sleep
 from shared.block_metadata import get_block_metadata
-from shared.clickhouse.batch_insert import buffer_insert, set_debug_mode
+from shared.clickhouse.batch_insert import buffer_insert_many, set_debug_mode
+from shared.clickhouse.dedup import DEDUP_TABLE_SETTINGS
 from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
 )
 from shared.shovel_base_class import ShovelBaseClass
+from shared.block_schedule import every_n_blocks
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
-from substrate import get_substrate_client
+from shared.async_substrate import get_async_substrate_client
+import asyncio
 import logging
 from typing import Dict, List, Any
 from typing import Union
@@ -52,19 +55,19 @@ def create_validators_table(table_name):
             subnet_hotkey_alpha Map(UInt64, Float64)
         ) ENGINE = ReplacingMergeTree()
         ORDER BY (block_number, address)
+        {DEDUP_TABLE_SETTINGS}
         """
 
         get_clickhouse_client().execute(query)
 
-def get_subnet_uids(substrate, block_hash: str) -> List[int]:
+async def get_subnet_uids(substrate, block_hash: str) -> List[int]:
     try:
-        result = substrate.runtime_call(
+        subnet_info = await substrate.runtime_call(
             api="SubnetInfoRuntimeApi",
             method="get_subnets_info",
             params=[],
             block_hash=block_hash
         )
-        subnet_info = result.value
 
         return [info['netuid'] for info in subnet_info if 'netuid' in info]
     except Exception as e:
@@ -78,23 +81,37 @@ def get_active_validators(substrate, block_hash: str, delegate_info) -> List[str
         logging.error(f"Failed to get active validators: {str(e)}")
         return []
 
-def is_registered_in_subnet(substrate, net_uid: int, address: str, block_hash: str) -> bool:
+async def get_identities_and_alphas(substrate, validators: List[str], owners: List[str], subnet_uids: List[int], block_hash: str):
+    """
+    Reads every owner's identity, and every validator's UID and TotalHotkeyAlpha on every
+    subnet, in concurrent batched requests. Returns ({owner: identity}, {(address, net_uid):
+    alpha}), the latter only for the subnets each validator is registered in.
+    """
     try:
-        result = substrate.query("SubtensorModule", "Uids", [net_uid, address], block_hash=block_hash)
-        return result is not None
+        pairs = [(address, net_uid) for address in validators for net_uid in subnet_uids]
+        values = await substrate.query_storage_batch(
+            [("SubtensorModule", "IdentitiesV2", [owner]) for owner in owners]
+            + [("SubtensorModule", "Uids", [net_uid, address]) for (address, net_uid) in pairs]
+            + [("SubtensorModule", "TotalHotkeyAlpha", [address, net_uid]) for (address, net_uid) in pairs],
+            block_hash,
+        )
+        identities = dict(zip(owners, values[:len(owners)]))
+        uids = values[len(owners):len(owners) + len(pairs)]
+        alphas = {
+            pair: float(alpha) if alpha else 0.0
+            for (pair, uid, alpha) in zip(pairs, uids, values[len(owners) + len(pairs):])
+            if uid is not None
+        }
+        return (identities, alphas)
     except Exception as e:
-        logging.error(f"Failed to check subnet registration for {address} in subnet {net_uid}: {str(e)}")
-        return False
+        logging.error(f"Failed to get identities and total hotkey alpha: {str(e)}")
+        return ({}, {})
 
-def get_total_hotkey_alpha(substrate, address: str, net_uid: int, block_hash: str) -> float:
-    try:
-        result = substrate.query("SubtensorModule", "TotalHotkeyAlpha", [address, net_uid], block_hash=block_hash)
-        return float(result.value) if result.value else 0.0
-    except Exception as e:
-        logging.error(f"Failed to get total hotkey alpha for {address} in subnet {net_uid}: {str(e)}")
-        return 0.0
+def get_owner(address: str, delegate_info):
+    chain_info = next((d for d in delegate_info if decode_account_id(d['delegate_ss58']) == address), None)
+    return decode_account_id(chain_info.get('owner_ss58')) if chain_info else None
 
-def fetch_validator_info(substrate, address: str, block_hash: str, delegate_info) -> Dict[str, Any]:
+def fetch_validator_info(address: str, delegate_info, identities) -> Dict[str, Any]:
     try:
         chain_info = next((d for d in delegate_info if decode_account_id(d['delegate_ss58']) == address), None)
 
@@ -109,7 +126,7 @@ def fetch_validator_info(substrate, address: str, block_hash: str, delegate_info
 
         owner = decode_account_id(chain_info.get('owner_ss58'))
 
-        identity = substrate.query("SubtensorModule", "IdentitiesV2", [owner], block_hash=block_hash)
+        identity = identities.get(owner)
 
         return {
             "name": decode_string(identity.get('name', address)) if identity else address,
@@ -128,7 +145,7 @@ def fetch_validator_info(substrate, address: str, block_hash: str, delegate_info
             "url": None
         }
 
-def fetch_validator_stats(substrate, address: str, block_hash: str, delegate_info) -> Dict[str, Any]:
+def fetch_validator_stats(address: str, delegate_info, subnet_uids: List[int], alphas) -> Dict[str, Any]:
     try:
         info = next((d for d in delegate_info if decode_account_id(d['delegate_ss58']) == address), None)
 
@@ -143,16 +160,16 @@ def fetch_validator_stats(substrate, address: str, block_hash: str, delegate_inf
 
         return_per_1000 = int(info['return_per_1000'], 16) if isinstance(info['return_per_1000'], str) else info['return_per_1000']
 
-        subnet_uids = get_subnet_uids(substrate, block_hash)
         subnet_hotkey_alpha = {}
 
         for net_uid in subnet_uids:
-            if is_registered_in_subnet(substrate, net_uid, address, block_hash):
-                alpha = get_total_hotkey_alpha(substrate, address, net_uid, block_hash)
-                if alpha > 0:
-                    subnet_hotkey_alpha[net_uid] = alpha
-                else:
-                    subnet_hotkey_alpha[net_uid] = 0
+            if (address, net_uid) not in alphas:
+                continue
+            alpha = alphas[(address, net_uid)]
+            if alpha > 0:
+                subnet_hotkey_alpha[net_uid] = alpha
+            else:
+                subnet_hotkey_alpha[net_uid] = 0
 
         return {
             "nominators": len(info.get('nominators', [])),
@@ -173,17 +190,18 @@ def fetch_validator_stats(substrate, address: str, block_hash: str, delegate_inf
 
 class ValidatorsShovel(ShovelBaseClass):
     table_name = "shovel_validators"
+    # Each scheduled block is read whole from chain state at that block and nothing is carried
+    # over to the next, so backfill stays parallel
+    block_schedule = staticmethod(every_n_blocks(7200))
 
     def __init__(self, name):
         super().__init__(name)
         self.starting_block = FIRST_DTAO_BLOCK
 
-    def process_block(self, n):
-        if n % 7200 != 0:
-            return
+    async def process_block_async(self, n):
         try:
             logging.info(f"Processing block {n}")
-            substrate = get_substrate_client()
+            substrate = get_async_substrate_client()
             logging.info("Got substrate client")
 
             (block_timestamp, block_hash) = get_block_metadata(n)
@@ -192,51 +210,54 @@ class ValidatorsShovel(ShovelBaseClass):
             create_validators_table(self.table_name)
             logging.info("Ensured validators table exists")
 
-            logging.info("Fetching delegate info...")
-            delegate_info = substrate.runtime_call(
-                api="DelegateInfoRuntimeApi",
-                method="get_delegates",
-                params=[],
-                block_hash=block_hash
-            ).value
+            logging.info("Fetching delegate and subnet info...")
+            (delegate_info, subnet_uids) = await asyncio.gather(
+                substrate.runtime_call(
+                    api="DelegateInfoRuntimeApi",
+                    method="get_delegates",
+                    params=[],
+                    block_hash=block_hash
+                ),
+                get_subnet_uids(substrate, block_hash),
+            )
             logging.info(f"Got delegate info with {len(delegate_info)} entries")
 
             validators = get_active_validators(substrate, block_hash, delegate_info)
             logging.info(f"Found {len(validators)} active validators")
 
+            owners = list({owner for owner in (get_owner(v, delegate_info) for v in validators) if owner})
+            (identities, alphas) = await get_identities_and_alphas(substrate, validators, owners, subnet_uids, block_hash)
+            logging.info(f"Got {len(identities)} identities and {len(alphas)} subnet alphas")
+
             successful_inserts = 0
+            rows = []
             for idx, validator_address in enumerate(validators, 1):
                 try:
                     logging.info(f"Processing validator {idx}/{len(validators)}: {validator_address}")
 
-                    info = fetch_validator_info(substrate, validator_address, block_hash, delegate_info)
+                    info = fetch_validator_info(validator_address, delegate_info, identities)
                     logging.info(f"Got validator info for {validator_address}: name={info['name']}, owner={info['owner']}")
 
-                    stats = fetch_validator_stats(substrate, validator_address, block_hash, delegate_info)
+                    stats = fetch_validator_stats(validator_address, delegate_info, subnet_uids, alphas)
                     logging.info(f"Got validator stats for {validator_address}: nominators={stats['nominators']}, registrations={stats['registrations']}")
 
-                    def escape_string(s):
-                        if s is None:
-                            return 'NULL'
-                        return f"'{s.replace("'", "''")}'"
-
                     values = [
                         n,
                         block_timestamp,
-                        escape_string(info['name']),
-                        escape_string(validator_address),
-                        escape_string(info['image']),
-                        escape_string(info['description']),
-                        escape_string(info['owner']),
-                        escape_string(info['url']),
+                        info['name'] or '',
+                        validator_address,
+                        info['image'],
+                        info['description'],
+                        info['owner'],
+                        info['url'],
                         stats["nominators"],
                         stats["daily_return"],
-                        f"[{','.join(str(x) for x in stats['registrations'])}]",
-                        f"[{','.join(str(x) for x in stats['validator_permits'])}]",
-                        f"{{{','.join(f'{k}:{v}' for k,v in stats['subnet_hotkey_alpha'].items())}}}" if stats['subnet_hotkey_alpha'] else '{}'
+                        stats['registrations'],
+                        stats['validator_permits'],
+                        stats['subnet_hotkey_alpha'],
                     ]
 
-                    buffer_insert(self.table_name, values)
+                    rows.append(values)
                     successful_inserts += 1
                     logging.info(f"Successfully processed validator {validator_address} ({idx}/{len(validators)})")
 
@@ -244,19 +265,13 @@ class ValidatorsShovel(ShovelBaseClass):
                     logging.error(f"Error processing validator {validator_address} ({idx}/{len(validators)}): {str(e)}")
                     continue
 
+            buffer_insert_many(self.table_name, rows)
+
             logging.info(f"Block {n} summary:")
             logging.info(f"- Total validators: {len(validators)}")
             logging.info(f"- Successful inserts: {successful_inserts}")
             logging.info(f"- Failed inserts: {len(validators) - successful_inserts}")
 
-            logging.info(f"Mannually updating shovel_checkpoints for block {n}")
-
-            buffer_insert(
-                "shovel_checkpoints",
-                [f"'{self.name}'", n],
-            )
-            logging.info(f"Done, processing another block")
-
         except DatabaseConnectionError as e:
             logging.error(f"Database connection error in block {n}: {str(e)}")
             raise
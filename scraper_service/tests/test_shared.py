@@ -0,0 +1,300 @@
+"""
+Unit tests for the buffering and backfill building blocks in `shared` that need neither
+Clickhouse nor an archive node.
+
+    cd scraper_service
+    python -m pytest tests
+"""
+import datetime
+import os
+import threading
+import time
+import pytest
+from shared.clickhouse import batch_insert, leases
+from shared.clickhouse.dedup import dedup_token, hash_rows, split_by_window
+from shared.clickhouse.wal import WriteAheadLog, read_unflushed
+from shared.header_index import HeaderIndex, RECORD
+
+
+class RecordingSink:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, shovel_name, table_name, rows, spans):
+        self.writes.append((table_name, list(rows), [list(span) for span in spans]))
+
+
+def write_log(directory, records):
+    """
+    Writes records to a sealed segment, as a run killed after logging them would leave it.
+    """
+    wal = WriteAheadLog(directory)
+    for record in records:
+        wal.append(record)
+    wal.rotate()
+    return WriteAheadLog(directory)
+
+
+# Write-ahead log replay
+
+def test_read_unflushed_keeps_rows_up_to_the_last_checkpoint(tmp_path):
+    wal = write_log(tmp_path, [
+        ("rows", 10, {"t": [[10, "a"], [10, "b"]]}),
+        ("rows", 10, {"t": [[10, "c"]], "u": [[10]]}),
+        ("checkpoint", 10),
+        ("rows", 11, {"t": [[11, "d"]]}),
+        ("checkpoint", 11),
+        # Block 12 never finished processing
+        ("rows", 12, {"t": [[12, "e"]]}),
+    ])
+    (rows_by_table, checkpoint) = read_unflushed(wal)
+    assert checkpoint == 11
+    assert rows_by_table == {
+        "t": ([[10, "a"], [10, "b"], [10, "c"], [11, "d"]], [[10, 3], [11, 1]]),
+        "u": ([[10]], [[10, 1]]),
+    }
+
+
+def test_read_unflushed_drops_discarded_blocks(tmp_path):
+    wal = write_log(tmp_path, [
+        ("rows", 1, {"t": [[1]]}),
+        ("rows", 2, {"t": [[2]]}),
+        ("rows", 3, {"t": [[3]]}),
+        ("discard", 2, 3),
+        ("rows", 4, {"t": [[4]]}),
+        ("checkpoint", 4),
+    ])
+    (rows_by_table, checkpoint) = read_unflushed(wal)
+    assert checkpoint == 4
+    assert rows_by_table == {"t": ([[1], [4]], [[1, 1], [4, 1]])}
+
+
+def test_read_unflushed_reads_logs_without_block_numbers(tmp_path):
+    wal = write_log(tmp_path, [("rows", {"t": [[1], [2]]}), ("checkpoint", 7)])
+    assert read_unflushed(wal) == ({"t": ([[1], [2]], [[None, 2]])}, 7)
+
+
+def test_read_unflushed_ignores_a_torn_last_record(tmp_path):
+    wal = write_log(tmp_path, [("rows", 1, {"t": [[1]]}), ("checkpoint", 1), ("rows", 2, {"t": [[2]]}), ("checkpoint", 2)])
+    [segment] = wal.segments()
+    path = wal._path(segment)
+    # Cut the last record short, as a crash while appending it would
+    os.truncate(path, os.path.getsize(path) - 1)
+    assert read_unflushed(WriteAheadLog(tmp_path)) == ({"t": ([[1]], [[1, 1]])}, 1)
+
+
+def test_read_unflushed_skips_the_segment_being_written(tmp_path):
+    wal = WriteAheadLog(tmp_path)
+    wal.append(("rows", 1, {"t": [[1]]}))
+    wal.append(("checkpoint", 1))
+    assert read_unflushed(wal) == ({}, None)
+
+
+# Insert profiles and window-aligned flushes
+
+@pytest.fixture
+def buffer_state(monkeypatch):
+    """
+    Runs a test against an empty buffer with the flush thread in this process, inserting into
+    a RecordingSink, and restores the module's state afterwards.
+    """
+    sink = RecordingSink()
+    monkeypatch.setattr(batch_insert, "sink", sink)
+    monkeypatch.setattr(batch_insert, "wal", None)
+    monkeypatch.setattr(batch_insert, "current_block", None)
+    monkeypatch.setattr(batch_insert, "window_flush_due", False)
+    monkeypatch.setattr(batch_insert, "flush_cycles", 0)
+    monkeypatch.setattr(batch_insert, "flush_thread_pid", os.getpid())
+    monkeypatch.setattr(batch_insert, "DEDUP_WINDOW_BLOCKS", 100)
+    batch_insert.reset_buffer()
+    yield sink
+    batch_insert.reset_buffer()
+
+
+def aligned_profile(flush_max_rows):
+    return batch_insert.InsertProfile(
+        "test", settings={}, flush_max_rows=flush_max_rows, flush_max_bytes=2**40,
+        flush_max_age=3600, align_to_windows=True,
+    )
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_full_buffer_waits_for_the_window_boundary(buffer_state, monkeypatch):
+    monkeypatch.setattr(batch_insert, "insert_profile", aligned_profile(flush_max_rows=2))
+    batch_insert.set_current_block(150)
+    batch_insert.buffer_insert_many("t", [[150], [150]])
+    # Over flush_max_rows, but the window isn't complete yet
+    assert batch_insert.window_flush_due
+    assert not batch_insert.flush_requested
+    batch_insert.set_current_block(199)
+    batch_insert.buffer_insert("t", [199])
+    assert not batch_insert.flush_requested
+
+    # Entering the next window requests the flush and waits until it has taken the buffer
+    crossed = threading.Thread(target=batch_insert.set_current_block, args=(200,))
+    crossed.start()
+    wait_for(lambda: batch_insert.flush_requested)
+    assert crossed.is_alive()
+    batch_insert.drain_buffer()
+    crossed.join(timeout=5)
+    assert not crossed.is_alive()
+
+    assert buffer_state.writes == [("t", [[150], [150], [199]], [[150, 2], [199, 1]])]
+    assert not batch_insert.window_flush_due
+    assert batch_insert.current_block == 200
+
+
+def test_window_boundary_without_a_due_flush_does_not_wait(buffer_state, monkeypatch):
+    monkeypatch.setattr(batch_insert, "insert_profile", aligned_profile(flush_max_rows=10))
+    batch_insert.set_current_block(99)
+    batch_insert.buffer_insert("t", [99])
+    batch_insert.set_current_block(100)
+    assert not batch_insert.flush_requested
+    assert batch_insert.flush_cycles == 0
+
+
+def test_unaligned_profile_requests_a_flush_immediately(buffer_state, monkeypatch):
+    profile = batch_insert.InsertProfile("tail", {}, flush_max_rows=2, flush_max_bytes=2**40, flush_max_age=3600)
+    monkeypatch.setattr(batch_insert, "insert_profile", profile)
+    batch_insert.set_current_block(150)
+    batch_insert.buffer_insert_many("t", [[150], [150]])
+    assert batch_insert.flush_requested
+    assert not batch_insert.window_flush_due
+
+
+def test_discard_blocks_drops_buffered_and_requeued_rows(buffer_state, monkeypatch):
+    monkeypatch.setattr(batch_insert, "insert_profile", aligned_profile(flush_max_rows=100))
+    for block_number in (1, 2, 3):
+        batch_insert.set_current_block(block_number)
+        batch_insert.buffer_insert("t", [block_number])
+    batch_insert.requeue([("u", [[2], [5]], [[2, 1], [5, 1]], 16)])
+    batch_insert.discard_blocks(2, 3)
+    batch_insert.drain_buffer()
+    assert buffer_state.writes == [("u", [[5]], [[5, 1]]), ("t", [[1]], [[1, 1]])]
+
+
+# Backfill leases
+
+class FakeLeases:
+    """
+    Stands in for the reads and writes `claim_range` makes, with each `get_range_holder` call
+    answered by the next of `holders`.
+    """
+
+    def __init__(self, monkeypatch, holders):
+        self.holders = list(holders)
+        self.writes = []
+        monkeypatch.setattr(leases, "get_range_holder", self.get_range_holder)
+        monkeypatch.setattr(leases, "_write_lease", self.write_lease)
+
+    def get_range_holder(self, shovel_name, range_start):
+        return self.holders.pop(0)
+
+    def write_lease(self, *args):
+        self.writes.append(args)
+
+
+def test_claim_range_wins_a_free_range(monkeypatch):
+    claimed_at = datetime.datetime(2024, 1, 1)
+    fake = FakeLeases(monkeypatch, [None, ("me", claimed_at, False), ("me", claimed_at, False)])
+    assert leases.claim_range("s", 0, 99, "me", ttl_seconds=30, settle_seconds=0) == claimed_at
+    assert fake.writes == [("s", 0, 99, "me", None, 30, "false")]
+    assert fake.holders == []
+
+
+def test_claim_range_leaves_a_held_range_alone(monkeypatch):
+    fake = FakeLeases(monkeypatch, [("other", datetime.datetime(2024, 1, 1), False)])
+    assert leases.claim_range("s", 0, 99, "me", ttl_seconds=30, settle_seconds=0) is None
+    assert fake.writes == []
+
+
+def test_claim_range_yields_to_an_earlier_claim_seen_while_settling(monkeypatch):
+    earlier = datetime.datetime(2024, 1, 1)
+    mine = datetime.datetime(2024, 1, 1, 0, 0, 1)
+    # The competing claim was stamped first but only becomes visible after our first check
+    fake = FakeLeases(monkeypatch, [None, ("me", mine, False), ("other", earlier, False)])
+    assert leases.claim_range("s", 0, 99, "me", ttl_seconds=30, settle_seconds=0) is None
+    assert len(fake.writes) == 1
+
+
+def test_claim_range_leaves_a_done_range_alone(monkeypatch):
+    FakeLeases(monkeypatch, [None, ("me", datetime.datetime(2024, 1, 1), True)])
+    assert leases.claim_range("s", 0, 99, "me", ttl_seconds=30, settle_seconds=0) is None
+
+
+def test_renew_lease_reports_a_lost_lease(monkeypatch):
+    claimed_at = datetime.datetime(2024, 1, 1)
+    fake = FakeLeases(monkeypatch, [("me", claimed_at, False), ("other", claimed_at, False), None])
+    assert leases.renew_lease("s", 0, 99, "me", claimed_at, 30)
+    assert not leases.renew_lease("s", 0, 99, "me", claimed_at, 30)
+    assert not leases.renew_lease("s", 0, 99, "me", claimed_at, 30)
+    assert fake.writes == [("s", 0, 99, "me", claimed_at, 30, "false")]
+
+
+# Deduplication tokens
+
+def test_split_by_window_follows_spans():
+    rows = [[1], [1], [99], [100], [250], ["late"]]
+    spans = [[1, 2], [99, 1], [100, 1], [250, 1]]
+    assert list(split_by_window(rows, spans, window=100)) == [
+        (1, 99, [[1], [1], [99]]),
+        (100, 100, [[100]]),
+        (250, 250, [[250]]),
+        # Rows buffered outside of any block
+        (None, None, [["late"]]),
+    ]
+
+
+def test_split_by_window_keeps_rows_without_a_block_together():
+    assert list(split_by_window([[1], [2]], [[None, 2]], window=100)) == [(None, None, [[1], [2]])]
+
+
+def test_dedup_token_is_stable_and_covers_every_row():
+    rows = [[n, f"5F{n}", [n, n + 1]] for n in range(10_000)]
+    token = dedup_token("events", "t", 0, 99, rows)
+    assert token == dedup_token("events", "t", 0, 99, [list(row) for row in rows])
+    assert token.startswith("events:t:0-99:10000:")
+
+    changed = [list(row) for row in rows]
+    # Past the first hashed slice, so only a hash of every row notices
+    changed[9_000][1] = "5Fchanged"
+    assert dedup_token("events", "t", 0, 99, changed) != token
+    assert dedup_token("events", "u", 0, 99, rows) != token
+    assert dedup_token("events", "t", 100, 199, rows) != token
+
+
+def test_hash_rows_falls_back_to_repr():
+    rows = [[datetime.datetime(2024, 1, 1), 1]]
+    assert hash_rows(rows) == hash_rows([[datetime.datetime(2024, 1, 1), 1]])
+    assert hash_rows(rows) != hash_rows([[datetime.datetime(2024, 1, 2), 1]])
+
+
+# Block header index
+
+def test_header_index_round_trip(tmp_path):
+    index = HeaderIndex(str(tmp_path / "headers" / "index"))
+    block_hash = "0x" + "ab" * 32
+    index.put(5, block_hash, 1_700_000_000)
+    assert index.get(5) == (block_hash, 1_700_000_000)
+    # Blocks before it read as zeroes, blocks past the end of the file aren't there yet
+    assert index.get(4) is None
+    assert index.get(6) is None
+    assert os.path.getsize(index.path) == 6 * RECORD.size
+
+
+def test_header_index_reader_sees_blocks_written_after_mapping(tmp_path):
+    path = str(tmp_path / "index")
+    writer = HeaderIndex(path)
+    reader = HeaderIndex(path)
+    assert reader.get(0) is None
+    writer.put(0, "0x" + "01" * 32, 1)
+    assert reader.get(0) == ("0x" + "01" * 32, 1)
+    writer.put(1000, "0x" + "02" * 32, 2)
+    assert reader.get(1000) == ("0x" + "02" * 32, 2)
+    assert reader.get(0) == ("0x" + "01" * 32, 1)